@@ -0,0 +1,237 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load generator for the `/explain`, `/get` and `/send` endpoints.
+
+Drive a running API either with a fixed number of concurrent clients (closed loop)
+or at a fixed request rate (open loop), and report the throughput, the latency
+percentiles and the resident memory of the server. Each request carries a distinct
+output by default, so the explanation cache does not answer for the provider.
+
+The `send` endpoint is measured as a client would use it: a `/get` to build the
+prompt followed by a `/send` of its UUID.
+
+Usage:
+    python benchmarks/load.py --url http://127.0.0.1:8000 --levels 1 8 32 64 128
+    python benchmarks/load.py --endpoint send --rps 50 100 200 --pid 1234
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+
+OUTPUT = "UNKNOWN: SNMP Table Request: Cant get a single value."
+ENDPOINTS = ("explain", "get", "send")
+
+
+class Load:
+    """
+    Requests sent to the API during a run and their results.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, endpoint: str, unique: bool):
+        self.client = client
+        self.endpoint = endpoint
+        self.unique = unique
+        self.run = uuid.uuid4().hex[:8]  # Keep outputs distinct across runs
+        self.count = itertools.count()
+        self.latencies: list[float] = []
+        self.errors = 0
+
+    async def request(self) -> None:
+        """
+        Send a request and record its latency, or count it as an error.
+        """
+        output = f"{OUTPUT} #{self.run}-{next(self.count)}" if self.unique else OUTPUT
+        params = {"type": "service", "output": output}
+        start = time.perf_counter()
+        try:
+            if self.endpoint == "send":
+                response = await self.client.get("/get", params=params)
+                if response.status_code == 200:
+                    _, uuid = response.json()
+                    response = await self.client.get("/send", params={"uuid": uuid})
+            else:
+                response = await self.client.get(f"/{self.endpoint}", params=params)
+        except httpx.HTTPError:
+            self.errors += 1
+            return
+        if response.status_code != 200:
+            self.errors += 1
+            return
+        self.latencies.append(time.perf_counter() - start)
+
+
+async def closed(load: Load, concurrency: int, duration: float) -> None:
+    """
+    Send requests from a fixed number of clients, each waiting for its answer.
+    """
+
+    async def client(deadline: float):
+        while time.perf_counter() < deadline:
+            await load.request()
+
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(client(deadline) for _ in range(concurrency)))
+
+
+async def opened(load: Load, rps: float, duration: float) -> None:
+    """
+    Send requests at a fixed rate whatever the answers take, as independent
+    clients do, so a slow server builds up a backlog instead of slowing the load.
+    """
+    tasks = set()
+    start = time.perf_counter()
+    for i in range(int(rps * duration)):
+        delay = start + i / rps - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(load.request())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Return the p-th percentile of the values, 0 if there are none.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def rss(pid: int | None) -> float | None:
+    """
+    Return the resident memory of a process in MiB, None if unknown.
+    """
+    if pid is None:
+        return None
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) / 1024
+    return None
+
+
+async def run(
+    url: str,
+    endpoint: str = "explain",
+    concurrency: int | None = None,
+    rps: float | None = None,
+    duration: float = 10,
+    unique: bool = True,
+    pid: int | None = None,
+) -> dict:
+    """
+    Drive the API at a fixed concurrency, or at a fixed rate if `rps` is given.
+    """
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=None) as client:
+        load = Load(client, endpoint, unique)
+        start = time.perf_counter()
+        if rps is not None:
+            await opened(load, rps, duration)
+        else:
+            await closed(load, concurrency or 1, duration)
+        elapsed = time.perf_counter() - start
+
+    latencies = load.latencies
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency if rps is None else None,
+        "rps": rps,
+        "requests": len(latencies),
+        "errors": load.errors,
+        "throughput": len(latencies) / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "rss": rss(pid),
+    }
+
+
+HEADER = (
+    f"{'endpoint':>8} {'load':>8} {'requests':>9} {'errors':>7} {'req/s':>8} "
+    f"{'p50 (s)':>8} {'p95 (s)':>8} {'p99 (s)':>8} {'RSS (MiB)':>10}"
+)
+
+
+def line(r: dict) -> str:
+    """
+    Format the result of a run as a line of the report.
+    """
+    load = f"{r['rps']:g}/s" if r["rps"] is not None else f"{r['concurrency']}"
+    memory = f"{r['rss']:>10.1f}" if r["rss"] is not None else f"{'-':>10}"
+    return (
+        f"{r['endpoint']:>8} {load:>8} {r['requests']:>9} {r['errors']:>7} "
+        f"{r['throughput']:>8.1f} {r['p50']:>8.3f} {r['p95']:>8.3f} "
+        f"{r['p99']:>8.3f} {memory}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", choices=ENDPOINTS, default="explain")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per level")
+    parser.add_argument(
+        "--levels",
+        type=int,
+        nargs="+",
+        default=[1, 8, 32, 64, 128, 256],
+        help="concurrent clients of each level",
+    )
+    parser.add_argument(
+        "--rps", type=float, nargs="+", help="request rates, instead of the levels"
+    )
+    parser.add_argument(
+        "--same-output",
+        action="store_true",
+        help="send the same output every time, to measure the cache",
+    )
+    parser.add_argument("--pid", type=int, help="process of the API, to report RSS")
+    args = parser.parse_args()
+
+    print(HEADER)
+    for level in args.rps or args.levels:
+        load = {"rps": level} if args.rps else {"concurrency": level}
+        r = asyncio.run(
+            run(
+                args.url,
+                args.endpoint,
+                duration=args.duration,
+                unique=not args.same_output,
+                pid=args.pid,
+                **load,
+            )
+        )
+        print(line(r))
+
+
+if __name__ == "__main__":
+    main()
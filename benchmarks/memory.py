@@ -0,0 +1,91 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memory benchmark of the prompt store.
+
+Store as many prompts as `/get` and `/explain` requests would and report the
+resident memory of the process, which must stay flat once the store is full.
+
+Usage:
+    python benchmarks/memory.py --requests 1000000 --size 10000 --compress
+"""
+
+import argparse
+import resource
+import sys
+from pathlib import Path
+from uuid import uuid4
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from pop.globals import TEMPLATE_PROMPT  # noqa: E402
+from pop.store import PromptStore  # noqa: E402
+
+
+def rss() -> float:
+    """
+    Return the current resident memory of the process in MiB.
+    """
+    with open("/proc/self/statm") as file:
+        pages = int(file.read().split()[1])
+    return pages * resource.getpagesize() / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=1_000_000)
+    parser.add_argument("--size", type=int, default=10_000, help="store max size")
+    parser.add_argument("--ttl", type=float, default=3600)
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument(
+        "--max-growth", type=float, default=5, help="allowed RSS growth (MiB)"
+    )
+    args = parser.parse_args()
+    if args.requests <= 2 * args.size:
+        parser.error(
+            "--requests must exceed twice --size, to measure the growth once the "
+            "store has been filled and renewed"
+        )
+
+    store = PromptStore(args.size, args.ttl, args.compress)
+    step = max(1, args.requests // 10)
+    baseline = None
+
+    print(f"{'requests':>10} {'stored':>8} {'RSS (MiB)':>10}")
+    for i in range(1, args.requests + 1):
+        store[uuid4()] = TEMPLATE_PROMPT.format(
+            output=f"CRITICAL: /var usage {i % 100}% - {i}",
+            type="service",
+            name=f"srv-{i % 5000}",
+            description="disk",
+            length=100,
+            language="English",
+        )
+        # Measure growth once the store has been filled and renewed.
+        if i == 2 * args.size:
+            baseline = rss()
+        if i % step == 0:
+            print(f"{i:>10} {len(store):>8} {rss():>10.1f}")
+
+    growth = rss() - baseline
+    print(f"RSS growth once the store is renewed: {growth:.1f} MiB")
+    if growth > args.max_growth:
+        sys.exit(f"RSS grew by more than {args.max_growth} MiB.")
+
+
+if __name__ == "__main__":
+    main()
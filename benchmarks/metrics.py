@@ -0,0 +1,101 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmark of the metrics.
+
+Measure the cost of updating each kind of metric and the overhead added by the
+metrics middleware to a request, compared to the same request without it.
+
+Usage:
+    python benchmarks/metrics.py --iterations 100000
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from pop import metrics  # noqa: E402
+
+
+class App:
+    """
+    Smallest ASGI application, standing for the API.
+    """
+
+    routes = []
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def per_call(function, iterations: int) -> float:
+    """
+    Return the duration of a call in nanoseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+async def per_request(app, iterations: int) -> float:
+    """
+    Return the duration of a request handled by an ASGI application in nanoseconds.
+    """
+    scope = {"type": "http", "path": "/explain", "app": App()}
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await app(scope, receive, send)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--iterations", type=int, default=100_000)
+    args = parser.parse_args()
+    n = args.iterations
+
+    counter = metrics.Counter("bench_total", "Benchmark counter.")
+    histogram = metrics.Histogram("bench_seconds", "Benchmark histogram.")
+    print(f"{'operation':<22} {'ns':>8}")
+    print(f"{'counter.inc':<22} {per_call(lambda: counter.inc('p', 'm'), n):>8.0f}")
+    print(
+        f"{'histogram.observe':<22} "
+        f"{per_call(lambda: histogram.observe('p', 'm', 0.42), n):>8.0f}"
+    )
+
+    bare = asyncio.run(per_request(App(), n))
+    middleware = metrics.MetricsMiddleware(App(), lambda: ("ollama", "qwen2:0.5b"))
+    measured = asyncio.run(per_request(middleware, n))
+    print(f"{'request overhead':<22} {measured - bare:>8.0f}")
+    print(f"{'render':<22} {per_call(metrics.render, 1000):>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
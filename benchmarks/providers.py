@@ -0,0 +1,147 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Overhead of the completion engines, the native clients of the providers against
+litellm.
+
+The completions are requested to the provider stub, which should answer at once
+(`--latency 0` and a high `--token-rate`), so the time measured is the one of the
+client: the latency percentiles and the CPU time of a completion, streamed or not,
+with the given number of concurrent requests. The import time of each engine is
+measured in a fresh interpreter.
+
+Usage:
+    python benchmarks/stub.py --latency 0 --token-rate 100000 &
+    python benchmarks/providers.py --requests 500 --concurrency 1 16
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+SRC = Path(__file__).parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+from startup import import_time  # noqa: E402
+
+ENGINES = {"native": "pop.providers", "litellm": "litellm"}
+MESSAGES = [
+    {"role": "system", "content": "You are a Centreon professional assistant."},
+    {
+        "role": "user",
+        "content": "UNKNOWN: SNMP Table Request: Cant get a single value.",
+    },
+]
+
+
+async def complete(engine: str, provider, model: str, stream: bool) -> None:
+    """
+    Request a completion, reading the whole stream if streamed.
+    """
+    from pop.providers import fallback
+
+    params = {"messages": MESSAGES, "max_tokens": 50}
+    if engine == "litellm":
+        target = fallback.astream if stream else fallback.acomplete
+        call = target(provider, model, **params)
+    else:
+        call = (provider.astream if stream else provider.acomplete)(model, **params)
+    if stream:
+        async for _ in call:
+            pass
+    else:
+        await call
+
+
+async def measure(
+    engine: str, provider, model: str, stream: bool, requests: int, concurrency: int
+) -> tuple[list[float], float]:
+    """
+    Return the latencies of the completions in seconds and the CPU time of one.
+    """
+    await complete(engine, provider, model, stream)  # Import and connect first
+    latencies: list[float] = []
+    pending = iter(range(requests))
+
+    async def client():
+        for _ in pending:
+            start = time.perf_counter()
+            await complete(engine, provider, model, stream)
+            latencies.append(time.perf_counter() - start)
+
+    cpu = time.process_time()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, (time.process_time() - cpu) / requests
+
+
+async def run(args: argparse.Namespace) -> None:
+    """
+    Measure the engines in a single event loop, as litellm keeps its clients
+    across loops.
+    """
+    from pop.globals import Provider
+    from pop.providers import PROVIDERS
+
+    models = {Provider.OLLAMA: "qwen2:0.5b", Provider.OPENAI: "gpt-4o"}
+    print(
+        f"\n{'engine':<8} {'provider':<8} {'stream':<6} {'clients':>7} "
+        f"{'p50 (ms)':>9} {'p95 (ms)':>9} {'cpu (ms)':>9}"
+    )
+    for engine in args.engines:
+        for name, model in models.items():
+            for stream in (False, True):
+                for concurrency in args.concurrency:
+                    latencies, cpu = await measure(
+                        engine,
+                        PROVIDERS[name],
+                        model,
+                        stream,
+                        args.requests,
+                        concurrency,
+                    )
+                    p50 = statistics.median(latencies) * 1000
+                    p95 = statistics.quantiles(latencies, n=20)[-1] * 1000
+                    print(
+                        f"{engine:<8} {name.value:<8} {str(stream):<6} "
+                        f"{concurrency:>7} {p50:>9.2f} {p95:>9.2f} {cpu * 1000:>9.2f}"
+                    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1", help="host of the stub")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES))
+    args = parser.parse_args()
+
+    os.environ["OLLAMA_HOST"] = args.host
+    os.environ["OPENAI_BASE_URL"] = f"http://{args.host}:11434/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+    print(f"{'engine':<8} {'import (s)':>10}")
+    for engine in args.engines:
+        print(f"{engine:<8} {import_time(ENGINES[engine]):>10.3f}")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Matching time of the rule pack against the number of rules.
+
+The shipped rule pack is extended with generated rules, each one a message with a
+variable part, and outputs matching none of them, the first one or the last one
+are matched with the indexed pack and with a plain loop over the rules.
+
+Usage:
+    python benchmarks/rules.py --rules 10 100 1000 10000
+"""
+
+import argparse
+import random
+import re
+import string
+import sys
+import time
+from pathlib import Path
+
+SRC = Path(__file__).parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+from pop.globals import Language  # noqa: E402
+from pop.rules import Rule, RulePack, load  # noqa: E402
+
+OUTPUT = (
+    "CRITICAL: Partitions for table 'centreon_storage.data_bin' are not up to date "
+    "(current retention forward in days: 0)"
+)
+
+
+def generated(count: int) -> list[Rule]:
+    """
+    Return rules of random messages followed by a variable number.
+    """
+    random.seed(0)
+    rules = []
+    for number in range(count):
+        words = [
+            "".join(random.choices(string.ascii_lowercase, k=random.randint(4, 9)))
+            for _ in range(4)
+        ]
+        rules.append(
+            Rule(
+                name=f"rule-{number}",
+                pattern=re.compile(" ".join(words) + r" \((?P<code>\d+)\)"),
+                explanation="Generated {code}.",
+            )
+        )
+    return rules
+
+
+def measure(match, output: str, repeat: int) -> float:
+    """
+    Return the mean duration of a match in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        match(output)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rules", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=2000, help="matches measured")
+    args = parser.parse_args()
+
+    shipped = load(str(SRC / "pop" / "rules.yaml")).rules
+    print(f"{'rules':>6} {'output':>7} {'indexed (us)':>13} {'loop (us)':>10}")
+    for count in args.rules:
+        rules = shipped + generated(count)
+        pack = RulePack(rules)
+
+        def indexed(output):
+            return pack.match("service", "srv", output, "n/a", Language.ENGLISH)
+
+        def loop(output):
+            for rule in rules:
+                if rule.pattern.search(output):
+                    return rule.name
+            return None
+
+        last = rules[-1].pattern.pattern.replace(r"\((?P<code>\d+)\)", "(42)")
+        outputs = {
+            "none": OUTPUT,
+            "first": "UNKNOWN: SNMP Table Request: Cant get a single value.",
+            "last": f"CRITICAL: {last}",
+        }
+        for name, output in outputs.items():
+            assert (indexed(output) is None) == (loop(output) is None)
+            print(
+                f"{len(rules):>6} {name:>7} "
+                f"{measure(indexed, output, args.repeat):>13.1f} "
+                f"{measure(loop, output, max(1, args.repeat // 10)):>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
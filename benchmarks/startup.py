@@ -0,0 +1,112 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Startup benchmark of the API.
+
+Measure the import cost of the heaviest dependencies and the time until the API
+answers `/health`, in fresh processes. Exit with an error if the API takes longer
+than the threshold to answer.
+
+Usage:
+    python benchmarks/startup.py --runs 3 --max-health 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+SRC = str(Path(__file__).parents[1] / "src")
+MODULES = ["fastapi", "openai", "litellm", "pop.processor"]
+
+
+def import_time(module: str) -> float:
+    """
+    Return the time to import a module in a fresh interpreter, in seconds.
+    """
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    env = {**os.environ, "PYTHONPATH": SRC}
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def health_time(port: int, timeout: float) -> float:
+    """
+    Return the time until a new API process answers `/health`, in seconds.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "PYTHONPATH": SRC,
+            "POP_CONFIG_PATH": os.path.join(directory, "pop.yaml"),
+        }
+        code = f"import uvicorn; uvicorn.run('pop.api:app', port={port})"
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-c", code],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            while time.perf_counter() - start < timeout:
+                try:
+                    httpx.get(f"http://127.0.0.1:{port}/health", timeout=1)
+                except httpx.TransportError:
+                    time.sleep(0.05)
+                    continue
+                return time.perf_counter() - start
+            return float("inf")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--max-health", type=float, default=10, help="threshold to answer (s)"
+    )
+    args = parser.parse_args()
+
+    print(f"{'import':<16} {'median (s)':>10}")
+    for module in MODULES:
+        times = [import_time(module) for _ in range(args.runs)]
+        print(f"{module:<16} {statistics.median(times):>10.3f}")
+
+    times = [health_time(args.port, 2 * args.max_health) for _ in range(args.runs)]
+    median = statistics.median(times)
+    print(f"{'/health':<16} {median:>10.3f}")
+    if median > args.max_health:
+        sys.exit(f"The API took more than {args.max_health}s to answer /health.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stub LLM server speaking the OpenAI and Ollama protocols.
+
+Answers are generated locally with a configurable latency before the first token,
+token rate and error rate, so benchmarks can run offline. With a load time, Ollama
+models are loaded as Ollama does: on the first request, again after their
+keep-alive expired or when requested with another context size or thread count.
+With a quota of requests per minute, OpenAI requests beyond it are rejected with a
+429 status, and every answer gives the rate limit headers of OpenAI.
+
+Usage:
+    python benchmarks/stub.py --port 11434 --latency 0.2 --token-rate 50 --tokens 20
+    python benchmarks/stub.py --load-time 3 --keep-alive 10
+    python benchmarks/stub.py --rpm 600
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+import zlib
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+MODELS = ["qwen2:0.5b", "gpt-4o"]
+WORDS = (
+    "The plugin could not reach the monitored resource, check the network, "
+    "the credentials and the service configuration then run the check again."
+).split()
+
+
+class Behavior:
+    """
+    Behavior of the stub, set from the command line.
+    """
+
+    latency = 0.2  # Seconds before the first token
+    token_rate = 50.0  # Tokens per second
+    tokens = 20  # Tokens per answer
+    error_rate = 0.0  # Fraction of requests failing
+    load_time = 0.0  # Seconds to load an Ollama model
+    keep_alive = 300.0  # Seconds an Ollama model stays loaded, by default
+    rpm: int | None = None  # OpenAI requests per minute
+
+
+# Options of an Ollama request which need the model to be loaded again.
+LOAD_OPTIONS = ("num_ctx", "num_thread", "num_gpu")
+UNITS = {"s": 1, "m": 60, "h": 3600}
+
+app = FastAPI()
+stats = {"requests": 0, "errors": 0, "loads": 0, "tokens": 0, "limited": 0}
+quota_state = {"level": None, "updated": 0.0}  # Requests left in the quota bucket
+loaded: dict[str, tuple[float, dict]] = {}  # Model: unload time, load options
+
+
+def words(limit: int | None = None) -> list[str]:
+    count = min(Behavior.tokens, limit or Behavior.tokens)
+    return [WORDS[i % len(WORDS)] for i in range(count)]
+
+
+def limit(body: dict) -> int | None:
+    """
+    Return the maximum number of tokens of the answer, if any.
+    """
+    return body.get("max_tokens") or body.get("options", {}).get("num_predict")
+
+
+def reason(body: dict) -> str:
+    """
+    Return why the answer ended, its length or its end.
+    """
+    return "length" if (limit(body) or Behavior.tokens) < Behavior.tokens else "stop"
+
+
+def usage(body: dict) -> int:
+    """
+    Return the number of prompt tokens, roughly 4 characters per token.
+    """
+    return len(json.dumps(body.get("messages", body.get("prompt", "")))) // 4
+
+
+async def fail() -> bool:
+    """
+    Count a request and return True if it must fail, after the latency.
+    """
+    stats["requests"] += 1
+    await asyncio.sleep(Behavior.latency)
+    if random.random() < Behavior.error_rate:
+        stats["errors"] += 1
+        return True
+    return False
+
+
+async def generate(limit: int | None = None):
+    """
+    Yield the tokens of an answer at the configured rate, stopped when the client
+    goes away.
+    """
+    for i, word in enumerate(words(limit)):
+        if i:
+            await asyncio.sleep(1 / Behavior.token_rate)
+        stats["tokens"] += 1
+        yield word + " "
+
+
+def seconds(keep_alive: str | float | None) -> float:
+    """
+    Return a keep-alive in seconds, given in seconds or as a duration like "5m".
+    """
+    if keep_alive is None:
+        return Behavior.keep_alive
+    if isinstance(keep_alive, str) and keep_alive[-1:] in UNITS:
+        return float(keep_alive[:-1]) * UNITS[keep_alive[-1]]
+    return float(keep_alive)
+
+
+async def load(body: dict) -> None:
+    """
+    Load the model of an Ollama request if it is not loaded with its options,
+    then keep it loaded for the keep-alive of the request, forever if negative.
+    """
+    model = body["model"]
+    options = {
+        key: value
+        for key, value in (body.get("options") or {}).items()
+        if key in LOAD_OPTIONS
+    }
+    until, current = loaded.get(model, (0.0, {}))
+    if time.monotonic() >= until or options != current:
+        stats["loads"] += 1
+        await asyncio.sleep(Behavior.load_time)
+    keep_alive = seconds(body.get("keep_alive"))
+    until = math.inf if keep_alive < 0 else time.monotonic() + keep_alive
+    loaded[model] = (until, options)
+
+
+def quota() -> tuple[bool, dict]:
+    """
+    Count an OpenAI request in the quota, a bucket refilled continuously as the
+    one of OpenAI, return whether it is over the quota and the rate limit headers
+    of its answer.
+    """
+    if Behavior.rpm is None:
+        return False, {}
+    now, rate = time.monotonic(), Behavior.rpm / 60
+    level = quota_state["level"]
+    level = Behavior.rpm if level is None else level
+    level = min(Behavior.rpm, level + (now - quota_state["updated"]) * rate)
+    limited = level < 1
+    if not limited:
+        level -= 1
+    quota_state.update(level=level, updated=now)
+    headers = {
+        "x-ratelimit-limit-requests": str(Behavior.rpm),
+        "x-ratelimit-remaining-requests": str(int(level)),
+        "x-ratelimit-reset-requests": f"{(Behavior.rpm - level) / rate:.3f}s",
+    }
+    if limited:
+        headers["retry-after"] = f"{(1 - level) / rate:.3f}"
+    return limited, headers
+
+
+# OpenAI protocol
+
+
+@app.get("/v1/models")
+async def openai_models():
+    data = [{"id": model, "object": "model", "owned_by": "stub"} for model in MODELS]
+    return {"object": "list", "data": data}
+
+
+@app.post("/v1/chat/completions")
+async def openai_chat(request: Request):
+    body = await request.json()
+    limited, headers = quota()
+    if limited:
+        stats["limited"] += 1
+        error = {"message": "Rate limit reached for requests", "code": "rate_limit"}
+        return JSONResponse({"error": error}, status_code=429, headers=headers)
+    if await fail():
+        return JSONResponse({"error": {"message": "Injected error"}}, status_code=500)
+
+    prompt_tokens = usage(body)
+    base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time())}
+    base["model"] = body["model"]
+    completion_tokens = len(words(limit(body)))
+    counts = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+    counts["total_tokens"] = prompt_tokens + completion_tokens
+
+    if not body.get("stream"):
+        start = time.perf_counter()
+        content = "".join([token async for token in generate(limit(body))])
+        choice = {"index": 0, "message": {"role": "assistant", "content": content}}
+        choice["finish_reason"] = reason(body)
+        # Generation time, as given by OpenAI.
+        processing = f"{(time.perf_counter() - start) * 1000:.0f}"
+        return JSONResponse(
+            {**base, "object": "chat.completion", "choices": [choice], "usage": counts},
+            headers={"openai-processing-ms": processing, **headers},
+        )
+
+    async def chunks():
+        base["object"] = "chat.completion.chunk"
+        async for token in generate(limit(body)):
+            choice = {"index": 0, "delta": {"content": token}, "finish_reason": None}
+            yield f"data: {json.dumps({**base, 'choices': [choice]})}\n\n"
+        choice = {"index": 0, "delta": {}, "finish_reason": reason(body)}
+        yield f"data: {json.dumps({**base, 'choices': [choice]})}\n\n"
+        if body.get("stream_options", {}).get("include_usage"):
+            yield f"data: {json.dumps({**base, 'choices': [], 'usage': counts})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(chunks(), media_type="text/event-stream", headers=headers)
+
+
+# Ollama protocol
+
+
+@app.get("/")
+async def ollama_root():
+    return PlainTextResponse("Ollama is running")
+
+
+@app.get("/api/tags")
+async def ollama_tags():
+    return {"models": [{"name": model, "model": model} for model in MODELS]}
+
+
+@app.post("/api/show")
+async def ollama_show():
+    return {"template": "", "model_info": {}, "details": {}}
+
+
+@app.post("/api/pull")
+async def ollama_pull():
+    return {"status": "success"}
+
+
+@app.post("/api/generate")
+@app.post("/api/chat")
+async def ollama_generate(request: Request):
+    body = await request.json()
+    chat = request.url.path.endswith("chat")
+    start = time.perf_counter()
+    await load(body)
+    if not body.get("messages" if chat else "prompt"):
+        # Nothing to answer, the model is only loaded.
+        answer = {"message": {"role": "assistant", "content": ""}} if chat else {}
+        return {"model": body["model"], "response": "", "done": True, **answer}
+    if await fail():
+        return JSONResponse({"error": "Injected error"}, status_code=500)
+
+    def message(content: str, done: bool) -> dict:
+        result = {"model": body["model"], "created_at": "", "done": done}
+        if chat:
+            result["message"] = {"role": "assistant", "content": content}
+        else:
+            result["response"] = content
+        if done:
+            result["done_reason"] = reason(body)
+            result["prompt_eval_count"] = usage(body)
+            result["eval_count"] = len(words(limit(body)))
+            # Nanoseconds spent, as given by Ollama.
+            result["total_duration"] = int((time.perf_counter() - start) * 1e9)
+        return result
+
+    if not body.get("stream", True):
+        content = "".join([token async for token in generate(limit(body))])
+        return message(content, True)
+
+    async def lines():
+        async for token in generate(limit(body)):
+            yield json.dumps(message(token, False)) + "\n"
+        yield json.dumps(message("", True)) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/api/embed")
+async def ollama_embed(request: Request):
+    body = await request.json()
+    await load(body)
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    return {"model": body["model"], "embeddings": [embedding(text) for text in texts]}
+
+
+def embedding(text: str, dimensions: int = 256) -> list[float]:
+    """
+    Return the counts of the hashed character trigrams of a text, so similar
+    texts have similar embeddings.
+    """
+    vector = [0.0] * dimensions
+    for i in range(len(text) - 2):
+        vector[zlib.crc32(text[i : i + 3].encode()) % dimensions] += 1
+    return vector
+
+
+@app.get("/stats")
+async def stub_stats():
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=Behavior.latency)
+    parser.add_argument("--token-rate", type=float, default=Behavior.token_rate)
+    parser.add_argument("--tokens", type=int, default=Behavior.tokens)
+    parser.add_argument("--error-rate", type=float, default=Behavior.error_rate)
+    parser.add_argument("--load-time", type=float, default=Behavior.load_time)
+    parser.add_argument("--keep-alive", type=float, default=Behavior.keep_alive)
+    parser.add_argument("--rpm", type=int, help="OpenAI requests per minute")
+    args = parser.parse_args()
+
+    Behavior.latency = args.latency
+    Behavior.token_rate = args.token_rate
+    Behavior.tokens = args.tokens
+    Behavior.error_rate = args.error_rate
+    Behavior.load_time = args.load_time
+    Behavior.keep_alive = args.keep_alive
+    Behavior.rpm = args.rpm
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
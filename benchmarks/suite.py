@@ -0,0 +1,219 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline benchmark suite of the API.
+
+Start the stub LLM server in place of Ollama and the API in front of it, run a
+fixed set of load scenarios and write their results to a JSON file. Given the
+results of a previous run as a baseline, exit with an error if the throughput
+dropped or the 95th percentile of the latency grew by more than the tolerance.
+
+Usage:
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --baseline results.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import yaml
+
+import load
+
+HERE = Path(__file__).parent
+SRC = str(HERE.parent / "src")
+
+# Latency increase ignored whatever the tolerance, in seconds, as a few
+# milliseconds of noise are a large relative change on fast endpoints.
+SLACK = 0.01
+
+# Name, endpoint and load of each scenario.
+SCENARIOS = [
+    ("explain-c1", "explain", {"concurrency": 1}),
+    ("explain-c16", "explain", {"concurrency": 16}),
+    ("explain-c64", "explain", {"concurrency": 64}),
+    ("explain-rps50", "explain", {"rps": 50}),
+    ("get-c16", "get", {"concurrency": 16}),
+    ("send-c16", "send", {"concurrency": 16}),
+]
+
+CONFIG = {
+    "provider": "ollama",
+    "model": "qwen2:0.5b",
+    "language": "English",
+    "length": 100,
+    "failover": False,
+    "cache_persist": False,
+}
+
+
+def wait(url: str, timeout: float) -> None:
+    """
+    Wait until an URL answers 200.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    sys.exit(f"{url} did not answer within {timeout}s.")
+
+
+def start(
+    args: argparse.Namespace,
+    directory: str,
+    processes: list[subprocess.Popen],
+    config: dict = CONFIG,
+    options: tuple[str, ...] = (),
+) -> None:
+    """
+    Start the stub LLM server and the API using it, adding them to the processes
+    as soon as they are started so the caller can stop them whatever happens.
+    The configuration of the API and further options of the stub can be given.
+    """
+    try:
+        httpx.get("http://127.0.0.1:11434/", timeout=1)
+        sys.exit("Port 11434 is in use, stop Ollama or the stub running there.")
+    except httpx.TransportError:
+        pass
+
+    stub = subprocess.Popen(
+        [
+            sys.executable,
+            str(HERE / "stub.py"),
+            f"--latency={args.latency}",
+            f"--token-rate={args.token_rate}",
+            f"--tokens={args.tokens}",
+            f"--error-rate={args.error_rate}",
+            *options,
+        ]
+    )
+    processes.append(stub)
+    wait("http://127.0.0.1:11434/", 10)
+
+    path = Path(directory) / "pop.yaml"
+    path.write_text(yaml.dump(config))
+    env = {
+        **os.environ,
+        "PYTHONPATH": SRC,
+        "POP_CONFIG_PATH": str(path),
+        "POP_DB_PATH": str(Path(directory) / "pop.db"),
+        "OLLAMA_HOST": "127.0.0.1",
+    }
+    code = (
+        "import uvicorn; "
+        f"uvicorn.run('pop.api:app', port={args.port}, log_level='warning')"
+    )
+    api = subprocess.Popen(
+        [sys.executable, "-c", code],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    processes.append(api)
+    wait(f"http://127.0.0.1:{args.port}/ready", 30)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Return the regressions of the results compared to the baseline.
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {result['throughput']:.1f} req/s, "
+                f"was {before['throughput']:.1f} req/s"
+            )
+        if result["p95"] > before["p95"] * (1 + tolerance) + SLACK:
+            regressions.append(
+                f"{name}: p95 {result['p95']:.3f}s, was {before['p95']:.3f}s"
+            )
+        if result["errors"] > before["errors"]:
+            regressions.append(
+                f"{name}: {result['errors']} errors, was {before['errors']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--duration", type=float, default=5, help="seconds each")
+    parser.add_argument("--latency", type=float, default=0.2, help="stub latency")
+    parser.add_argument("--token-rate", type=float, default=50, help="stub tokens/s")
+    parser.add_argument("--tokens", type=int, default=20, help="stub answer tokens")
+    parser.add_argument("--error-rate", type=float, default=0, help="stub errors")
+    parser.add_argument("--output", type=Path, help="file to write the results to")
+    parser.add_argument("--baseline", type=Path, help="results to compare to")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="relative regression allowed"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        processes: list[subprocess.Popen] = []
+        try:
+            start(args, directory, processes)
+            url = f"http://127.0.0.1:{args.port}"
+            print(f"{'scenario':<14} {load.HEADER}")
+            for name, endpoint, scenario in SCENARIOS:
+                result = asyncio.run(
+                    load.run(
+                        url,
+                        endpoint,
+                        duration=args.duration,
+                        pid=processes[1].pid,
+                        **scenario,
+                    )
+                )
+                results[name] = result
+                print(f"{name:<14} {load.line(result)}")
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    if args.baseline:
+        regressions = compare(
+            results, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
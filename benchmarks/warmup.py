@@ -0,0 +1,121 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cold and warm latency of the API with the Ollama model lifecycle management.
+
+Start the stub LLM server, loading its models in `--load-time` seconds and
+unloading them after `--keep-alive` seconds by default as Ollama does, and the API
+in front of it with each scenario of configuration. Then measure the latency of
+the first request, of warm requests, and of a request after being idle longer
+than the default keep-alive, along with the number of model loads.
+
+Usage:
+    python benchmarks/warmup.py --load-time 2 --keep-alive 5 --idle 8
+"""
+
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+import load
+import suite
+
+# Name and configuration of each scenario, the keep-alive is set by main.
+SCENARIOS = [
+    ("unmanaged", {"warm_up": False}),
+    ("warm-up", {"warm_up": True}),
+    ("keep-warm", {"warm_up": True, "keep_warm": None}),
+    ("keep-alive", {"warm_up": True, "keep_alive": -1}),
+]
+
+
+def warmed(url: str, timeout: float) -> None:
+    """
+    Wait until the API discovered the providers and warmed up the model.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if httpx.get(f"{url}/health").json()["status"] == "ready":
+            return
+        time.sleep(0.1)
+    sys.exit(f"The API did not warm up within {timeout}s.")
+
+
+def explain(client: httpx.Client) -> float:
+    """
+    Explain a new output and return the latency of the request.
+    """
+    output = f"{load.OUTPUT} #{uuid.uuid4().hex}"
+    start = time.perf_counter()
+    response = client.get("/explain", params={"type": "service", "output": output})
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--load-time", type=float, default=2, help="model load")
+    parser.add_argument(
+        "--keep-alive", type=float, default=5, help="default keep-alive of the stub"
+    )
+    parser.add_argument("--idle", type=float, default=8, help="idle time measured")
+    parser.add_argument("--requests", type=int, default=5, help="warm requests")
+    parser.add_argument("--latency", type=float, default=0.2, help="stub latency")
+    parser.add_argument("--token-rate", type=float, default=50, help="stub tokens/s")
+    parser.add_argument("--tokens", type=int, default=20, help="stub answer tokens")
+    args = parser.parse_args()
+    args.error_rate = 0
+
+    url = f"http://127.0.0.1:{args.port}"
+    print(
+        f"{'scenario':<11} {'first (s)':>10} {'warm (s)':>9} "
+        f"{'after idle (s)':>15} {'loads':>6}"
+    )
+    for name, scenario in SCENARIOS:
+        config = {**suite.CONFIG, "keep_alive": f"{args.keep_alive:g}s", **scenario}
+        if "keep_warm" in scenario:
+            # Ping before the default keep-alive expires.
+            config["keep_warm"] = args.keep_alive / 2
+        options = (f"--load-time={args.load_time}", f"--keep-alive={args.keep_alive}")
+        with tempfile.TemporaryDirectory() as directory:
+            processes = []
+            try:
+                suite.start(args, directory, processes, config, options)
+                warmed(url, args.load_time + 30)
+                with httpx.Client(base_url=url, timeout=None) as client:
+                    first = explain(client)
+                    warm = statistics.median(
+                        explain(client) for _ in range(args.requests)
+                    )
+                    time.sleep(args.idle)
+                    idle = explain(client)
+                    loads = client.get("http://127.0.0.1:11434/stats").json()["loads"]
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+        print(f"{name:<11} {first:>10.3f} {warm:>9.3f} {idle:>15.3f} {loads:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,13 +14,63 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
 import uvicorn
 
-from pop.api import app
+from pop.logger import logger
+from pop.settings import config_path, discover_fallbacks, load_settings
 
 
 def main():
 
+    parser = argparse.ArgumentParser(
+        prog="pop", description="Explain the outputs of Centreon plugins with a LLM."
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="serve the API, the default")
+    precompute = commands.add_parser(
+        "precompute", help="explain outputs ahead of the requests and cache them"
+    )
+    precompute.add_argument("path", help="CSV or NDJSON file of the outputs")
+    precompute.add_argument("--format", choices=("csv", "ndjson"))
+    precompute.add_argument(
+        "--concurrency",
+        type=int,
+        help="explanations requested at the same time, by default batch_concurrency",
+    )
+    precompute.add_argument(
+        "--checkpoint", help="file of the explained outputs, by default PATH.checkpoint"
+    )
+    precompute.add_argument(
+        "--interval", type=float, default=10, help="seconds between progress reports"
+    )
+    args = parser.parse_args()
+
+    if args.command == "precompute":
+        # Imported here so that serving doesn't import what it doesn't need.
+        from pop.precompute import run
+
+        run(args.path, args.format, args.concurrency, args.checkpoint, args.interval)
+    else:
+        serve()
+
+
+def serve():
+
+    try:
+        settings = load_settings(config_path(), discover=False)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit()
+    # The configuration may be incomplete until the providers are discovered.
+    workers = settings.workers if settings is not None else 1
+    workers = int(os.environ.get("POP_WORKERS", workers))
+
     log_config = {
         "version": 1,
         "disable_existing_loggers": False,
@@ -60,4 +110,28 @@ def main():
         },
     }
 
-    uvicorn.run(app, host="0.0.0.0", log_config=log_config)
+    if workers > 1:
+        # Discover every provider and write the configuration once, before
+        # starting the workers which trust the configuration and models files.
+        try:
+            settings = load_settings(config_path())
+        except ValueError as e:
+            logger.error(e)
+            sys.exit()
+        discover_fallbacks(settings, config_path())
+        os.environ["POP_DISCOVERED"] = "1"
+        # Workers must share the prompts, whatever the configuration says.
+        os.environ["POP_WORKERS"] = str(workers)
+        # Workers add up their metrics through files, fresh for each run.
+        os.environ["POP_METRICS_DIR"] = tempfile.mkdtemp(prefix="pop-metrics-")
+        try:
+            uvicorn.run(
+                "pop.api:app", host="0.0.0.0", workers=workers, log_config=log_config
+            )
+        finally:
+            shutil.rmtree(os.environ["POP_METRICS_DIR"], ignore_errors=True)
+    else:
+        # Imported here so that importing a submodule doesn't start the processor.
+        from pop.api import app
+
+        uvicorn.run(app, host="0.0.0.0", log_config=log_config)
@@ -14,19 +14,118 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import contextlib
+import json
+import os
+import signal
+from contextlib import asynccontextmanager
 from typing import Literal
 from uuid import UUID
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Query, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
+from pop import metrics, tracing
+from pop.globals import Output, Provider
+from pop.logger import logger
 from pop.processor import PluginProcessor
+from pop.providers import PROVIDERS
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Discover the providers in the background while serving requests, run the
+    jobs, and reload the configuration when it changes or on SIGHUP.
+    """
+    discovery = asyncio.create_task(processor.discover())
+    saving = asyncio.create_task(save_metrics())
+    warming = asyncio.create_task(processor.keep_warm())
+    watching = asyncio.create_task(processor.watch())
+    jobs = asyncio.create_task(processor.run_jobs())
+    checking = asyncio.create_task(processor.check_backends())
+    reloads = set()
+
+    def hangup():
+        task = asyncio.create_task(reload_config())
+        reloads.add(task)
+        task.add_done_callback(reloads.discard)
+
+    loop = asyncio.get_running_loop()
+    with contextlib.suppress(NotImplementedError, AttributeError):  # Windows
+        loop.add_signal_handler(signal.SIGHUP, hangup)
+    yield
+    discovery.cancel()
+    saving.cancel()
+    warming.cancel()
+    watching.cancel()
+    checking.cancel()
+    # Wait for the running jobs to be queued again.
+    jobs.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await jobs
+
+
+async def reload_config() -> None:
+    """
+    Reload the configuration, logging why if it failed.
+    """
+    try:
+        await processor.reload()
+    except ValueError as e:
+        logger.error(f"Configuration not reloaded: {e}")
+
+
+async def save_metrics(interval: float = 1) -> None:
+    """
+    Share the metrics with the other workers, if any, every interval in seconds.
+    """
+    directory = os.environ.get("POP_METRICS_DIR")
+    if directory is None:
+        return
+    while True:
+        await asyncio.to_thread(metrics.save, directory)
+        await asyncio.sleep(interval)
+
+
+app = FastAPI(lifespan=lifespan)
 processor = PluginProcessor()
 
 
-@app.get("/get", include_in_schema=False)
-def get_prompt(
+def current() -> tuple[str, str]:
+    """
+    Return the provider and the model in use, to label the metrics.
+    """
+    if processor.settings is None:
+        return "none", "none"
+    return processor.settings.provider.value, processor.settings.model
+
+
+app.add_middleware(metrics.MetricsMiddleware, current=current)
+# Outermost, so the traces include the other middlewares.
+app.add_middleware(
+    tracing.TracingMiddleware,
+    settings=lambda: processor.settings,
+    directory=os.path.join(os.path.dirname(processor.database), "profiles"),
+)
+
+
+def ready():
+    """
+    Reject requests until the processor is configured.
+    """
+    if processor.settings is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Not ready, providers discovery: {processor.status}",
+            headers={"Retry-After": "5"},
+        )
+
+
+@app.get("/get", include_in_schema=False, dependencies=[Depends(ready)])
+async def get_prompt(
+    response: Response,
     type: Literal["host", "service"],
     output: str = "n/a",
     name: str = "n/a",
@@ -36,7 +135,9 @@ def get_prompt(
     Build a prompt to be send to a LLM.
 
     This endpoint is useful if the prompt needs to be modified by the end user before
-    being sent to the LLM.
+    being sent to the LLM. The estimated tokens of the output before and after its
+    compaction are given by the `X-Output-Tokens` and `X-Output-Tokens-Compacted`
+    headers.
 
     Parameters:
     ----------
@@ -49,35 +150,281 @@ def get_prompt(
     description: str, optional
         The description of the host or service.
     """
-    return processor.get_prompt(type, name, output, description)
+    tracing.lap("validation")
+    prompt, uuid, compacted = await processor.get_prompt(
+        type, name, output, description
+    )
+    response.headers["X-Output-Tokens"] = str(compacted.before)
+    response.headers["X-Output-Tokens-Compacted"] = str(compacted.after)
+    return prompt, uuid
 
 
-@app.get("/send", include_in_schema=False)
-def send_prompt(prompt: str, uuid: UUID):
+@app.get("/send", include_in_schema=False, dependencies=[Depends(ready)])
+async def send_prompt(response: Response, uuid: UUID, prompt: str | None = None):
     """
     Send a prompt to a LLM.
 
+    If the answer is truncated, the `X-Truncated` header gives by what
+    (max_tokens) and the `X-Saved-Tokens` header the tokens of the budget left.
+
     Parameters:
     ----------
-    prompt: str
-        The prompt to send to the LLM.
     uuid: UUID
         The UUID of the prompt given by the get endpoint.
+    prompt: str, optional
+        The prompt to send to the LLM, the one stored with the UUID if not given.
     """
-    return processor.send_prompt(prompt, uuid)
+    tracing.lap("validation")
+    if prompt is None:
+        with tracing.span("store"):
+            prompt = await processor.stored_prompt(uuid)
+    explanation = await processor.send_prompt(prompt, uuid)
+    report_truncation(response)
+    return explanation
 
 
-@app.get("/explain")
-def explain(
+@app.get("/explain", dependencies=[Depends(ready)])
+async def explain(
+    response: Response,
     type: Literal["host", "service"],
     output: str = "n/a",
     name: str = "n/a",
     description: str = "n/a",
+    bypass_rules: bool = False,
 ):
     """
     Get an explanation for the output.
 
-    This is a combination of the get and send endpoints.
+    This is a combination of the get and send endpoints, explanations are cached.
+    Outputs matching a rule of the rule pack are explained by it, unless
+    `bypass_rules` is set to ask the LLM. If the answer of the LLM is truncated,
+    the `X-Truncated` header gives by what (max_tokens) and the `X-Saved-Tokens`
+    header the tokens of the budget left, as the `done` event of the stream.
+    """
+    tracing.lap("validation")
+    explanation = await processor.explain(type, name, output, description, bypass_rules)
+    report_truncation(response)
+    return explanation
+
+
+def report_truncation(response: Response) -> None:
+    """
+    Give the truncation of the answer to the request, if any, by its headers.
+    """
+    attributes = tracing.attributes()
+    if "truncated" in attributes:
+        response.headers["X-Truncated"] = attributes["truncated"]
+        response.headers["X-Saved-Tokens"] = attributes["saved_tokens"]
+
+
+@app.get("/explain/stream", dependencies=[Depends(ready)])
+async def explain_stream(
+    type: Literal["host", "service"],
+    output: str = "n/a",
+    name: str = "n/a",
+    description: str = "n/a",
+    bypass_rules: bool = False,
+):
+    """
+    Get an explanation for the output, streamed token by token.
+
+    Tokens are sent as Server-Sent Events with a `token` field. A final `done` event
+    gives the `usage` of the LLM and the timings in seconds (`ttft` the time to the
+    first token and `duration`), or an `error` event if the completion failed. An
+    explanation given by a rule is sent at once, its `rule` given by the `done`
+    event, unless `bypass_rules` is set.
+    """
+    tracing.lap("validation")
+    events = processor.stream(type, name, output, description, bypass_rules)
+
+    async def messages():
+        async for event in events:
+            if "error" in event:
+                yield f"event: error\ndata: {json.dumps(event)}\n\n"
+            elif "token" in event:
+                yield f"data: {json.dumps(event)}\n\n"
+            else:
+                yield f"event: done\ndata: {json.dumps(event)}\n\n"
+
+    # Ask proxies not to buffer the events.
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(
+        messages(), media_type="text/event-stream", headers=headers
+    )
+
+
+@app.post("/explain/batch", dependencies=[Depends(ready)])
+async def explain_batch(
+    outputs: list[Output], stream: bool = False, bypass_rules: bool = False
+):
+    """
+    Get explanations for many outputs.
+
+    Results are given in the order of the outputs, each one either with an
+    `explanation` or an `error`. If `stream` is set, results are streamed as
+    newline delimited JSON as soon as they are ready, with their `index`. The
+    rules are skipped if `bypass_rules` is set. Batches of more than `batch_size`
+    outputs are rejected with a 413 status.
+    """
+    tracing.lap("validation")
+    if len(outputs) > processor.settings.batch_size:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batches are limited to {processor.settings.batch_size} outputs.",
+        )
+    requests = [
+        (output.type, output.name, output.output, output.description)
+        for output in outputs
+    ]
+    results = processor.explain_many(requests, bypass_rules)
+
+    if stream:
+
+        async def lines():
+            async for index, explanation, error in results:
+                result = {"index": index, "explanation": explanation, "error": error}
+                yield json.dumps(result) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    explanations = [None] * len(requests)
+    async for index, explanation, error in results:
+        explanations[index] = {"explanation": explanation, "error": error}
+    return explanations
+
+
+@app.post("/jobs", status_code=status.HTTP_202_ACCEPTED, dependencies=[Depends(ready)])
+async def submit_job(output: Output, response: Response, bypass_rules: bool = False):
+    """
+    Queue the explanation of an output, answered at once with the `id` of the job,
+    the UUID of its prompt.
+
+    The job is explained in the background, its result given by `/jobs/{id}` and
+    sent to the `job_webhook` if set. The rules are skipped if `bypass_rules` is
+    set.
+    """
+    tracing.lap("validation")
+    uuid = await processor.submit(
+        output.type, output.name, output.output, output.description, bypass_rules
+    )
+    response.headers["Location"] = f"/jobs/{uuid}"
+    return {"id": str(uuid), "status": "queued"}
+
+
+@app.get("/jobs/{uuid}", dependencies=[Depends(ready)])
+async def get_job(uuid: UUID, wait: float = Query(default=0, ge=0, le=60)):
+    """
+    Get the `status` of a job (queued, running, done or failed) and once finished
+    its `explanation` or its `error`.
+
+    If `wait` is given, the answer waits up to `wait` seconds for the job to
+    finish.
+    """
+    job = await processor.job(uuid, wait)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {uuid} unknown or expired.",
+        )
+    return job
+
+
+@app.get("/stats", include_in_schema=False, dependencies=[Depends(ready)])
+async def stats():
+    """
+    Get the counters of the processor.
+    """
+    return {
+        "cache": processor.cache.stats(),
+        "coalesced": processor.flights.coalesced,
+        "scheduler": {
+            provider.value: scheduler.stats()
+            for provider, scheduler in processor.schedulers.items()
+        },
+        "breakers": {
+            provider.value: breaker.stats()
+            for provider, breaker in processor.breakers.items()
+        },
+        "jobs": await asyncio.to_thread(processor.jobs.stats),
+        "backends": PROVIDERS[Provider.OLLAMA].pool.stats(),
+        "limiters": {
+            name.value: provider.limiter.stats()
+            for name, provider in PROVIDERS.items()
+            if provider.limiter is not None
+        },
+    }
+
+
+@app.get("/cache", include_in_schema=False, dependencies=[Depends(ready)])
+async def cache_stats():
+    """
+    Get the hits, misses and evictions counters of the explanation cache.
+    """
+    return processor.cache.stats()
+
+
+@app.delete("/cache", include_in_schema=False, dependencies=[Depends(ready)])
+async def purge_cache():
+    """
+    Purge the explanation cache, e.g. after changing the role or the model.
+    """
+    await asyncio.to_thread(processor.cache.clear)
+
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    """
+    Get the progress of the startup, always answered even while starting.
+    """
+    return {
+        "ready": processor.settings is not None,
+        "status": processor.status,
+        "providers": {
+            name.value: provider.status for name, provider in PROVIDERS.items()
+        },
+    }
+
+
+@app.post("/reload", include_in_schema=False, dependencies=[Depends(ready)])
+async def reload():
+    """
+    Load the configuration file again and use it without restarting.
+
+    With several workers, only the worker answering reloads, the others reload
+    when they see the file changed.
+    """
+    try:
+        changed = await processor.reload()
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"changed": changed}
+
+
+@app.get("/live", include_in_schema=False)
+async def live():
+    """
+    Liveness probe, the API answers requests.
+    """
+    return {"status": "alive"}
+
+
+@app.get("/ready", include_in_schema=False)
+async def readiness():
+    """
+    Readiness probe, the API can explain outputs.
+    """
+    content = await health()
+    code = (
+        status.HTTP_200_OK if content["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE
+    )
+    return JSONResponse(content, status_code=code)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus():
+    """
+    Get the metrics in the Prometheus text format.
     """
-    prompt, uuid = processor.get_prompt(type, name, output, description)
-    return processor.send_prompt(prompt, uuid)
+    directory = os.environ.get("POP_METRICS_DIR")
+    content = await asyncio.to_thread(metrics.render, directory)
+    return PlainTextResponse(content, media_type="text/plain; version=0.0.4")
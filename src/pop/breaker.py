@@ -0,0 +1,134 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    """
+    Stop sending requests to a failing or slow provider for a while.
+
+    The breaker opens when the error rate or the 95th percentile of the latency
+    of the last requests exceeds its threshold. Once the cooldown is over, a
+    single trial request is allowed: its success closes the breaker, its failure
+    opens it again.
+    """
+
+    def __init__(
+        self,
+        window: int = 20,
+        errors: float = 0.5,
+        latency: float | None = None,
+        cooldown: float = 30,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        window : int, optional
+            The number of last requests considered, by default 20.
+        errors : float, optional
+            The error rate opening the breaker, by default 0.5.
+        latency : float, optional
+            The 95th percentile of the latency in seconds opening the breaker,
+            by default None to ignore the latency.
+        cooldown : float, optional
+            The time in seconds the breaker stays open, by default 30.
+        """
+        self.window = window
+        self.errors = errors
+        self.latency = latency
+        self.cooldown = cooldown
+        self.results: deque[tuple[bool, float]] = deque(maxlen=window)
+        self.opened: float | None = None  # When the breaker opened
+        self.trial = False  # Whether the trial request is pending
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        """
+        Return the state of the breaker: closed, open or half-open.
+        """
+        if self.opened is None:
+            return "closed"
+        if time.monotonic() - self.opened < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        """
+        Return True if a request can be sent, taking the trial one if half-open.
+        """
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def release(self) -> None:
+        """
+        Give back the trial request without a result, e.g. when it was rejected
+        before being sent or cancelled, so another request can take it.
+        """
+        self.trial = False
+
+    def record(self, success: bool, latency: float) -> None:
+        """
+        Record the result of a request and open or close the breaker.
+        """
+        if self.opened is not None:
+            if not self.trial:
+                return  # Late result of a request sent before the breaker opened
+            self.trial = False
+            if success:
+                self.opened = None
+                self.results.clear()
+            else:
+                self.opened = time.monotonic()
+            return
+
+        self.results.append((success, latency))
+        if len(self.results) < self.window // 2:
+            return
+        rate = sum(1 for success, _ in self.results if not success) / len(self.results)
+        slow = self.latency is not None and self.p95() > self.latency
+        if rate >= self.errors or slow:
+            self.opened = time.monotonic()
+            self.trips += 1
+
+    def p95(self) -> float | None:
+        """
+        Return the 95th percentile of the latency of the successful requests.
+        """
+        latencies = sorted(latency for success, latency in self.results if success)
+        if not latencies:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def stats(self) -> dict:
+        """
+        Return the state of the breaker and the statistics of the last requests.
+        """
+        failures = sum(1 for success, _ in self.results if not success)
+        return {
+            "state": self.state,
+            "trips": self.trips,
+            "requests": len(self.results),
+            "errors": failures,
+            "p95": self.p95(),
+        }
@@ -0,0 +1,205 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from pop.logger import logger
+
+# Minimum time between two purges of the expired entries of the disk tier, in
+# seconds. Expired entries are ignored when read, so they can stay a while.
+SWEEP_INTERVAL = 60
+
+
+class ExplanationCache:
+    """
+    Two tiers cache of explanations.
+
+    The first tier is a bounded in-memory LRU, the second one is a SQLite database
+    surviving restarts. Both tiers expire entries after the same TTL.
+
+    The disk tier is accessed from a thread, so a slow disk or a database locked
+    by another worker doesn't block the event loop.
+    """
+
+    def __init__(self, size: int, ttl: float, path: str | None = None) -> None:
+        """
+        Parameters
+        ----------
+        size : int
+            The maximum number of entries kept in memory, 0 disables the memory tier.
+        ttl : float
+            The time to live of an entry in seconds.
+        path : str, optional
+            The path of the SQLite database, by default None disables the disk tier.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.db = None
+        self.lock = threading.Lock()  # The connection is shared by threads
+        self.swept = 0.0  # When the expired entries were last purged
+        if path is not None:
+            self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            # Durable at checkpoints only, losing the last explanations on a power
+            # failure is fine and saves a fsync on every write.
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS explanations"
+                " (key TEXT PRIMARY KEY, created REAL, explanation TEXT)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS explanations_created"
+                " ON explanations (created)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata"
+                " (name TEXT PRIMARY KEY, value TEXT)"
+            )
+            self.db.commit()
+
+    @staticmethod
+    def key(**fields) -> str:
+        """
+        Build a cache key from all the fields affecting an explanation.
+        """
+        payload = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        """
+        Return the cached explanation or None if missing or expired.
+        """
+        now = time.time()
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            created, explanation = entry
+            if now - created < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return explanation
+            del self.entries[key]
+            self.evictions += 1
+
+        if self.db is not None:
+            row = await asyncio.to_thread(self._select, key)
+            if row is not None and now - row[0] < self.ttl:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                return row[1]
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, explanation: str) -> None:
+        """
+        Store an explanation in both tiers.
+        """
+        created = time.time()
+        self._remember(key, created, explanation)
+        if self.db is not None:
+            await asyncio.to_thread(self._insert, key, created, explanation)
+
+    def _select(self, key: str) -> tuple[float, str] | None:
+        """
+        Return the creation time and the explanation of the disk tier.
+        """
+        with self.lock:
+            return self.db.execute(
+                "SELECT created, explanation FROM explanations WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _insert(self, key: str, created: float, explanation: str) -> None:
+        """
+        Store an explanation in the disk tier, purging the expired ones from time
+        to time.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO explanations VALUES (?, ?, ?)",
+                (key, created, explanation),
+            )
+            if created - self.swept >= SWEEP_INTERVAL:
+                self.swept = created
+                self.db.execute(
+                    "DELETE FROM explanations WHERE created < ?",
+                    (created - self.ttl,),
+                )
+
+    def _remember(self, key: str, created: float, explanation: str) -> None:
+        """
+        Store an entry in the memory tier, evicting the least recently used ones.
+        """
+        if self.size <= 0:
+            return
+        self.entries[key] = (created, explanation)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Purge both tiers.
+        """
+        self.entries.clear()
+        if self.db is not None:
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM explanations")
+        logger.info("Explanation cache purged.")
+
+    def scope(self, fingerprint: str) -> None:
+        """
+        Purge the cache if it was filled with a different fingerprint.
+
+        The fingerprint identifies the settings whose change invalidates every
+        explanation, like the role or the model.
+        """
+        if self.db is None:
+            return
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM metadata WHERE name = 'fingerprint'"
+            ).fetchone()
+        if row is not None and row[0] != fingerprint:
+            self.clear()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('fingerprint', ?)",
+                (fingerprint,),
+            )
+
+    def stats(self) -> dict:
+        """
+        Return the cache counters.
+        """
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
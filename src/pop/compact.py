@@ -0,0 +1,264 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compaction of the plugin outputs before crafting a prompt.
+
+A plugin output is a status line, an optional long output on the next lines and
+performance data after a `|`, on the status line or on a later line:
+
+    CRITICAL: 2 disks full | '/var'=97%;80;90;0;100 '/'=40%;80;90;0;100
+    /var is full
+    /home is full | '/home'=99%;80;90;0;100
+
+The performance data is summarized, keeping the metrics out of their thresholds,
+repeated messages are collapsed, and the result is cut to a budget of tokens.
+"""
+
+import math
+import re
+from typing import NamedTuple
+
+from pop.scheduler import PRIORITIES
+
+# label=value[UoM];warn;crit;min;max, the label is quoted if it has spaces.
+PERFDATA = re.compile(
+    r"(?P<label>'(?:[^']|'')+'|[^\s'=]+)="
+    r"(?P<value>[-+]?(?:\d+(?:[.,]\d+)?|[.,]\d+)(?:[eE][-+]?\d+)?|U)"
+    r"(?P<uom>[a-zA-Z%/]*)"
+    r"(?:;(?P<warn>[^;\s]*))?(?:;(?P<crit>[^;\s]*))?"
+    r"(?:;(?P<min>[^;\s]*))?(?:;(?P<max>[^;\s]*))?"
+)
+
+# Messages are separated by new lines or by " - " in a single line output.
+SEPARATOR = re.compile(r"\n| - ")
+
+# State starting an output, e.g. "CRITICAL: " or "OK - ".
+STATE = re.compile(r"^(?:" + "|".join(PRIORITIES) + r")\s*[:-]\s*")
+
+# Parts of a message which vary between repetitions: quoted names and numbers.
+VARIABLE = re.compile(r"'[^']*'|\"[^\"]*\"|[-+]?\d+(?:[.,]\d+)?")
+
+# Messages repeated at least this number of times are collapsed.
+REPEATED = 3
+
+# Maximum number of repetitions or metrics within thresholds listed.
+LISTED = 10
+
+
+class PerfData(NamedTuple):
+    """
+    A metric of the performance data.
+    """
+
+    label: str
+    value: float | None  # None if unknown ("U")
+    uom: str
+    warn: str
+    crit: str
+
+    @property
+    def state(self) -> str:
+        """
+        Return the state of the metric given its thresholds.
+        """
+        if breached(self.value, self.crit):
+            return "critical"
+        if breached(self.value, self.warn):
+            return "warning"
+        return "ok"
+
+    def __str__(self) -> str:
+        value = "unknown" if self.value is None else f"{self.value:g}{self.uom}"
+        limits = [
+            f"{name} {threshold}"
+            for name, threshold in (("warn", self.warn), ("crit", self.crit))
+            if threshold
+        ]
+        return f"{self.label}={value}" + (f" ({', '.join(limits)})" if limits else "")
+
+
+class Compacted(NamedTuple):
+    """
+    A compacted output and its size in tokens, before and after.
+    """
+
+    output: str
+    before: int
+    after: int
+
+
+def tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a text, about 4 characters per token.
+    """
+    return math.ceil(len(text) / 4)
+
+
+def number(text: str) -> float | None:
+    """
+    Return the number written in a text, None if there is none.
+    """
+    try:
+        return float(text.replace(",", "."))
+    except ValueError:
+        return None
+
+
+def breached(value: float | None, threshold: str) -> bool:
+    """
+    Return True if a value is out of a threshold range.
+
+    Ranges follow the monitoring plugins guidelines: `10` means outside 0 to 10,
+    `10:` below 10, `~:10` above 10, `10:20` outside 10 to 20 and `@10:20` inside.
+    """
+    if value is None or not threshold:
+        return False
+    inside = threshold.startswith("@")
+    threshold = threshold.lstrip("@")
+    low, _, high = threshold.rpartition(":")
+    low = -math.inf if low == "~" else (number(low) if low else 0.0)
+    high = math.inf if high == "" else number(high)
+    if low is None or high is None:
+        return False
+    within = low <= value <= high
+    return within if inside else not within
+
+
+def split(output: str) -> tuple[str, list[PerfData]]:
+    """
+    Split an output into its text and its performance data.
+    """
+    lines = output.strip().split("\n")
+    texts, perfdata = [], ""
+    in_perfdata = False
+    for line in lines:
+        if in_perfdata:
+            perfdata += " " + line
+            continue
+        text, bar, data = line.partition("|")
+        texts.append(text.rstrip())
+        if bar:
+            perfdata += " " + data
+            # After the first line, the performance data goes on to the end.
+            in_perfdata = len(texts) > 1
+
+    metrics = [
+        PerfData(
+            label=match["label"].strip("'").replace("''", "'"),
+            value=None if match["value"] == "U" else number(match["value"]),
+            uom=match["uom"],
+            warn=match["warn"] or "",
+            crit=match["crit"] or "",
+        )
+        for match in PERFDATA.finditer(perfdata)
+    ]
+    return "\n".join(text for text in texts if text), metrics
+
+
+def collapse(text: str) -> str:
+    """
+    Collapse the messages repeated with different names or numbers into the first
+    one followed by the names or numbers of the others.
+    """
+    messages = [message.strip() for message in SEPARATOR.split(text)]
+    messages = [message for message in messages if message]
+
+    # Group the messages by template, ignoring the state of the first one.
+    groups: dict[str, list[str]] = {}
+    for message in messages:
+        template = VARIABLE.sub("#", STATE.sub("", message, count=1))
+        groups.setdefault(template, []).append(message)
+    if all(len(group) < REPEATED for group in groups.values()):
+        return text
+
+    collapsed = []
+    for group in groups.values():
+        if len(group) < REPEATED:
+            collapsed.extend(group)
+            continue
+        first = VARIABLE.findall(STATE.sub("", group[0], count=1))
+        others = []
+        for message in group[1:]:
+            values = [
+                value
+                for value, reference in zip(VARIABLE.findall(message), first)
+                if value != reference
+            ]
+            others.append(" ".join(values) or "same")
+        listed = ", ".join(others[:LISTED]) + (", ..." if len(others) > LISTED else "")
+        collapsed.append(f"{group[0]} (and {len(others)} more: {listed})")
+    return "\n".join(collapsed)
+
+
+def summarize(metrics: list[PerfData]) -> str:
+    """
+    Return the metrics out of their thresholds and the number of the other ones.
+    """
+    if not metrics:
+        return ""
+    alerts = [metric for metric in metrics if metric.state != "ok"]
+    alerts.sort(key=lambda metric: metric.state != "critical")
+    # Without alerts, a few metrics still tell what the plugin measures.
+    shown = alerts or metrics[:LISTED]
+    parts = [str(metric) for metric in shown]
+    if len(metrics) > len(shown):
+        parts.append(f"{len(metrics) - len(shown)} more within thresholds")
+    return "Metrics: " + ", ".join(parts)
+
+
+def fit(text: str, budget: int) -> str:
+    """
+    Cut a text to a budget of tokens, keeping whole lines from the start.
+    """
+    if tokens(text) <= budget:
+        return text
+    kept, used = [], 0
+    lines = text.split("\n")
+    for line in lines:
+        if used + tokens(line) + 1 > budget:
+            break
+        kept.append(line)
+        used += tokens(line) + 1
+    if not kept:
+        # The first line alone is too long, cut it.
+        return lines[0][: max(0, budget * 4 - 3)] + "..."
+    return "\n".join(kept) + f"\n[{len(lines) - len(kept)} more lines omitted]"
+
+
+def compact(output: str, budget: int) -> Compacted:
+    """
+    Compact a plugin output to help the LLM and save prompt tokens.
+
+    Parameters
+    ----------
+    output : str
+        The output of the plugin.
+    budget : int
+        The maximum number of tokens of the compacted output.
+
+    Returns
+    -------
+    compacted : Compacted
+        The compacted output and its size in tokens, before and after.
+    """
+    text, metrics = split(output)
+    lines = [collapse(text), summarize(metrics)]
+    result = fit("\n".join(line for line in lines if line), budget)
+    if tokens(result) >= tokens(output):
+        # Nothing to save, e.g. a short output with its metrics spelled out.
+        result = fit(output, budget)
+    return Compacted(result, tokens(output), tokens(result))
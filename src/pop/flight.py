@@ -0,0 +1,64 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class SingleFlight:
+    """
+    Coalesce identical concurrent calls into a single one.
+
+    The first caller of a key starts the call, the following callers wait for the
+    same result while it is pending. A failure is given to every waiter and is not
+    remembered, the next call of the key starts a new one. A waiter being cancelled
+    (e.g. a client disconnecting) does not cancel the shared call.
+    """
+
+    def __init__(self) -> None:
+        self.calls: dict[str, asyncio.Future] = {}
+        self.coalesced = 0  # Number of callers attached to a pending call
+
+    async def do(self, key: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await the pending call of the key or start a new one.
+
+        Parameters
+        ----------
+        key : str
+            The key identifying identical calls.
+        call : Callable
+            The coroutine function to call if no call is pending.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Future) -> None:
+        """
+        Remove a finished call, so the next one is not coalesced with it.
+        """
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # Retrieve the exception in case every waiter is gone, avoiding asyncio
+        # to log it as never retrieved.
+        if not task.cancelled():
+            task.exception()
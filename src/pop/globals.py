@@ -15,6 +15,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from enum import Enum
+from typing import Literal
+
+from pydantic import BaseModel
 
 
 class Provider(str, Enum):
@@ -36,17 +39,31 @@ class Language(str, Enum):
     ITALIAN = "Italian"
 
 
+class Output(BaseModel):
+    """
+    A plugin output to explain, see the explain endpoint parameters.
+    """
+
+    type: Literal["host", "service"]
+    output: str = "n/a"
+    name: str = "n/a"
+    description: str = "n/a"
+
+
 DEFAULT_ROLE = """
     You are a Centreon professional assistant.
     """
 
+# The instructions only depend on the settings and come before the data of the
+# resource, so prompts share a long prefix which Ollama keeps evaluated in cache.
 TEMPLATE_PROMPT = """
-    Explain the following output coming from a Centreon plugin: {output}. 
+    Explain the output coming from a Centreon plugin given below.
+    Describe mains reasons causing this output and suggest the better way to solve it.
+    Ensure your answer is clear, concise, and actionable.
+    Limit your answer to {length} words and answer in {language}.
+    Output: {output}
     Here are some information about the monitored ressource,
     Type: {type}
     Name: {name}
     Description: {description}
-    Describe mains reasons causing this output and suggest the better way to solve it.
-    Ensure your answer is clear, concise, and actionable.
-    Limit your answer to {length} words and answer in {language}.
     """
@@ -0,0 +1,239 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Explanations requested as jobs, answered at once with the UUID of their prompt and
+explained in the background.
+
+Jobs are kept in the SQLite database of the API, so the queued ones are still run
+after a restart and any worker can run them or give their result. A running job
+is owned by a worker which beats while running it, so the job of a worker which
+stopped beating, e.g. killed, is run again by another one.
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from uuid import UUID
+
+# Delay after which a running job whose worker stopped beating is run again, and
+# a webhook delivery is attempted again, in seconds.
+LEASE = 30
+
+# Minimum time between two purges of the finished jobs, in seconds.
+SWEEP_INTERVAL = 1
+
+# States of a job, the last two once finished.
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class JobQueue:
+    """
+    Bounded queue of the jobs and their results, shared between processes.
+
+    The coroutines access the database from a thread, as `SharedPromptStore`.
+    """
+
+    def __init__(self, path: str, size: int, ttl: float) -> None:
+        """
+        Parameters
+        ----------
+        path : str
+            The path of the SQLite database.
+        size : int
+            The maximum number of jobs queued or running.
+        ttl : float
+            The time to live of a finished job in seconds.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()  # The connection is shared by threads
+        self.swept = 0.0  # When the finished jobs were last purged
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY,"
+            " uuid BLOB UNIQUE, status TEXT, request TEXT, created REAL,"
+            " owner TEXT, beat REAL, finished REAL, explanation TEXT, error TEXT,"
+            " deliver REAL, deliveries INTEGER DEFAULT 0)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_deliver ON jobs (deliver)")
+        self.db.commit()
+
+    def add(self, uuid: UUID, request: dict) -> bool:
+        """
+        Queue a job, return False if the queue is full.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            if now - self.swept >= SWEEP_INTERVAL:
+                self.swept = now
+                self.db.execute(
+                    "DELETE FROM jobs WHERE finished < ?", (now - self.ttl,)
+                )
+            (pending,) = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchone()
+            if pending >= self.size:
+                return False
+            self.db.execute(
+                "INSERT INTO jobs (uuid, status, request, created) VALUES (?, ?, ?, ?)",
+                (uuid.bytes, QUEUED, json.dumps(request), now),
+            )
+        return True
+
+    def claim(self, owner: str) -> tuple[UUID, dict] | None:
+        """
+        Return the oldest job to run, queued or left by a worker which stopped
+        beating, None if there is none.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                "UPDATE jobs SET status = ?, owner = ?, beat = ? WHERE id = ("
+                " SELECT id FROM jobs WHERE status = ?"
+                " OR (status = ? AND beat < ?) ORDER BY id LIMIT 1)"
+                " RETURNING uuid, request",
+                (RUNNING, owner, now, QUEUED, RUNNING, now - LEASE),
+            ).fetchone()
+        if row is None:
+            return None
+        return UUID(bytes=row[0]), json.loads(row[1])
+
+    def beat(self, owner: str) -> None:
+        """
+        Tell the jobs of a worker are still running.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET beat = ? WHERE owner = ? AND status = ?",
+                (time.time(), owner, RUNNING),
+            )
+
+    def release(self, uuid: UUID) -> None:
+        """
+        Queue a running job again, e.g. rejected by an overloaded provider.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, owner = NULL WHERE uuid = ?",
+                (QUEUED, uuid.bytes),
+            )
+
+    def finish(
+        self, uuid: UUID, explanation: str | None, error: str | None, deliver: bool
+    ) -> None:
+        """
+        Store the result of a job, to be delivered at once if `deliver` is set.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET status = ?, finished = ?, explanation = ?,"
+                " error = ?, deliver = ? WHERE uuid = ?",
+                (
+                    FAILED if error is not None else DONE,
+                    now,
+                    explanation,
+                    error,
+                    now if deliver else None,
+                    uuid.bytes,
+                ),
+            )
+
+    def get(self, uuid: UUID) -> dict | None:
+        """
+        Return the state of a job, None if it is unknown or expired.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT uuid, status, created, finished, explanation, error"
+                " FROM jobs WHERE uuid = ?",
+                (uuid.bytes,),
+            ).fetchone()
+        if row is None or (row[3] is not None and time.time() - row[3] >= self.ttl):
+            return None
+        return result(row)
+
+    def due(self) -> tuple[dict, int] | None:
+        """
+        Return the result of a finished job to deliver and the number of previous
+        deliveries, None if there is none. The next delivery is postponed by
+        `LEASE` seconds meanwhile, so no other worker delivers it.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                "UPDATE jobs SET deliver = ? WHERE id = ("
+                " SELECT id FROM jobs WHERE deliver <= ? ORDER BY deliver LIMIT 1)"
+                " RETURNING uuid, status, created, finished, explanation, error,"
+                " deliveries",
+                (now + LEASE, now),
+            ).fetchone()
+        if row is None:
+            return None
+        return result(row[:6]), row[6]
+
+    def delivered(self, uuid: UUID, retry: float | None) -> None:
+        """
+        Record a delivery attempt, to be retried at the given time if any.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET deliver = ?, deliveries = deliveries + 1"
+                " WHERE uuid = ?",
+                (retry, uuid.bytes),
+            )
+
+    def stats(self) -> dict:
+        """
+        Return the number of jobs by status.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall()
+        return {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)} | dict(rows)
+
+    async def put(self, uuid: UUID, request: dict) -> bool:
+        """
+        Queue a job without blocking the event loop, see `add`.
+        """
+        return await asyncio.to_thread(self.add, uuid, request)
+
+    async def fetch(self, uuid: UUID) -> dict | None:
+        """
+        Return the state of a job without blocking the event loop, see `get`.
+        """
+        return await asyncio.to_thread(self.get, uuid)
+
+
+def result(row: tuple) -> dict:
+    """
+    Return the state of a job given to the clients from its row.
+    """
+    uuid, status, created, finished, explanation, error = row
+    return {
+        "id": str(UUID(bytes=uuid)),
+        "status": status,
+        "created": created,
+        "finished": finished,
+        "explanation": explanation,
+        "error": error,
+    }
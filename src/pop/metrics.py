@@ -0,0 +1,354 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Metrics in the Prometheus text format.
+
+Metrics are kept in plain dictionaries keyed by their labels values, updating
+one is a dictionary lookup and an addition so they can stay on at full load.
+
+When served by several workers, each one saves its metrics to a directory shared
+with the others every second and on scrape, and the worker answering a scrape
+adds them all up.
+"""
+
+import json
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+# Endpoint of the request being handled, to label the metrics of deeper layers.
+endpoint: ContextVar[str] = ContextVar("endpoint", default="none")
+
+LABELS = ("endpoint", "provider", "model")
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIMILARITY_BUCKETS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 0.99, 1)
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01)
+
+
+class Metric:
+    """
+    Base class of the metrics, labelled by the endpoint, the provider and the
+    model plus optional extra labels.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, extra: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = LABELS + extra
+        self.values: dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def key(self, provider, model, *extra) -> tuple:
+        """
+        Return the labels values of the current endpoint.
+        """
+        return (endpoint.get(), getattr(provider, "value", provider), model) + extra
+
+    def format(self, key: tuple, suffix: str = "", extra: str = "") -> str:
+        """
+        Format the labels of a sample.
+        """
+        labels = ",".join(
+            f'{name}="{escape(value)}"' for name, value in zip(self.labels, key)
+        )
+        labels = f"{labels},{extra}" if extra else labels
+        return f"{self.name}{suffix}{{{labels}}}"
+
+    @staticmethod
+    def merge(value, other):
+        """
+        Return the sum of the values of two processes, the first one may be None.
+        """
+        return other if value is None else value + other
+
+    def render(self, values: dict | None = None) -> list[str]:
+        """
+        Render the values of the metric, by default those of this process.
+        """
+        values = self.values if values is None else values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in values.items():
+            lines.append(f"{self.format(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, provider, model, *extra, value: float = 1) -> None:
+        key = self.key(provider, model, *extra)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def add(self, provider, model, *extra, value: float = 1) -> None:
+        key = self.key(provider, model, *extra)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        extra: tuple[str, ...] = (),
+    ) -> None:
+        super().__init__(name, help, extra)
+        self.buckets = buckets
+        # Per labels: the count of each bucket (not cumulative), the sum and count.
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, provider, model, value: float, *extra) -> None:
+        key = self.key(provider, model, *extra)
+        sample = self.values.get(key)
+        if sample is None:
+            sample = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        sample[0][bisect_left(self.buckets, value)] += 1
+        sample[1] += value
+        sample[2] += 1
+
+    @staticmethod
+    def merge(value, other):
+        if value is None:
+            return other
+        counts = [a + b for a, b in zip(value[0], other[0])]
+        return [counts, value[1] + other[1], value[2] + other[2]]
+
+    def render(self, values: dict | None = None) -> list[str]:
+        values = self.values if values is None else values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket
+                bucket_key = self.format(key, "_bucket", f'le="{bound}"')
+                lines.append(f"{bucket_key} {cumulative}")
+            lines.append(f"{self.format(key, '_sum')} {total}")
+            lines.append(f"{self.format(key, '_count')} {count}")
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+requests = Counter("pop_requests_total", "HTTP requests.", ("status",))
+errors = Counter("pop_errors_total", "HTTP requests answered with an error.")
+inflight = Gauge("pop_requests_inflight", "HTTP requests being handled.")
+duration = Histogram("pop_request_seconds", "End to end duration of HTTP requests.")
+prompt_build = Histogram(
+    "pop_prompt_build_seconds", "Duration of the prompt crafting.", FAST_BUCKETS
+)
+queue_wait = Histogram("pop_queue_wait_seconds", "Waiting time for a provider slot.")
+provider_latency = Histogram(
+    "pop_provider_seconds", "Duration of the completion requests to providers."
+)
+provider_inflight = Gauge(
+    "pop_provider_inflight", "Completion requests being sent to providers."
+)
+selections = Counter(
+    "pop_provider_selections_total", "Completion requests sent to each provider."
+)
+tokens = Counter("pop_tokens_total", "Tokens used by the completions.", ("kind",))
+output_tokens = Counter(
+    "pop_output_tokens_total",
+    "Estimated tokens of the plugin outputs, before and after compaction.",
+    ("stage",),
+)
+semantic_lookups = Counter(
+    "pop_semantic_lookups_total",
+    "Lookups of the semantic cache, by result (hit, miss, error).",
+    ("result",),
+)
+semantic_similarity = Histogram(
+    "pop_semantic_similarity",
+    "Similarity of the closest output found in the semantic cache.",
+    SIMILARITY_BUCKETS,
+)
+semantic_audits = Counter(
+    "pop_semantic_audits_total",
+    "Semantic cache hits compared to the LLM, by result (agree, disagree).",
+    ("result",),
+)
+routes = Counter(
+    "pop_route_requests_total",
+    "Explanations requested to the LLM by route, labelled by the model answering.",
+    ("route",),
+)
+route_latency = Histogram(
+    "pop_route_seconds",
+    "Duration of the explanations requested to the LLM by route.",
+    extra=("route",),
+)
+rule_hits = Counter(
+    "pop_rule_hits_total", "Explanations served by a rule, by rule.", ("rule",)
+)
+jobs = Counter(
+    "pop_jobs_total",
+    "Jobs by status (queued, rejected, done, failed).",
+    ("status",),
+)
+truncations = Counter(
+    "pop_truncations_total",
+    "Answers truncated, by reason (max_tokens, cutoff).",
+    ("reason",),
+)
+saved_tokens = Counter(
+    "pop_saved_tokens_total", "Tokens of the budget left by the answers cut off."
+)
+webhooks = Counter(
+    "pop_webhook_deliveries_total",
+    "Deliveries of the job results, by result (delivered, failed).",
+    ("result",),
+)
+retries = Counter(
+    "pop_retries_total",
+    "Completions retried, by status of the failed attempt (429, 5xx).",
+    ("status",),
+)
+
+
+def escape(value) -> str:
+    """
+    Escape a label value as the Prometheus text format requires, e.g. the name of
+    a route or a rule given by the configuration.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(directory: str | None = None) -> str:
+    """
+    Return every metric in the Prometheus text format.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The directory where the workers save their metrics, by default None to
+        only render those of this process.
+    """
+    if directory is None:
+        lines = [line for metric in REGISTRY for line in metric.render()]
+    else:
+        values = combine(directory)
+        lines = [line for metric in REGISTRY for line in metric.render(values[metric])]
+    return "\n".join(lines) + "\n"
+
+
+def save(directory: str) -> None:
+    """
+    Save the metrics of this process to the directory shared by the workers.
+    """
+    snapshot = {
+        metric.name: [[list(key), value] for key, value in metric.values.items()]
+        for metric in REGISTRY
+    }
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(snapshot, file)
+    os.replace(f"{path}.tmp", path)
+
+
+def combine(directory: str) -> dict[Metric, dict[tuple, object]]:
+    """
+    Return the values of every metric added up over the workers.
+
+    Counters and histograms of a stopped worker are kept so they never go back,
+    its gauges are dropped as it no longer handles anything.
+    """
+    save(directory)
+    metrics = {metric.name: metric for metric in REGISTRY}
+    values = {metric: {} for metric in REGISTRY}
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            continue
+        alive = running(int(name.removesuffix(".json")))
+        for metric_name, samples in snapshot.items():
+            metric = metrics.get(metric_name)
+            if metric is None or (metric.kind == "gauge" and not alive):
+                continue
+            for key, value in samples:
+                key = tuple(key)
+                values[metric][key] = metric.merge(values[metric].get(key), value)
+    return values
+
+
+def running(pid: int) -> bool:
+    """
+    Return True if a process is running.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware measuring the HTTP requests.
+
+    The provider and the model in use are given by a callable, as they may change
+    while serving.
+    """
+
+    def __init__(self, app, current) -> None:
+        self.app = app
+        self.current = current  # Return the provider and the model in use
+        self.paths: set[str] | None = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Only label known endpoints, so unknown paths can't add labels.
+        if self.paths is None:
+            self.paths = {route.path for route in scope["app"].routes}
+        path = scope["path"] if scope["path"] in self.paths else "other"
+        token = endpoint.set(path)
+        code = 500
+
+        async def send_status(message):
+            nonlocal code
+            if message["type"] == "http.response.start":
+                code = message["status"]
+            await send(message)
+
+        provider, model = self.current()
+        inflight.add(provider, model)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            inflight.add(provider, model, value=-1)
+            duration.observe(provider, model, time.perf_counter() - start)
+            requests.inc(provider, model, str(code))
+            if code >= 400:
+                errors.inc(provider, model)
+            endpoint.reset(token)
@@ -0,0 +1,214 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Explanations computed ahead of the requests, e.g. during off-hours for the outputs
+of past non-OK states.
+
+The explanations are written to the cache database of the API, which serves them
+as if it had requested them. The keys of the explained outputs are appended to a
+checkpoint file, so an interrupted run resumes where it stopped.
+"""
+
+import asyncio
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+from collections import deque
+from typing import Iterator
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from pop.globals import Output
+from pop.logger import logger
+
+
+def read(path: str, format: str | None = None) -> Iterator[Output]:
+    """
+    Read the outputs of a CSV file with a header or of a newline delimited JSON
+    file, with the fields of the explain endpoint. Invalid records are skipped.
+
+    Parameters
+    ----------
+    path : str
+        The path of the file.
+    format : str, optional
+        Either "csv" or "ndjson", by default guessed from the file extension.
+    """
+    format = format or ("csv" if path.lower().endswith(".csv") else "ndjson")
+    with open(path, newline="") as file:
+        if format == "csv":
+            records = csv.DictReader(file)
+        else:
+            records = (line for line in file if line.strip())
+        for number, record in enumerate(records, 1):
+            try:
+                if format == "ndjson":
+                    record = json.loads(record)
+                # Empty fields take their default value, as missing parameters.
+                fields = {key: value for key, value in record.items() if value}
+                yield Output.model_validate(fields)
+            except ValidationError as e:
+                logger.warning(f"Record {number} skipped: {e.errors()[0]['msg']}")
+            except (ValueError, AttributeError) as e:
+                logger.warning(f"Record {number} skipped: {e}")
+
+
+def checkpointed(path: str) -> set[str]:
+    """
+    Return the keys of the outputs explained by previous runs.
+    """
+    try:
+        with open(path) as file:
+            return {line.strip() for line in file if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+async def precompute(
+    path: str,
+    format: str | None = None,
+    concurrency: int | None = None,
+    checkpoint: str | None = None,
+    interval: float = 10,
+) -> int:
+    """
+    Explain the outputs of a file and cache the explanations.
+
+    Parameters
+    ----------
+    path : str
+        The path of the CSV or NDJSON file of the outputs.
+    format : str, optional
+        Either "csv" or "ndjson", by default guessed from the file extension.
+    concurrency : int, optional
+        The number of explanations requested at the same time, by default
+        `batch_concurrency`.
+    checkpoint : str, optional
+        The path of the checkpoint file, by default the one of the outputs
+        followed by `.checkpoint`.
+    interval : float, optional
+        The delay in seconds between two reports of the progress, by default 10.
+
+    Returns
+    -------
+    failed : int
+        The number of outputs which could not be explained.
+    """
+
+    # The prompts are only needed by this process, whatever the configuration.
+    os.environ["POP_WORKERS"] = "1"
+    # Imported here so that the processor is configured after the above.
+    from pop.processor import PluginProcessor
+    from pop.settings import load_settings
+
+    processor = PluginProcessor()
+    try:
+        settings = await asyncio.to_thread(load_settings, processor.path)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+    if not settings.cache_persist:
+        logger.error("cache_persist is disabled, the API couldn't serve the results.")
+        sys.exit(1)
+    # Answers of a fallback provider are not cached, better retry on next run.
+    processor.apply(settings.model_copy(update={"failover": False, "hedge": False}))
+    await processor.warm_up()
+
+    checkpoint = checkpoint or f"{path}.checkpoint"
+    done = checkpointed(checkpoint)
+    todo: deque[tuple[str, Output]] = deque()
+    keys, duplicates, skipped = set(), 0, 0
+    for output in read(path, format):
+        key = processor.explanation_key(
+            output.type, output.name, output.output, output.description
+        )
+        if key in keys:
+            duplicates += 1
+        elif key in done:
+            skipped += 1
+        else:
+            todo.append((key, output))
+        keys.add(key)
+    total = len(todo)
+    logger.info(
+        f"{total} outputs to explain, {duplicates} duplicates, "
+        f"{skipped} already explained."
+    )
+
+    explained, failed = 0, 0
+    start = time.monotonic()
+
+    def report() -> None:
+        elapsed = time.monotonic() - start
+        rate = (explained + failed) / elapsed if elapsed else 0.0
+        left = total - explained - failed
+        eta = datetime.timedelta(seconds=round(left / rate)) if rate else "unknown"
+        logger.info(
+            f"{explained}/{total} explained, {failed} failed, "
+            f"{rate:.2f} outputs/s, ETA {eta}."
+        )
+
+    async def reporter() -> None:
+        while True:
+            await asyncio.sleep(interval)
+            report()
+
+    async def worker(file) -> None:
+        nonlocal explained, failed
+        while todo:
+            key, output = todo.popleft()
+            try:
+                await processor.explain(
+                    output.type, output.name, output.output, output.description
+                )
+            except HTTPException as e:
+                failed += 1
+                reason = str(e.detail).splitlines()[0]
+                logger.warning(f"Failed to explain {output.output!r}: {reason}")
+                continue
+            explained += 1
+            file.write(key + "\n")
+            file.flush()
+
+    reporting = asyncio.create_task(reporter())
+    try:
+        with open(checkpoint, "a") as file:
+            workers = concurrency or settings.batch_concurrency
+            await asyncio.gather(*(worker(file) for _ in range(workers)))
+    finally:
+        reporting.cancel()
+        report()
+    return failed
+
+
+def run(
+    path: str,
+    format: str | None = None,
+    concurrency: int | None = None,
+    checkpoint: str | None = None,
+    interval: float = 10,
+) -> None:
+    """
+    Run `precompute`, exiting with an error if some outputs failed.
+    """
+    failed = asyncio.run(precompute(path, format, concurrency, checkpoint, interval))
+    if failed:
+        sys.exit(1)
@@ -14,29 +14,808 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import itertools
+import json
+import math
 import os
+import random
+import re
 import sys
+import time
+from asyncio import FIRST_COMPLETED
+from typing import AsyncIterator
 from uuid import UUID, uuid4
-from pathlib import Path
 
-import yaml
+import httpx
 from fastapi import HTTPException, status
-from litellm import completion
-from pydantic import ValidationError
 
-from pop.globals import TEMPLATE_PROMPT
+from pop import metrics, rules, tracing
+from pop.breaker import CircuitBreaker
+from pop.cache import ExplanationCache
+from pop.compact import Compacted, compact, tokens
+from pop.flight import SingleFlight
+from pop.globals import TEMPLATE_PROMPT, Provider
+from pop.jobs import DONE, FAILED, LEASE, JobQueue
 from pop.logger import logger
-from pop.settings import Settings
+from pop.providers import PROVIDERS, fallback
+from pop.providers.base import CLIENTS, BaseProvider, Completion
+from pop.ratelimit import retry_after
+from pop.routing import Route
+from pop.scheduler import Scheduler, priority
+from pop.settings import (
+    Settings,
+    config_path,
+    discover_fallbacks,
+    load_settings,
+    models_path,
+    reload_settings,
+)
+from pop.store import PromptStore, SharedPromptStore
+
+# Settings used once at startup, whose change needs a restart.
+RESTART = ("workers", "cache_persist")
+
+# Rejections of a job by an overloaded provider, the job being queued again.
+POSTPONED = (status.HTTP_429_TOO_MANY_REQUESTS, status.HTTP_503_SERVICE_UNAVAILABLE)
+
+# Timeout of a webhook delivery in seconds.
+WEBHOOK_TIMEOUT = 10
+
+# A word of an answer, to stop streaming it once long enough.
+WORD = re.compile(r"\S+")
 
 
 class PluginProcessor:
 
     def __init__(self) -> None:
 
+        self.settings = None  # Set once the configuration is complete
+        self.status = "starting"  # Progress of the providers discovery
+        self.reloading = asyncio.Lock()  # One reload of the configuration at once
         self.configure()
-        self.prompts: dict[UUID, str] = {}  # Store generated prompts
 
-    def send_prompt(self, prompt: str, uuid: UUID) -> str:
+    def apply(self, settings: Settings) -> None:
+        """
+        Use the settings, creating the state of the processor on first call and
+        updating it in place on the next ones.
+        """
+        first = self.settings is None
+        previous, self.settings = self.settings, settings
+
+        if first:
+            # Store generated prompts, shared with the other workers if any.
+            workers = int(os.environ.get("POP_WORKERS", self.settings.workers))
+            if workers > 1:
+                self.prompts = SharedPromptStore(
+                    self.database,
+                    size=self.settings.prompt_store_size,
+                    ttl=self.settings.prompt_ttl,
+                    compress=self.settings.prompt_compress,
+                )
+            else:
+                self.prompts = PromptStore(
+                    size=self.settings.prompt_store_size,
+                    ttl=self.settings.prompt_ttl,
+                    compress=self.settings.prompt_compress,
+                )
+            # Admission control in front of each provider.
+            self.schedulers: dict[Provider, Scheduler] = {}
+            self.breakers: dict[Provider, CircuitBreaker] = {}
+            self.cache = ExplanationCache(
+                size=self.settings.cache_size,
+                ttl=self.settings.cache_ttl,
+                path=self.database if self.settings.cache_persist else None,
+            )
+            self.flights = SingleFlight()  # Coalesce identical pending completions
+            self.semantic = None  # Created if enabled, see below
+            self.audits: set[asyncio.Task] = set()  # Audits of semantic hits
+            # Jobs shared with the other workers, this one owning those it runs.
+            self.jobs = JobQueue(
+                self.database,
+                size=self.settings.job_queue_size,
+                ttl=self.settings.job_ttl,
+            )
+            self.owner = f"{os.getpid()}-{uuid4().hex[:8]}"
+            self.job_queued = asyncio.Event()  # Wakes up `run_jobs`
+            self.job_done = asyncio.Event()  # Wakes up the waiters of `job`
+        else:
+            self.update(previous)
+        self.rules = rules.load(settings.rules_path) if settings.rules_path else None
+        CLIENTS.configure(
+            settings.connect_timeout,
+            settings.max_connections,
+            settings.max_keepalive,
+            settings.keepalive_expiry,
+        )
+        pool = PROVIDERS[Provider.OLLAMA].pool
+        pool.balance = settings.ollama_balance
+        pool.errors = settings.ollama_eject_errors
+        PROVIDERS[Provider.OPENAI].limiter.configure(
+            settings.openai_rpm, settings.openai_tpm
+        )
+        # Route of the outputs matching none of the configured ones.
+        self.default_route = Route(
+            name="default", provider=self.settings.provider, model=self.settings.model
+        )
+
+        if not self.settings.semantic_cache:
+            self.semantic = None
+        elif self.semantic is not None and self.semantic.size != settings.semantic_size:
+            self.semantic = None  # Created again with the new size
+        if self.settings.semantic_cache and self.semantic is None:
+            # Imported here as NumPy is an optional dependency.
+            from pop.semantic import SemanticCache
+
+            self.semantic = SemanticCache(
+                size=self.settings.semantic_size,
+                ttl=self.settings.cache_ttl,
+                threshold=self.settings.semantic_threshold,
+                path=self.database if self.settings.cache_persist else None,
+            )
+        if self.semantic is not None:
+            self.semantic.threshold = self.settings.semantic_threshold
+
+    def scope(self) -> None:
+        """
+        Purge the caches filled with other settings, blocking on their database
+        and files, so run in a thread while serving.
+        """
+
+        # Explanations are worthless once the role or the model changed.
+        self.cache.scope(
+            ExplanationCache.key(
+                provider=self.settings.provider,
+                model=self.settings.model,
+                role=self.settings.role,
+            )
+        )
+        if self.semantic is not None:
+            # Explanations are worthless once an answer setting changed, and
+            # embeddings once the embedding model or the size of the index did.
+            self.semantic.scope(
+                ExplanationCache.key(
+                    embedding=self.settings.semantic_model,
+                    size=self.settings.semantic_size,
+                    **self.answer_settings(),
+                )
+            )
+
+    def update(self, previous: Settings) -> None:
+        """
+        Update the state of the processor to settings changed while serving.
+        """
+
+        for name in RESTART:
+            if getattr(self.settings, name) != getattr(previous, name):
+                logger.warning(f"{name} changed, restart the API to apply it.")
+
+        self.prompts.size = self.settings.prompt_store_size
+        self.prompts.ttl = self.settings.prompt_ttl
+        self.prompts.compress = self.settings.prompt_compress
+        self.cache.size = self.settings.cache_size
+        self.cache.ttl = self.settings.cache_ttl
+        self.jobs.size = self.settings.job_queue_size
+        self.jobs.ttl = self.settings.job_ttl
+        for scheduler in self.schedulers.values():
+            scheduler.size = self.settings.queue_size
+            scheduler.timeout = self.settings.queue_timeout
+            scheduler.resize(self.settings.concurrency)
+        breaker = ("breaker_window", "breaker_errors", "breaker_latency")
+        if any(getattr(self.settings, n) != getattr(previous, n) for n in breaker):
+            self.breakers.clear()  # Created again with the new settings
+        for breaker in self.breakers.values():
+            breaker.cooldown = self.settings.breaker_cooldown
+
+    async def reload(self) -> list[str]:
+        """
+        Load the configuration file again and use it while serving.
+
+        The settings are validated in a thread and swapped at once, and a new
+        Ollama model is loaded before being used. Explanations of the previous
+        settings are kept, their cache keys differ from those of the new ones.
+
+        Returns:
+        -------
+        changed: list[str]
+            The names of the changed settings.
+
+        Raises:
+        ------
+        ValueError
+            If the configuration is invalid, the settings in use are kept.
+        """
+
+        async with self.reloading:
+            if self.settings is None:
+                raise ValueError("The providers are not discovered yet.")
+            settings = await asyncio.to_thread(
+                reload_settings, self.path, self.settings
+            )
+            changed = [
+                name
+                for name in Settings.model_fields
+                if getattr(settings, name) != getattr(self.settings, name)
+            ]
+            path = settings.rules_path
+            if rules.PACKS.get(path) is not self.rules and "rules_path" not in changed:
+                changed.append("rules_path")  # The file of the rule pack changed
+            if not changed:
+                return changed
+            if {"provider", "model", "ollama_options", "routes"} & set(changed):
+                await self.warm_up(settings)
+            self.apply(settings)
+            await asyncio.to_thread(self.scope)
+            logger.info(f"Configuration reloaded, changed: {', '.join(changed)}.")
+            if {"provider", "routes"} & set(changed):
+                await asyncio.to_thread(discover_fallbacks, self.settings, self.path)
+            return changed
+
+    async def watch(self, check: float = 5) -> None:
+        """
+        Reload the configuration whenever its file or the one of the rule pack
+        changes.
+
+        Parameters:
+        ----------
+        check: float
+            The delay in seconds before checking again when not watching.
+        """
+
+        def modified() -> list[tuple[int, int] | None]:
+            paths = [self.path, self.settings and self.settings.rules_path]
+            stamps = []
+            for path in paths:
+                try:
+                    stat = os.stat(path) if path else None
+                except OSError:
+                    stat = None
+                stamps.append(stat and (stat.st_mtime_ns, stat.st_size))
+            return stamps
+
+        current = modified()
+        while True:
+            interval = self.settings.watch_interval if self.settings else None
+            await asyncio.sleep(interval or check)
+            if interval is None or self.status != "ready":
+                # Written by the discovery, or changes reloaded on demand only.
+                current = modified()
+                continue
+            last, current = current, modified()
+            if current == last:
+                continue
+            try:
+                await self.reload()
+            except ValueError as e:
+                logger.error(f"Configuration not reloaded: {e}")
+
+    async def discover(self, retry: float = 30) -> None:
+        """
+        Discover the providers in the background and use the resulting settings.
+
+        Until then, the settings of the configuration file are used if it is
+        complete. The discovery is retried until a provider is available.
+
+        Parameters:
+        ----------
+        retry: float
+            The delay in seconds before retrying a failed discovery.
+        """
+
+        if "POP_DISCOVERED" in os.environ:
+            # The parent process of the workers already discovered the providers.
+            for provider in PROVIDERS.values():
+                provider.load(models_path(self.path))
+            self.status = "ready"
+            await self.warm_up()
+            return
+
+        while True:
+            self.status = "discovering"
+            try:
+                settings = await asyncio.to_thread(load_settings, self.path)
+            except Exception as e:
+                # E.g. an invalid configuration or a provider failing to answer.
+                logger.error(f"Discovery failed, retrying in {retry}s: {e}")
+                self.status = f"failed: {e}"
+                await asyncio.sleep(retry)
+                continue
+            self.apply(settings)
+            await asyncio.to_thread(self.scope)
+            logger.info("Providers discovered.")
+            break
+        self.status = "ready"
+        await self.warm_up()
+
+        # Fallback providers are only needed once serving.
+        await asyncio.to_thread(discover_fallbacks, self.settings, self.path)
+
+    async def warm_up(self, settings: Settings | None = None) -> None:
+        """
+        Load the Ollama models of the settings, by default those in use, so the
+        first requests don't wait for them.
+        """
+
+        settings = settings or self.settings
+        models = ollama_models(settings)
+        if not settings.warm_up or not models:
+            return
+        provider = PROVIDERS[Provider.OLLAMA]
+        self.status = "warming up"
+        for model in models:
+            await asyncio.to_thread(
+                provider.warm, model, settings.keep_alive, settings.ollama_options
+            )
+        self.status = "ready"
+
+    async def keep_warm(self, check: float = 5) -> None:
+        """
+        Load the Ollama models in use again whenever idle for `keep_warm` seconds,
+        in case Ollama unloaded them meanwhile, e.g. restarted or short of memory.
+
+        Parameters:
+        ----------
+        check: float
+            The delay in seconds before checking again when not keeping warm.
+        """
+
+        while True:
+            settings = self.settings
+            models = ollama_models(settings) if settings else []
+            if self.status != "ready" or settings.keep_warm is None or not models:
+                await asyncio.sleep(check)
+                continue
+            provider = PROVIDERS[Provider.OLLAMA]
+            idle = time.monotonic() - provider.used
+            if idle < settings.keep_warm:
+                await asyncio.sleep(settings.keep_warm - idle)
+                continue
+            logger.info(f"Idle for {idle:.0f}s, keeping {', '.join(models)} warm.")
+            for model in models:
+                await asyncio.to_thread(
+                    provider.warm, model, settings.keep_alive, settings.ollama_options
+                )
+
+    async def check_backends(self, check: float = 5) -> None:
+        """
+        Check the health and the models of the Ollama hosts every
+        `ollama_health_interval` seconds, if there are several of them.
+
+        Parameters:
+        ----------
+        check: float
+            The delay in seconds before checking again when not ready.
+        """
+
+        provider = PROVIDERS[Provider.OLLAMA]
+        while True:
+            if self.status != "ready" or len(provider.pool.backends) < 2:
+                await asyncio.sleep(check)
+                continue
+            await provider.check()
+            await asyncio.sleep(self.settings.ollama_health_interval)
+
+    async def explain(
+        self,
+        type: str,
+        name: str,
+        output: str,
+        description: str,
+        bypass: bool = False,
+        crafted: tuple[str, UUID] | None = None,
+    ) -> str:
+        """
+        Get an explanation from a rule, the cache or the LLM.
+
+        Parameters:
+        ----------
+        type: str
+            The type of the prompt. Either "host" or "service".
+        output: str
+            The output of the plugin.
+        name: str, optional
+            The name of the host or service.
+        description: str, optional
+            The description of the host or service.
+        bypass: bool, optional
+            Whether to skip the rules, by default False.
+        crafted: tuple[str, UUID], optional
+            The prompt and its UUID if already crafted, e.g. for a job.
+
+        Returns:
+        -------
+        explanation: str
+            The explanation of the output.
+        """
+
+        canned = None if bypass else self.canned(type, name, output, description)
+        if canned is not None:
+            return canned[1]
+
+        route = self.route(type, output, description)
+        key = self.explanation_key(type, name, output, description, route)
+        with tracing.span("cache"):
+            explanation = await self.cache.get(key)
+        if explanation is not None:
+            logger.info("Explanation served from cache.")
+            return explanation
+
+        vector, explanation = await self.semantic_get(type, output)
+        if explanation is not None:
+            logger.info("Explanation served from semantic cache.")
+            self.audit(type, name, output, description, explanation)
+            return explanation
+
+        if crafted is None:
+            prompt, uuid, _ = await self.get_prompt(type, name, output, description)
+        else:
+            prompt, uuid = crafted
+        start = time.monotonic()
+        explanation, provider, model = await self.answer(prompt, uuid, route)
+        metrics.routes.inc(provider, model, route.name)
+        metrics.route_latency.observe(
+            provider, model, time.monotonic() - start, route.name
+        )
+        # Answers of a fallback provider are not the ones of the routed model.
+        if (provider, model) == (route.provider, route.model):
+            await self.cache.set(key, explanation)
+            if vector is not None:
+                await self.semantic.set(vector, explanation)
+        return explanation
+
+    def canned(
+        self, type: str, name: str, output: str, description: str
+    ) -> tuple[str, str] | None:
+        """
+        Return the name of the first rule matching an output and its explanation,
+        None if none does or there is no rule pack.
+        """
+
+        if self.rules is None:
+            return None
+        with tracing.span("rules"):
+            matched = self.rules.match(
+                type, name, output, description, self.settings.language
+            )
+        if matched is None:
+            return None
+        rule, _ = matched
+        metrics.rule_hits.inc(self.settings.provider, self.settings.model, rule)
+        logger.info(f"Explanation served by rule {rule}.")
+        return matched
+
+    async def semantic_get(
+        self, type: str, output: str
+    ) -> tuple[list[float] | None, str | None]:
+        """
+        Return the embedding of an output and the explanation of a similar one
+        from the semantic cache, None if disabled, failed or missing.
+        """
+
+        if self.semantic is None:
+            return None, None
+        from pop.semantic import normalize
+
+        provider, model = self.settings.provider, self.settings.model
+        try:
+            with tracing.span("embedding"):
+                (vector,) = await PROVIDERS[Provider.OLLAMA].embed(
+                    self.settings.semantic_model,
+                    [normalize(type, output)],
+                    self.settings.keep_alive,
+                )
+        except Exception as e:
+            logger.warning(f"Failed to embed the output: {e}")
+            metrics.semantic_lookups.inc(provider, model, "error")
+            return None, None
+        with tracing.span("semantic"):
+            similarity, explanation = await self.semantic.get(vector)
+        metrics.semantic_similarity.observe(provider, model, similarity)
+        result = "miss" if explanation is None else "hit"
+        metrics.semantic_lookups.inc(provider, model, result)
+        return vector, explanation
+
+    def audit(
+        self, type: str, name: str, output: str, description: str, cached: str
+    ) -> None:
+        """
+        Compare a sample of the semantic cache hits to the explanation of the LLM
+        in the background, counting the false hits.
+
+        The explanations are compared by the similarity of their embeddings, since
+        two answers to the same prompt are never the same word for word.
+        """
+
+        if random.random() >= self.settings.semantic_audit:
+            return
+        from pop.semantic import AGREEMENT, similarity
+
+        async def compare():
+            try:
+                prompt, uuid, _ = await self.get_prompt(type, name, output, description)
+                route = self.route(type, output, description)
+                explanation, provider, model = await self.answer(prompt, uuid, route)
+                embeddings = await PROVIDERS[Provider.OLLAMA].embed(
+                    self.settings.semantic_model,
+                    [explanation, cached],
+                    self.settings.keep_alive,
+                )
+            except Exception as e:
+                logger.warning(f"Failed to audit a semantic cache hit: {e}")
+                return
+            agree = similarity(*embeddings) >= AGREEMENT
+            result = "agree" if agree else "disagree"
+            metrics.semantic_audits.inc(provider, model, result)
+            if not agree:
+                logger.info(f"Semantic cache hit disagreeing with the LLM: {output}")
+
+        task = asyncio.create_task(compare())
+        self.audits.add(task)
+        task.add_done_callback(self.audits.discard)
+
+    async def explain_many(
+        self, requests: list[tuple[str, str, str, str]], bypass: bool = False
+    ) -> AsyncIterator[tuple[int, str | None, str | None]]:
+        """
+        Get explanations for many outputs, yielded as soon as they are ready.
+
+        Identical requests are explained once and at most `batch_concurrency`
+        explanations are requested at the same time.
+
+        Parameters:
+        ----------
+        requests: list[tuple[str, str, str, str]]
+            The (type, name, output, description) of the outputs to explain.
+        bypass: bool, optional
+            Whether to skip the rules, by default False.
+
+        Yields:
+        -------
+        index: int
+            The index of the request.
+        explanation: str | None
+            The explanation of the output, None if it failed.
+        error: str | None
+            The reason of the failure, None if it succeeded.
+        """
+
+        indexes: dict[tuple[str, str, str, str], list[int]] = {}
+        for index, request in enumerate(requests):
+            indexes.setdefault(request, []).append(index)
+
+        limiter = asyncio.Semaphore(self.settings.batch_concurrency)
+
+        async def explain(request):
+            async with limiter:
+                try:
+                    explanation = await self.explain(*request, bypass=bypass)
+                    return request, explanation, None
+                except HTTPException as e:
+                    return request, None, e.detail
+                except Exception as e:
+                    # A failed output must not abort the others of the batch.
+                    logger.error(f"Could not explain an output of a batch: {e!r}")
+                    return request, None, str(e) or type(e).__name__
+
+        tasks = [asyncio.create_task(explain(request)) for request in indexes]
+        try:
+            for task in asyncio.as_completed(tasks):
+                request, explanation, error = await task
+                for index in indexes[request]:
+                    yield index, explanation, error
+        finally:
+            # The caller may stop early, e.g. a client disconnecting from a stream.
+            for task in tasks:
+                task.cancel()
+
+    async def submit(
+        self, type: str, name: str, output: str, description: str, bypass: bool = False
+    ) -> UUID:
+        """
+        Queue the explanation of an output as a job, run by `run_jobs`.
+
+        Parameters:
+        ----------
+        type: str
+            The type of the prompt. Either "host" or "service".
+        output: str
+            The output of the plugin.
+        name: str, optional
+            The name of the host or service.
+        description: str, optional
+            The description of the host or service.
+        bypass: bool, optional
+            Whether to skip the rules, by default False.
+
+        Returns:
+        -------
+        uuid: UUID
+            The UUID of the prompt of the output, identifying the job.
+
+        Raises:
+        ------
+        HTTPException
+            If `job_queue_size` jobs are already queued or running.
+        """
+
+        prompt, uuid, _ = await self.get_prompt(type, name, output, description)
+        request = {
+            "type": type,
+            "name": name,
+            "output": output,
+            "description": description,
+            "bypass": bypass,
+            "prompt": prompt,
+        }
+        provider, model = self.settings.provider, self.settings.model
+        if not await self.jobs.put(uuid, request):
+            metrics.jobs.inc(provider, model, "rejected")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many jobs queued, retry later.",
+                headers={"Retry-After": "5"},
+            )
+        metrics.jobs.inc(provider, model, "queued")
+        logger.info(f"Job {uuid} queued.")
+        self.job_queued.set()
+        return uuid
+
+    async def job(self, uuid: UUID, wait: float = 0) -> dict | None:
+        """
+        Return the state of a job, waiting up to `wait` seconds for it to finish,
+        None if it is unknown or expired.
+
+        The jobs finished by this worker are given at once, those finished by
+        another one within a second.
+        """
+
+        deadline = time.monotonic() + wait
+        while True:
+            done = self.job_done  # Taken first not to miss a job finishing
+            job = await self.jobs.fetch(uuid)
+            left = deadline - time.monotonic()
+            if job is None or job["status"] in (DONE, FAILED) or left <= 0:
+                return job
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(done.wait(), min(left, 1))
+
+    async def run_jobs(self, check: float = 1) -> None:
+        """
+        Run the queued jobs, at most `job_concurrency` at the same time, and
+        deliver their results to the webhook.
+
+        Parameters:
+        ----------
+        check: float
+            The delay in seconds before looking for jobs queued by another worker.
+        """
+
+        metrics.endpoint.set("/jobs")
+        running: set[asyncio.Task] = set()
+        delivering: set[asyncio.Task] = set()
+        beaten = time.monotonic()
+
+        def start(tasks: set[asyncio.Task], coroutine) -> None:
+            task = asyncio.create_task(coroutine)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: self.job_queued.set())
+
+        async with httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT) as client:
+            try:
+                while True:
+                    self.job_queued.clear()
+                    settings = self.settings
+                    if settings is not None and self.status == "ready":
+                        while len(running) < settings.job_concurrency:
+                            job = await asyncio.to_thread(self.jobs.claim, self.owner)
+                            if job is None:
+                                break
+                            start(running, self.run_job(*job))
+                        while (
+                            settings.job_webhook
+                            and len(delivering) < settings.job_concurrency
+                        ):
+                            due = await asyncio.to_thread(self.jobs.due)
+                            if due is None:
+                                break
+                            start(delivering, self.deliver(client, *due))
+                    if running and time.monotonic() - beaten >= LEASE / 3:
+                        beaten = time.monotonic()
+                        await asyncio.to_thread(self.jobs.beat, self.owner)
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(self.job_queued.wait(), check)
+            finally:
+                # Stopping, the running jobs are queued again.
+                for task in running | delivering:
+                    task.cancel()
+                await asyncio.gather(*running, *delivering, return_exceptions=True)
+
+    async def run_job(self, uuid: UUID, request: dict) -> None:
+        """
+        Explain the output of a job and store the result, the job being queued
+        again if the provider is overloaded or the worker stopping.
+        """
+
+        explanation, error = None, None
+        try:
+            try:
+                explanation = await self.explain(
+                    request["type"],
+                    request["name"],
+                    request["output"],
+                    request["description"],
+                    request["bypass"],
+                    crafted=(request["prompt"], uuid),
+                )
+            except HTTPException as e:
+                if e.status_code not in POSTPONED:
+                    error = str(e.detail)
+                else:
+                    retry = float((e.headers or {}).get("Retry-After", 5))
+                    logger.warning(f"Job {uuid} postponed by {retry}s: {e.detail}")
+                    await asyncio.sleep(retry)
+                    await asyncio.to_thread(self.jobs.release, uuid)
+                    return
+            except Exception as e:
+                # Finished as failed, else it would be claimed again forever.
+                logger.error(f"Job {uuid} failed: {describe(e)}")
+                error = describe(e)
+        except asyncio.CancelledError:
+            # Queued again even if cancelled once more while releasing it.
+            await asyncio.shield(asyncio.to_thread(self.jobs.release, uuid))
+            raise
+
+        deliver = self.settings.job_webhook is not None
+        await asyncio.to_thread(self.jobs.finish, uuid, explanation, error, deliver)
+        result = FAILED if error is not None else DONE
+        metrics.jobs.inc(self.settings.provider, self.settings.model, result)
+        logger.info(f"Job {uuid} {result}.")
+        done, self.job_done = self.job_done, asyncio.Event()
+        done.set()
+
+    async def deliver(self, client: httpx.AsyncClient, job: dict, count: int) -> None:
+        """
+        POST the result of a job to the webhook, retried with an exponential
+        backoff up to `job_webhook_retries` times.
+
+        The body is signed with `job_webhook_secret` if set, by a
+        `X-Pop-Signature` header giving its HMAC-SHA256.
+        """
+
+        settings = self.settings
+        body = json.dumps(job).encode()
+        headers = {"Content-Type": "application/json"}
+        if settings.job_webhook_secret:
+            secret = settings.job_webhook_secret.encode()
+            signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
+            headers["X-Pop-Signature"] = f"sha256={signature}"
+        uuid = UUID(job["id"])
+        try:
+            response = await client.post(
+                settings.job_webhook, content=body, headers=headers
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            retry = None
+            if count < settings.job_webhook_retries:
+                delay = min(2**count, 300) * random.uniform(0.5, 1)
+                retry = time.time() + delay
+                logger.warning(
+                    f"Delivery of job {uuid} failed, retrying in {delay:.0f}s: {e}"
+                )
+            else:
+                logger.error(f"Delivery of job {uuid} failed, giving up: {e}")
+            metrics.webhooks.inc(settings.provider, settings.model, "failed")
+        else:
+            retry = None
+            metrics.webhooks.inc(settings.provider, settings.model, "delivered")
+        await asyncio.to_thread(self.jobs.delivered, uuid, retry)
+
+    async def send_prompt(self, prompt: str, uuid: UUID) -> str:
         """
         Send resquest to the LLM and handle its response.
 
@@ -53,41 +832,720 @@ class PluginProcessor:
             The explanation generated by the LLM.
         """
 
+        explanation, _, _ = await self.answer(prompt, uuid)
+        return explanation
+
+    async def answer(
+        self, prompt: str, uuid: UUID, route: Route | None = None
+    ) -> tuple[str, Provider, str]:
+        """
+        Get the explanation of a prompt along with the provider and the model
+        which gave it, identical pending prompts being sent once.
+
+        The prompt is sent to the provider and the model of the route, by default
+        those in use. The truncation of the answer is given to the trace of each
+        request waiting for it, see `truncation`.
+        """
+
+        route = route or self.default_route
+        key = ExplanationCache.key(prompt=prompt, **self.answer_settings(route))
+        explanation, provider, model, truncated, saved = await self.flights.do(
+            key, lambda: self.complete(prompt, uuid, route)
+        )
+        if truncated is not None:
+            tracing.annotate(truncated=truncated, saved_tokens=saved)
+        return explanation, provider, model
+
+    async def complete(
+        self, prompt: str, uuid: UUID, route: Route
+    ) -> tuple[str, Provider, str, str | None, int]:
+        """
+        Request a completion to the LLM, see `answer`. Return the explanation,
+        the provider, the model, the truncation of the answer and the tokens saved.
+        """
+
         logger.info(f"Sending prompt with UUID: {uuid} ...")
 
+        # Providers to try in order, the routed one first then the fallbacks.
+        targets = iter(self.targets(route))
+        tasks: set[asyncio.Task] = set()
+        sent: dict[asyncio.Task, tuple[BaseProvider, str]] = {}
+        errors: list[tuple[Exception, BaseProvider, str]] = []
+
+        def launch() -> bool:
+            for provider, model in targets:
+                breaker = self.breaker(provider)
+                if breaker.allow():
+                    # Allowed while not closed, the request is the trial one.
+                    trial = breaker.opened is not None
+                    attempt = self.attempt(prompt, provider, model, trial)
+                    task = asyncio.create_task(attempt)
+                    tasks.add(task)
+                    sent[task] = (provider, model)
+                    return True
+            return False
+
+        if not launch():
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="No provider available, retry later.",
+                headers={"Retry-After": str(math.ceil(self.settings.breaker_cooldown))},
+            )
+
+        delay = self.hedge_delay(route)
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=delay, return_when=FIRST_COMPLETED
+                )
+                # Too slow, hedge with the next provider if any.
+                if not done:
+                    if not launch():
+                        delay = None
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append((task.exception(), *sent[task]))
+                # Every pending request failed, fall back to the next provider.
+                if not tasks:
+                    launch()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # Rejections of the schedulers are given as is, other errors as before.
+        failures = [
+            error for error in errors if not isinstance(error[0], HTTPException)
+        ]
+        if failures:
+            raise self.completion_error(*failures[-1])
+        raise errors[0][0]
+
+    async def attempt(
+        self, prompt: str, provider: BaseProvider, model: str, trial: bool = False
+    ) -> tuple[str, Provider, str, str | None, int]:
+        """
+        Request a completion to a provider, recording the result in its breaker.
+        Return the explanation, the provider, the model, the truncation of the
+        answer and the tokens saved.
+
+        If the request is the trial one of its half-open breaker, the trial is
+        given back when no result is recorded, e.g. rejected by the scheduler or
+        cancelled by a faster hedged request, so the provider is tried again.
+        """
+
+        breaker = self.breaker(provider)
+        recorded = False
         try:
-            response = completion(
-                model=f"{self.settings.provider}/{self.settings.model}",
-                base_url=self.settings.url,
-                temperature=self.settings.temperature,
-                messages=[
-                    {"role": "system", "content": self.settings.role},
-                    {"role": "user", "content": prompt},
-                ],
+            # Waiting for a slot may be rejected, which is not a provider failure.
+            queued = time.monotonic()
+            async with self.scheduler(provider.name).slot(priority(prompt)):
+                start = provider.used = time.monotonic()
+                metrics.queue_wait.observe(provider.name, model, start - queued)
+                tracing.record("queue", start - queued)
+                metrics.selections.inc(provider.name, model)
+                metrics.provider_inflight.add(provider.name, model)
+                try:
+                    completion = await asyncio.wait_for(
+                        self.acomplete(
+                            provider, model, prompt, start + self.timeout(provider)
+                        ),
+                        self.timeout(provider),
+                    )
+                except asyncio.CancelledError:
+                    raise  # Cancelled by a faster hedged request, don't count it.
+                except HTTPException:
+                    raise  # Rejected by the quota, not a provider failure.
+                except Exception as e:
+                    breaker.record(False, time.monotonic() - start)
+                    recorded = True
+                    logger.warning(
+                        f"{provider.name.value}/{model} failed: {describe(e)}"
+                    )
+                    raise
+                finally:
+                    metrics.provider_inflight.add(provider.name, model, value=-1)
+                latency = time.monotonic() - start
+                breaker.record(True, latency)
+                recorded = True
+                metrics.provider_latency.observe(provider.name, model, latency)
+                tracing.record("llm", latency)
+                if completion.generation is not None:
+                    # The rest of the completion is spent by the network.
+                    tracing.record("generation", completion.generation)
+                tracing.annotate(provider=provider.name, model=model)
+                self.count_tokens(provider.name, model, completion.usage)
+                reason = completion.finish_reason
+                truncated = "max_tokens" if reason == "length" else None
+                truncated, saved = self.truncation(
+                    provider.name, model, truncated, completion.usage
+                )
+        finally:
+            if trial and not recorded:
+                breaker.release()
+
+        logger.info(f"Received response from model {model}.")
+        return completion.content, provider.name, model, truncated, saved
+
+    async def acomplete(
+        self, provider: BaseProvider, model: str, prompt: str, deadline: float
+    ) -> Completion:
+        """
+        Request a completion of the prompt to a provider, by the engine in use,
+        within its quota and retried until the monotonic deadline, see `retry`.
+        """
+        params = self.completion_params(prompt, provider)
+        for attempt in itertools.count():
+            await self.admit(provider, params, deadline)
+            try:
+                if self.settings.engine == "litellm":
+                    return await fallback.acomplete(provider, model, **params)
+                return await provider.acomplete(model, **params)
+            except Exception as e:
+                delay = self.retry(provider, model, e, attempt, deadline)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def astream(
+        self, provider: BaseProvider, model: str, prompt: str, deadline: float
+    ) -> AsyncIterator[Completion]:
+        """
+        Request a streamed completion of the prompt to a provider, see
+        `acomplete`, retried only until its first chunk.
+        """
+        params = self.completion_params(prompt, provider)
+        for attempt in itertools.count():
+            await self.admit(provider, params, deadline)
+            if self.settings.engine == "litellm":
+                chunks = fallback.astream(provider, model, **params)
+            else:
+                chunks = provider.astream(model, **params)
+            started = False
+            try:
+                async for chunk in chunks:
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started:
+                    raise
+                delay = self.retry(provider, model, e, attempt, deadline)
+                if delay is None:
+                    raise
+            finally:
+                await chunks.aclose()
+            await asyncio.sleep(delay)
+
+    async def admit(
+        self, provider: BaseProvider, params: dict, deadline: float
+    ) -> None:
+        """
+        Wait for the quota of a provider, if it has one, to send a completion
+        request. Its tokens are estimated as OpenAI counts them, from the
+        characters of the messages plus `max_tokens`.
+
+        The request is sent early enough to complete before the deadline, in the
+        95th percentile of the latency of the provider, at most half its timeout.
+        """
+        if provider.limiter is None:
+            return
+        text = "".join(message["content"] for message in params["messages"])
+        cost = tokens(text) + (params["max_tokens"] or 0)
+        half = self.timeout(provider) / 2
+        latency = self.breaker(provider).p95()
+        reserve = half if latency is None else min(latency, half)
+        await provider.limiter.acquire(cost, deadline - reserve)
+
+    def retry(
+        self,
+        provider: BaseProvider,
+        model: str,
+        e: Exception,
+        attempt: int,
+        deadline: float,
+    ) -> float | None:
+        """
+        Return the delay before retrying a completion failed with an error, None
+        if it is not retried.
+
+        Only the rejections of an overloaded provider (429) and its failures (5xx)
+        are retried, up to `retries` times before the deadline. The delay grows
+        exponentially from `retry_backoff` with a full jitter, so the retries of
+        concurrent requests spread out, and is at least the one the provider
+        asks for.
+        """
+        code = getattr(e, "status_code", None)
+        if not isinstance(code, int) or (code != 429 and code < 500):
+            return None
+        if attempt >= self.settings.retries:
+            return None
+        delay = random.uniform(0, self.settings.retry_backoff * 2**attempt)
+        headers = getattr(e, "headers", None)
+        delay = max(delay, (retry_after(headers) if headers else None) or 0)
+        if time.monotonic() + delay >= deadline:
+            return None
+        metrics.retries.inc(provider.name, model, str(code))
+        logger.warning(
+            f"{provider.name.value}/{model} failed, retrying in {delay:.2f}s: {e}"
+        )
+        return delay
+
+    def budget(self) -> int | None:
+        """
+        Return the maximum number of tokens of an answer, `tokens_per_word` for
+        each word of `length`, None if unlimited.
+        """
+        if self.settings.tokens_per_word is None:
+            return None
+        return math.ceil(self.settings.length * self.settings.tokens_per_word)
+
+    def cutoff(self, text: str, token: str) -> int | None:
+        """
+        Return where to cut a token streamed after a text so the answer doesn't
+        exceed `length` words, None if it doesn't or `cutoff` is disabled.
+
+        Only the native engine cuts off, as litellm can't stop the generation.
+        """
+        if not self.settings.cutoff or self.settings.engine == "litellm":
+            return None
+        words = list(WORD.finditer(text + token))
+        if len(words) <= self.settings.length:
+            return None
+        return max(0, words[self.settings.length].start() - len(text))
+
+    def truncation(
+        self,
+        provider: Provider,
+        model: str,
+        truncated: str | None,
+        usage: dict | None = None,
+        streamed: int = 0,
+    ) -> tuple[str | None, int]:
+        """
+        Report the truncation of an answer and return it, None if not truncated,
+        with the tokens saved, those of the budget left when cut off.
+
+        An answer is truncated by `max_tokens` when it reaches the budget, which
+        Ollama doesn't tell in non-streamed answers, or by the `cutoff` once
+        `length` words are streamed, the tokens being counted by chunk.
+        """
+        generated = (usage or {}).get("completion_tokens") or streamed
+        budget = self.budget()
+        if truncated is None and budget is not None and generated >= budget:
+            truncated = "max_tokens"
+        if truncated is None:
+            return None, 0
+        saved = max(0, budget - generated) if truncated == "cutoff" and budget else 0
+        metrics.truncations.inc(provider, model, truncated)
+        metrics.saved_tokens.inc(provider, model, value=saved)
+        logger.info(f"Answer truncated by {truncated}, {saved} tokens saved.")
+        return truncated, saved
+
+    def count_tokens(self, provider: Provider, model: str, usage: dict | None) -> None:
+        """
+        Add the tokens used by a completion to the metrics.
+        """
+        if usage is None:
+            return
+        for kind in ("prompt", "completion"):
+            count = usage.get(f"{kind}_tokens") or 0
+            metrics.tokens.inc(provider, model, kind, value=count)
+
+    def targets(self, route: Route | None = None) -> list[tuple[BaseProvider, str]]:
+        """
+        Return the providers and models to try, the one of the route first, by
+        default the one in use, then the one in use and the other providers.
+        """
+        route = route or self.default_route
+        targets = [(PROVIDERS[route.provider], route.model)]
+        if not self.settings.failover:
+            return targets
+        if route is not self.default_route:
+            targets.append((PROVIDERS[self.settings.provider], self.settings.model))
+        targets += [
+            (provider, provider.default)
+            for name, provider in PROVIDERS.items()
+            if name not in (route.provider, self.settings.provider)
+            and provider.available
+        ]
+        return targets
+
+    def route(self, type: str, output: str, description: str) -> Route:
+        """
+        Return the first available route matching an output, the default one,
+        to the provider and the model in use, if none does.
+        """
+        for route in self.settings.routes:
+            if route.model not in PROVIDERS[route.provider].models:
+                continue  # See `discover_fallbacks`
+            scheduler = self.scheduler(route.provider)
+            queue = scheduler.inflight + scheduler.waiting
+            if route.matches(type, output, description, queue):
+                return route
+        return self.default_route
+
+    def breaker(self, provider: BaseProvider) -> CircuitBreaker:
+        """
+        Return the circuit breaker of a provider.
+        """
+        if provider.name not in self.breakers:
+            self.breakers[provider.name] = CircuitBreaker(
+                window=self.settings.breaker_window,
+                errors=self.settings.breaker_errors,
+                latency=self.settings.breaker_latency,
+                cooldown=self.settings.breaker_cooldown,
             )
+        return self.breakers[provider.name]
+
+    def timeout(self, provider: BaseProvider) -> float:
+        """
+        Return the timeout of the completion requests to a provider, in seconds.
+        """
+        return self.settings.timeouts.get(provider.name.value, self.settings.timeout)
+
+    def hedge_delay(self, route: Route | None = None) -> float | None:
+        """
+        Return the delay before hedging with the next provider, None to wait.
+
+        If not configured, the delay is the 95th percentile of the latency of the
+        provider of the route, by default the one in use.
+        """
+        if not self.settings.hedge:
+            return None
+        if self.settings.hedge_delay is not None:
+            return self.settings.hedge_delay
+        route = route or self.default_route
+        return self.breaker(PROVIDERS[route.provider]).p95()
+
+    async def stream(
+        self, type: str, name: str, output: str, description: str, bypass: bool = False
+    ) -> AsyncIterator[dict]:
+        """
+        Get an explanation from a rule, the cache or the LLM, token by token.
+
+        Parameters:
+        ----------
+        type: str
+            The type of the prompt. Either "host" or "service".
+        output: str
+            The output of the plugin.
+        name: str, optional
+            The name of the host or service.
+        description: str, optional
+            The description of the host or service.
+        bypass: bool, optional
+            Whether to skip the rules, by default False.
+
+        Yields:
+        -------
+        event: dict
+            A `token` of the explanation, then the `usage` of the LLM and the
+            timings in seconds (`ttft` time to first token, `duration`) once done,
+            or an `error` if the completion failed.
+        """
 
+        start = time.perf_counter()
+        canned = None if bypass else self.canned(type, name, output, description)
+        if canned is not None:
+            rule, explanation = canned
+            yield {"token": explanation}
+            duration = time.perf_counter() - start
+            yield {
+                "usage": None,
+                "ttft": duration,
+                "duration": duration,
+                "cached": False,
+                "rule": rule,
+            }
+            return
+
+        route = self.route(type, output, description)
+        key = self.explanation_key(type, name, output, description, route)
+        with tracing.span("cache"):
+            explanation = await self.cache.get(key)
+        if explanation is not None:
+            logger.info("Explanation served from cache.")
+            yield {"token": explanation}
+            duration = time.perf_counter() - start
+            yield {
+                "usage": None,
+                "ttft": duration,
+                "duration": duration,
+                "cached": True,
+            }
+            return
+
+        vector, explanation = await self.semantic_get(type, output)
+        if explanation is not None:
+            logger.info("Explanation served from semantic cache.")
+            self.audit(type, name, output, description, explanation)
+            yield {"token": explanation}
+            duration = time.perf_counter() - start
+            yield {
+                "usage": None,
+                "ttft": duration,
+                "duration": duration,
+                "cached": True,
+            }
+            return
+
+        prompt, uuid, _ = await self.get_prompt(type, name, output, description)
+        logger.info(f"Streaming prompt with UUID: {uuid} ...")
+
+        # Fall back to another provider only before streaming, as the tokens
+        # already sent can't be taken back.
+        selected = self.select(route)
+        if selected is None:
+            yield {"error": "No provider available, retry later."}
+            return
+        target, model, trial = selected
+        provider, breaker = target.name, self.breaker(target)
+
+        tokens, usage, ttft, recorded = [], None, None, False
+        chunks, finished, truncated = None, False, None
+        queued = requested = time.monotonic()
+        try:
+            async with self.scheduler(provider).slot(priority(output)):
+                requested = target.used = time.monotonic()
+                metrics.queue_wait.observe(provider, model, requested - queued)
+                tracing.record("queue", requested - queued)
+                tracing.annotate(provider=provider, model=model)
+                metrics.selections.inc(provider, model)
+                # The timeout bounds the whole stream, so a stalled one frees its slot.
+                deadline = requested + self.timeout(target)
+                chunks = self.astream(target, model, prompt, deadline)
+                responded = None
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(
+                            anext(chunks), deadline - time.monotonic()
+                        )
+                    except StopAsyncIteration:
+                        break
+                    if responded is None:
+                        responded = time.monotonic()
+                        tracing.record("llm", responded - requested)
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if chunk.finish_reason == "length":
+                        truncated = "max_tokens"
+                    if not chunk.content:
+                        continue
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    token = chunk.content
+                    end = self.cutoff("".join(tokens), token)
+                    if end is not None:
+                        # Long enough, the rest of the answer is not generated.
+                        token, truncated = token[:end], "cutoff"
+                    if token:
+                        tokens.append(token)
+                        yield {"token": token}
+                    if end is not None:
+                        break
+                finished = truncated != "cutoff"
+                breaker.record(True, time.monotonic() - requested)
+                recorded = True
+                tracing.record("stream", time.monotonic() - (responded or requested))
+
+        except HTTPException as e:
+            # Rejected by the scheduler.
+            yield {"error": e.detail}
+            return
         except Exception as e:
-            msg = f"""Could not provide a completion:
-            - model: {self.settings.provider}/{self.settings.model}
+            breaker.record(False, time.monotonic() - requested)
+            recorded = True
+            yield {"error": self.completion_error(e, target, model).detail}
+            return
+        finally:
+            if trial and not recorded:
+                breaker.release()
+            # Stopped early, e.g. cut off or the client went away, the connection
+            # is closed so the provider stops generating.
+            if chunks is not None and not finished:
+                await chunks.aclose()
+
+        logger.info(f"Received response from model {model}.")
+        truncated, saved = self.truncation(
+            provider, model, truncated, usage, len(tokens)
+        )
+        if truncated is not None:
+            tracing.annotate(truncated=truncated, saved_tokens=saved)
+        metrics.provider_latency.observe(provider, model, time.monotonic() - requested)
+        metrics.routes.inc(provider, model, route.name)
+        metrics.route_latency.observe(
+            provider, model, time.monotonic() - requested, route.name
+        )
+        self.count_tokens(provider, model, usage)
+        # Answers of a fallback provider are not the ones of the routed model.
+        if (provider, model) == (route.provider, route.model):
+            await self.cache.set(key, "".join(tokens))
+            if vector is not None:
+                await self.semantic.set(vector, "".join(tokens))
+        duration = time.perf_counter() - start
+        yield {
+            "usage": usage,
+            "ttft": ttft,
+            "duration": duration,
+            "cached": False,
+            "truncated": truncated,
+            "saved_tokens": saved,
+        }
+
+    def select(
+        self, route: Route | None = None
+    ) -> tuple[BaseProvider, str, bool] | None:
+        """
+        Return the first provider of the route allowed by its breaker, its model
+        and whether the request is the trial one of the breaker, None if none is
+        allowed.
+        """
+        for provider, model in self.targets(route):
+            breaker = self.breaker(provider)
+            if breaker.allow():
+                return provider, model, breaker.opened is not None
+        return None
+
+    def scheduler(self, provider: Provider | None = None) -> Scheduler:
+        """
+        Return the scheduler of a provider, by default the one in use.
+        """
+        provider = provider or self.settings.provider
+        if provider not in self.schedulers:
+            self.schedulers[provider] = Scheduler(
+                concurrency=self.settings.concurrency,
+                size=self.settings.queue_size,
+                timeout=self.settings.queue_timeout,
+            )
+        return self.schedulers[provider]
+
+    def completion_params(
+        self, prompt: str, provider: BaseProvider | None = None
+    ) -> dict:
+        """
+        Return the parameters of a completion request for the prompt, by default
+        to the provider in use, see `BaseProvider.request`.
+        """
+        provider = provider or PROVIDERS[self.settings.provider]
+        params = {
+            "messages": [
+                {"role": "system", "content": self.settings.role},
+                {"role": "user", "content": prompt},
+            ],
+            "temperature": self.settings.temperature,
+            # Translated to num_predict for Ollama if the options don't set it.
+            "max_tokens": self.budget(),
+            "stop": self.settings.stop,
+        }
+        if provider.name == Provider.OLLAMA:
+            # The same as the warm-up, else Ollama loads the model again.
+            params["keep_alive"] = self.settings.keep_alive
+            params["options"] = self.settings.ollama_options
+        return params
+
+    def completion_error(
+        self, e: Exception, provider: BaseProvider, model: str
+    ) -> HTTPException:
+        """
+        Log a failed completion and return the error to give to the client, naming
+        the provider and the model which failed, without the prompt, which may be
+        long and reveal the monitored resource.
+
+        A provider still rejecting after the retries gives a 429 status, with the
+        delay to retry after it asked for.
+        """
+        logger.error(f"{provider.name.value}/{model} failed: {describe(e)}")
+        if getattr(e, "status_code", None) == status.HTTP_429_TOO_MANY_REQUESTS:
+            headers = getattr(e, "headers", None)
+            delay = (retry_after(headers) if headers else None) or 1
+            return HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Quota of the provider reached, retry later.",
+                headers={"Retry-After": str(max(1, math.ceil(delay)))},
+            )
+        msg = f"""Could not provide a completion:
+            - model: {provider.name.value}/{model}
             - temperature: {self.settings.temperature}
-            - base_url: {self.settings.url}
-            - role: {self.settings.role},
-            - prompt: {prompt},
-            - error: {e}
+            - base_url: {provider.url}
+            - error: {describe(e)}
             """
-            logger.error(e)
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=msg
+        )
+
+    async def stored_prompt(self, uuid: UUID) -> str:
+        """
+        Return a prompt previously crafted by `get_prompt`.
+
+        Parameters:
+        ----------
+        uuid: UUID
+            The UUID of the prompt.
+
+        Returns:
+        -------
+        prompt: str
+            The stored prompt.
+        """
+        prompt = await self.prompts.fetch(uuid)
+        if prompt is None:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=msg
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Prompt with UUID {uuid} is unknown or expired.",
             )
+        return prompt
 
-        else:
-            logger.info(f"Received response from model {self.settings.model}.")
-            explanation = response.choices[0].message.content
-            return explanation
+    def explanation_key(
+        self,
+        type: str,
+        name: str,
+        output: str,
+        description: str,
+        route: Route | None = None,
+    ) -> str:
+        """
+        Return the cache key of the explanation of an output, answered by the
+        model of its route.
+        """
+        route = route or self.route(type, output, description)
+        return ExplanationCache.key(
+            type=type,
+            name=name,
+            output=output,
+            description=description,
+            **self.answer_settings(route),
+        )
 
-    def get_prompt(
+    def answer_settings(self, route: Route | None = None) -> dict:
+        """
+        Return the settings affecting the answer of the LLM, with the provider
+        and the model of the route if given.
+        """
+        settings = self.settings.model_dump(
+            include={
+                "provider",
+                "model",
+                "temperature",
+                "length",
+                "language",
+                "role",
+                "compact",
+                "output_budget",
+                "ollama_options",
+                "tokens_per_word",
+                "stop",
+                "cutoff",
+            }
+        )
+        if route is not None:
+            settings.update(provider=route.provider.value, model=route.model)
+        return settings
+
+    async def get_prompt(
         self, type: str, name: str, output: str, description: str
-    ) -> tuple[str, UUID]:
+    ) -> tuple[str, UUID, Compacted]:
         """
         Craft a prompt from the received parameters and store it.
 
@@ -108,41 +1566,74 @@ class PluginProcessor:
             The prompt to send to the LLM.
         uuid: UUID
             The UUID of the prompt.
+        compacted: Compacted
+            The output as given in the prompt and its size in tokens, before and
+            after its compaction.
         """
 
+        start = time.perf_counter()
         uuid = uuid4()
+        if self.settings.compact:
+            compacted = compact(output, self.settings.output_budget)
+        else:
+            size = tokens(output)
+            compacted = Compacted(output, size, size)
         prompt = TEMPLATE_PROMPT.format(
-            output=output,
+            output=compacted.output,
             type=type,
             name=name,
             description=description,
             length=self.settings.length,
             language=self.settings.language.value,
         )
-        self.prompts[uuid] = prompt
+        metrics.prompt_build.observe(
+            self.settings.provider, self.settings.model, time.perf_counter() - start
+        )
+        provider, model = self.settings.provider, self.settings.model
+        metrics.output_tokens.inc(provider, model, "raw", value=compacted.before)
+        metrics.output_tokens.inc(provider, model, "compacted", value=compacted.after)
+        await self.prompts.put(uuid, prompt)
+        tracing.record("prompt", time.perf_counter() - start)
+        tracing.annotate(uuid=uuid)
         logger.info(f"Prompt created with UUID: {uuid}.")
-        return prompt, uuid
+        return prompt, uuid, compacted
 
     def configure(self):
-        """Load params from config file and create one if it doesn't exists."""
+        """
+        Load params from config file and create one if it doesn't exists.
 
-        # Default path to the root of the project if not provided.
-        default_path = os.path.join(os.getcwd(), "pop.yaml")
-        path = os.environ.get("POP_CONFIG_PATH", default_path)
+        Providers are not discovered here to start quickly, see `discover`.
+        """
 
-        # Create a configuration file if doesn't exist
-        Path(path).touch()
+        self.path = config_path()
 
-        with open(path, "r") as file:
-            config = yaml.safe_load(file)
-            config = config if isinstance(config, dict) else {}
-            try:
-                self.settings = Settings(**config)
-            except ValidationError as e:
-                logger.error(e.errors()[0]["msg"])
-                sys.exit()
+        # Local data (e.g. cached explanations) is stored next to the configuration.
+        default_database = os.path.join(os.path.dirname(self.path), "pop.db")
+        self.database = os.environ.get("POP_DB_PATH", default_database)
+
+        try:
+            settings = load_settings(self.path, discover=False)
+        except ValueError as e:
+            logger.error(e)
+            sys.exit()
+        if settings is not None:
+            self.apply(settings)
+            self.scope()  # Not serving yet
+
+
+def ollama_models(settings: Settings) -> list[str]:
+    """
+    Return the Ollama models of the settings, the one in use then those routed to.
+    """
+    models = [settings.model] if settings.provider == Provider.OLLAMA else []
+    for route in settings.routes:
+        if route.provider == Provider.OLLAMA and route.model not in models:
+            models.append(route.model)
+    return models
 
-        with open(path, "w") as file:
-            yaml.safe_dump(self.settings.model_dump(exclude=["url"]), file)
 
-        logger.info(f"Configuration path: {path}")
+def describe(e: Exception) -> str:
+    """
+    Return the message of an error, its type if it has none, e.g. a timeout.
+    """
+    return str(e) or type(e).__name__
@@ -15,9 +15,126 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+import json
+import os
+import tempfile
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator, NamedTuple
+
+import httpx
 
 from pop.globals import Provider
+from pop.logger import logger
+from pop.ratelimit import RateLimiter, retry_after
+
+
+class Completion(NamedTuple):
+    """
+    An answer of a provider, or a chunk of a streamed one.
+    """
+
+    content: str
+    usage: dict | None = None  # Tokens of the prompt and the completion, once done
+    finish_reason: str | None = None  # E.g. "length" if cut by max_tokens
+    generation: float | None = None  # Seconds spent by the provider, if given
+
+
+class ProviderError(Exception):
+    """
+    A completion request refused or failed by a provider.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status_code: int | None = None,
+        headers: httpx.Headers | None = None,
+    ) -> None:
+        super().__init__(message)
+        self.status_code = status_code  # Of the answer, if any
+        self.headers = headers
+
+
+class Clients:
+    """
+    HTTP clients shared by the providers, keeping their connections alive.
+
+    An asynchronous client is bound to the event loop using it, so it is created
+    again for another loop, e.g. of another `asyncio.run`.
+    """
+
+    def __init__(self) -> None:
+        self.connect = 5.0  # Timeout to connect and to get a pooled connection
+        self.limits = httpx.Limits(
+            max_connections=100, max_keepalive_connections=20, keepalive_expiry=30
+        )
+        self.async_client: httpx.AsyncClient | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.sync_client: httpx.Client | None = None
+
+    def configure(
+        self,
+        connect: float,
+        connections: int,
+        keepalive: int,
+        expiry: float,
+    ) -> None:
+        """
+        Set the limits of the clients, created again if they changed.
+
+        Parameters
+        ----------
+        connect : float
+            The timeout to connect and to get a connection from the pool.
+        connections : int
+            The maximum number of connections.
+        keepalive : int
+            The maximum number of idle connections kept alive.
+        expiry : float
+            The time an idle connection is kept alive in seconds.
+        """
+        limits = httpx.Limits(
+            max_connections=connections,
+            max_keepalive_connections=keepalive,
+            keepalive_expiry=expiry,
+        )
+        if (connect, limits) == (self.connect, self.limits):
+            return
+        self.connect, self.limits = connect, limits
+        # The connections of the previous clients close once they are released.
+        self.async_client = self.sync_client = None
+
+    def timeout(self, timeout: float | None) -> httpx.Timeout:
+        """
+        Return the timeouts of a request, reading an answer for up to `timeout`
+        seconds between two chunks, by default without limit.
+        """
+        return httpx.Timeout(timeout, connect=self.connect, pool=self.connect)
+
+    def get(self) -> httpx.AsyncClient:
+        """
+        Return the asynchronous client of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self.loop is not loop:
+            self.async_client = httpx.AsyncClient(limits=self.limits)
+            self.loop = loop
+        return self.async_client
+
+    def sync(self) -> httpx.Client:
+        """
+        Return the synchronous client.
+        """
+        if self.sync_client is None:
+            self.sync_client = httpx.Client(limits=self.limits)
+        return self.sync_client
+
+
+# Shared by the providers, so they share the limits of the connections.
+CLIENTS = Clients()
 
 
 class BaseProvider(ABC):
@@ -36,6 +153,10 @@ class BaseProvider(ABC):
         self.name = name
         self._default = default
         self.url = url
+        self.models: list[str] = []
+        self.status = "unknown"  # Progress of the discovery
+        self.used = 0.0  # Monotonic time of the last request
+        self.limiter: RateLimiter | None = None  # Set if the provider has quotas
 
     @abstractmethod
     def fetch(self) -> None:
@@ -44,6 +165,189 @@ class BaseProvider(ABC):
         """
         pass
 
+    @contextmanager
+    def backend(self, model: str) -> Iterator[str | None]:
+        """
+        Yield the base URL of the backend serving a completion of a model, by
+        default the one of the provider.
+        """
+        yield self.url
+
+    @abstractmethod
+    def request(
+        self,
+        base: str | None,
+        model: str,
+        messages: list[dict],
+        stream: bool,
+        temperature: float = 1.0,
+        max_tokens: int | None = None,
+        stop: list[str] | None = None,
+        keep_alive: str | int | None = None,
+        options: dict | None = None,
+    ) -> tuple[str, dict, dict]:
+        """
+        Return the URL, the body and the headers of a completion request.
+
+        Parameters
+        ----------
+        base : str | None
+            The base URL of the backend answering, see `backend`.
+        model : str
+            The model answering.
+        messages : list[dict]
+            The messages of the chat, each one with a `role` and a `content`.
+        stream : bool
+            Whether the answer is streamed.
+        temperature : float, optional
+            The sampling temperature, by default 1.
+        max_tokens : int, optional
+            The maximum number of tokens of the answer, by default unlimited.
+        stop : list[str], optional
+            The sequences ending the answer, by default None.
+        keep_alive : str | int, optional
+            How long Ollama keeps the model loaded, ignored by the others.
+        options : dict, optional
+            The options of Ollama, ignored by the others.
+        """
+        pass
+
+    @abstractmethod
+    def answer(self, response: httpx.Response) -> Completion:
+        """
+        Return the completion of a non-streamed answer.
+        """
+        pass
+
+    @abstractmethod
+    def chunk(self, line: str) -> Completion | None:
+        """
+        Return the chunk of a line of a streamed answer, None if it has none.
+        """
+        pass
+
+    def complete(
+        self, model: str, messages: list[dict], timeout: float | None = None, **params
+    ) -> Completion:
+        """
+        Request a completion, see `request` for the parameters.
+
+        Raises
+        ------
+        ProviderError
+            If the provider answered with an error.
+        """
+        with self.backend(model) as base:
+            url, body, headers = self.request(base, model, messages, False, **params)
+            response = CLIENTS.sync().post(
+                url, json=body, headers=headers, timeout=CLIENTS.timeout(timeout)
+            )
+            self.observe(response)
+            check(response)
+        return self.answer(response)
+
+    async def acomplete(
+        self, model: str, messages: list[dict], timeout: float | None = None, **params
+    ) -> Completion:
+        """
+        Request a completion without blocking the event loop, see `complete`.
+        """
+        with self.backend(model) as base:
+            url, body, headers = self.request(base, model, messages, False, **params)
+            response = await CLIENTS.get().post(
+                url, json=body, headers=headers, timeout=CLIENTS.timeout(timeout)
+            )
+            self.observe(response)
+            check(response)
+        return self.answer(response)
+
+    async def astream(
+        self, model: str, messages: list[dict], timeout: float | None = None, **params
+    ) -> AsyncIterator[Completion]:
+        """
+        Request a streamed completion, see `complete`. The last chunk gives the
+        usage and why the answer ended.
+
+        Closing the iterator early closes the connection, so the provider stops
+        generating.
+        """
+        with self.backend(model) as base:
+            url, body, headers = self.request(base, model, messages, True, **params)
+            async with CLIENTS.get().stream(
+                "POST",
+                url,
+                json=body,
+                headers=headers,
+                timeout=CLIENTS.timeout(timeout),
+            ) as response:
+                self.observe(response)
+                if response.is_error:
+                    await response.aread()
+                    check(response)
+                async for line in response.aiter_lines():
+                    chunk = self.chunk(line) if line else None
+                    if chunk is not None:
+                        yield chunk
+
+    def observe(self, response: httpx.Response) -> None:
+        """
+        Follow the rate limits given by an answer, if the provider has quotas.
+        """
+        if self.limiter is None:
+            return
+        self.limiter.update(response.headers)
+        if response.status_code == 429:
+            self.limiter.pause(retry_after(response.headers) or 0)
+
+    def discover(self, path: str | None = None, ttl: float = 0) -> None:
+        """
+        Get available models from the cache file if fresh enough, else fetch them.
+
+        Parameters
+        ----------
+        path : str, optional
+            The path of the JSON file caching the models of every provider,
+            by default None to always fetch them.
+        ttl : float, optional
+            The time to live of the cached models in seconds, by default 0.
+        """
+        cache = read_models(path) if path is not None else {}
+        cached = cache.get(self.name.value)
+        if cached is not None and time.time() - cached["fetched"] < ttl:
+            logger.info(f"Using cached models of {self.name.value}.")
+            self.models = cached["models"]
+            self.status = "available" if self.available else "unavailable"
+            return
+
+        self.status = "fetching"
+        try:
+            self.fetch()
+        except Exception:
+            self.status = "failed"
+            raise
+        self.status = "available" if self.available else "unavailable"
+
+        # Only cache available models, so an unavailable provider is checked again.
+        if path is not None and self.available:
+            # Read again, another provider may have been cached meanwhile.
+            cache = read_models(path)
+            cache[self.name.value] = {"fetched": time.time(), "models": self.models}
+            write_models(path, cache)
+
+    def load(self, path: str) -> None:
+        """
+        Get the models from the cache file only, whatever their age, e.g. in a
+        worker whose parent process already discovered the providers.
+
+        Parameters
+        ----------
+        path : str
+            The path of the JSON file caching the models of every provider.
+        """
+        cached = read_models(path).get(self.name.value)
+        self.models = cached["models"] if cached is not None else []
+        self.status = "available" if self.available else "unavailable"
+
     @property
     def available(self) -> bool:
         """
@@ -61,3 +365,40 @@ class BaseProvider(ABC):
         if self.available:
             return self.models[0]
         return None
+
+
+def check(response: httpx.Response) -> None:
+    """
+    Raise an error if a provider answered with an error, giving its reason.
+    """
+    if response.is_error:
+        raise ProviderError(
+            f"{response.status_code} {response.reason_phrase}: {response.text[:500]}",
+            response.status_code,
+            response.headers,
+        )
+
+
+def read_models(path: str) -> dict:
+    """
+    Return the models cached in a JSON file by provider, empty if unreadable.
+    """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_models(path: str, cache: dict) -> None:
+    """
+    Write the models cached by provider to a JSON file.
+
+    The file is replaced at once, so other processes never read it half written.
+    """
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(
+        "w", dir=directory, suffix=".tmp", delete=False
+    ) as file:
+        json.dump(cache, file)
+    os.replace(file.name, path)
@@ -0,0 +1,132 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Completions requested through litellm, the `litellm` engine, instead of the
+providers themselves.
+
+litellm is an optional dependency, imported on the first completion as importing
+it takes seconds. The completions are the ones of the providers, see
+`BaseProvider.request` for their parameters.
+
+litellm gives no handle on the connection of a stream, so a stream stopped early
+is left to litellm and generated by the provider until its end: the streams are
+only cut off by the native engine.
+"""
+
+from typing import AsyncIterator
+
+from pop.globals import Provider
+from pop.providers.base import BaseProvider, Completion
+
+
+def load():
+    """
+    Return litellm, imported on first call.
+    """
+    import litellm
+
+    return litellm
+
+
+def params(
+    provider: BaseProvider,
+    base: str | None,
+    model: str,
+    messages: list[dict],
+    temperature: float = 1.0,
+    max_tokens: int | None = None,
+    stop: list[str] | None = None,
+    keep_alive: str | int | None = None,
+    options: dict | None = None,
+) -> dict:
+    """
+    Return the parameters of litellm for a completion.
+    """
+    params = {
+        "model": f"{provider.name.value}/{model}",
+        "base_url": base,
+        "temperature": temperature,
+        "messages": messages,
+    }
+    if provider.name == Provider.OLLAMA:
+        # The chat endpoint applies the template of the model to the messages,
+        # and takes the keep-alive while the generate one of litellm drops it.
+        params["model"] = f"ollama_chat/{model}"
+        if keep_alive is not None:
+            params["keep_alive"] = keep_alive
+        params.update(options or {})
+    # Translated to num_predict for Ollama if not set.
+    if max_tokens is not None and "num_predict" not in params:
+        params["max_tokens"] = max_tokens
+    if stop:
+        params["stop"] = stop
+    return params
+
+
+async def acomplete(
+    provider: BaseProvider,
+    model: str,
+    messages: list[dict],
+    timeout: float | None = None,
+    **options,
+) -> Completion:
+    """
+    Request a completion to a provider through litellm.
+    """
+    with provider.backend(model) as base:
+        response = await load().acompletion(
+            **params(provider, base, model, messages, **options), timeout=timeout
+        )
+    choice = response.choices[0]
+    usage = getattr(response, "usage", None)
+    hidden = getattr(response, "_hidden_params", None) or {}
+    headers = hidden.get("additional_headers") or {}
+    processing = headers.get("llm_provider-openai-processing-ms")
+    return Completion(
+        choice.message.content or "",
+        usage.model_dump() if usage is not None else None,
+        choice.finish_reason,
+        float(processing) / 1000 if processing is not None else None,
+    )
+
+
+async def astream(
+    provider: BaseProvider,
+    model: str,
+    messages: list[dict],
+    timeout: float | None = None,
+    **options,
+) -> AsyncIterator[Completion]:
+    """
+    Request a streamed completion to a provider through litellm, see
+    `BaseProvider.astream`.
+    """
+    with provider.backend(model) as base:
+        response = await load().acompletion(
+            **params(provider, base, model, messages, **options),
+            timeout=timeout,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in response:
+            usage = getattr(chunk, "usage", None)
+            choice = chunk.choices[0] if chunk.choices else None
+            content = (choice.delta.content if choice else None) or ""
+            reason = choice.finish_reason if choice else None
+            if content or usage is not None or reason is not None:
+                usage = usage.model_dump() if usage is not None else None
+                yield Completion(content, usage, reason)
@@ -14,47 +14,239 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import os
+import time
+from typing import ContextManager
+from urllib.parse import urlsplit
 
-import ollama
-from httpx import ConnectError
+import httpx
 
 from pop.globals import Provider
 from pop.logger import logger
-from pop.providers.base import BaseProvider
+from pop.providers.base import CLIENTS, BaseProvider, Completion, ProviderError, check
+from pop.providers.pool import Pool
+
+# Port of Ollama, used when a host doesn't give one.
+PORT = 11434
+
+# Timeout of a health check in seconds.
+HEALTH_TIMEOUT = 5
 
 
 class Ollama(BaseProvider):
+    """
+    Ollama, served by one or several hosts given by `OLLAMA_HOST`, the completions
+    being balanced between them, see `pop.providers.pool`.
+    """
 
     def __init__(self) -> None:
 
-        host = os.environ.get("OLLAMA_HOST", "localhost")
+        self.pool = Pool(hosts(), self.atags)
+        # The first host stands for the others where a single one is expected.
+        super().__init__(name=Provider.OLLAMA, url=self.pool.backends[0].url)
 
-        super().__init__(name=Provider.OLLAMA, url=f"http://{host}:11434")
+    def backend(self, model: str) -> ContextManager[str]:
+        return self.pool.use(model)
 
     def fetch(self) -> None:
         """
-        Get available models for Ollama.
-        If Ollama is available but has no models, pull a small one.
+        Get available models for Ollama, those of every host.
+        If a host is available but has no models, pull a small one.
         """
-        try:
-            self.models = [model["name"] for model in ollama.list()["models"]]
-        except ConnectError:
-            self.models = []
-        else:
-            if len(self.models) == 0:
-                self.pull_default_model()
+        for backend in self.pool.backends:
+            try:
+                backend.models = self.tags(backend.url)
+                if len(backend.models) == 0:
+                    self.pull_default_model(backend.url)
+                    backend.models = self.tags(backend.url)
+            except (httpx.HTTPError, ProviderError) as e:
+                self.pool.eject(backend, f"models not listed, {e}")
+                continue
+            backend.healthy = True
+        self.models = self.pool.models()
+
+    def tags(self, url: str) -> list[str]:
+        """
+        Return the models of an Ollama host.
+        """
+        response = CLIENTS.sync().get(
+            f"{url}/api/tags", timeout=CLIENTS.timeout(HEALTH_TIMEOUT)
+        )
+        check(response)
+        return [model["name"] for model in response.json()["models"]]
+
+    async def atags(self, url: str) -> list[str]:
+        """
+        Return the models of an Ollama host without blocking the event loop.
+        """
+        response = await CLIENTS.get().get(
+            f"{url}/api/tags", timeout=CLIENTS.timeout(HEALTH_TIMEOUT)
+        )
+        check(response)
+        return [model["name"] for model in response.json()["models"]]
+
+    async def check(self) -> None:
+        """
+        Check the health and the models of the hosts, ejecting those down and
+        admitting again those back.
+        """
+        await self.pool.check()
+        self.models = self.pool.models() or self.models
 
-    def pull_default_model(self) -> None:
+    def pull_default_model(self, url: str) -> None:
         """
-        Pull a small model in Ollama;
+        Pull a small model in an Ollama host.
         """
         small_model = os.environ.get("POP_OLLAMA_DEFAULT_MODEL", "qwen2:0.5b")
         try:
-            logger.info(f"No models found, pulling default model {small_model} ...")
-            ollama.pull(small_model)
-        except ConnectError:
-            logger.warning(f"Failed to pull default model {small_model}.")
+            logger.info(f"No models found on {url}, pulling {small_model} ...")
+            with CLIENTS.sync().stream(
+                "POST",
+                f"{url}/api/pull",
+                json={"model": small_model, "stream": True},
+                timeout=CLIENTS.timeout(None),
+            ) as response:
+                if response.is_error:
+                    response.read()
+                    check(response)
+                for line in response.iter_lines():
+                    progress = json.loads(line) if line else {}
+                    if "error" in progress:
+                        raise ProviderError(progress["error"])
+                    if "status" not in progress:
+                        continue
+                    self.status = f"pulling {small_model}: {progress['status']}"
+                    if progress.get("total"):
+                        percent = 100 * progress.get("completed", 0) / progress["total"]
+                        self.status += f" {percent:.0f}%"
+        except (httpx.HTTPError, ProviderError) as e:
+            logger.warning(f"Failed to pull default model {small_model}: {e}")
         else:
-            logger.info(f"Model {small_model} pulled.")
-            self.models.append(small_model)
+            logger.info(f"Model {small_model} pulled on {url}.")
+
+    def warm(self, model: str, keep_alive: str | int, options: dict) -> None:
+        """
+        Load a model in memory of every healthy host having it and keep it loaded
+        for `keep_alive`, with an empty prompt which is not evaluated.
+
+        The options must be the ones of the completions, since Ollama loads the
+        model again when some of them change, e.g. `num_ctx` or `num_thread`.
+        """
+        body = {"model": model, "keep_alive": keep_alive, "options": options}
+        body["stream"] = False
+        for backend in self.pool.backends:
+            if not backend.healthy or not backend.has(model):
+                continue
+            start = time.monotonic()
+            try:
+                response = CLIENTS.sync().post(
+                    f"{backend.url}/api/generate",
+                    json=body,
+                    timeout=CLIENTS.timeout(None),
+                )
+                check(response)
+            except (httpx.HTTPError, ProviderError) as e:
+                logger.warning(f"Failed to load model {model} on {backend.url}: {e}")
+            else:
+                duration = time.monotonic() - start
+                logger.info(
+                    f"Model {model} loaded on {backend.url} in {duration:.1f}s."
+                )
+        self.used = time.monotonic()
+
+    async def embed(
+        self, model: str, texts: list[str], keep_alive: str | int | None = None
+    ) -> list[list[float]]:
+        """
+        Return the embeddings of texts computed by a model.
+        """
+        body = {"model": model, "input": texts}
+        if keep_alive is not None:
+            body["keep_alive"] = keep_alive
+        with self.backend(model) as url:
+            response = await CLIENTS.get().post(
+                f"{url}/api/embed", json=body, timeout=CLIENTS.timeout(None)
+            )
+            check(response)
+        return response.json()["embeddings"]
+
+    def request(
+        self,
+        base: str,
+        model: str,
+        messages: list[dict],
+        stream: bool,
+        temperature: float = 1.0,
+        max_tokens: int | None = None,
+        stop: list[str] | None = None,
+        keep_alive: str | int | None = None,
+        options: dict | None = None,
+    ) -> tuple[str, dict, dict]:
+        """
+        Return a request to the chat endpoint, which applies the template of the
+        model to the messages.
+        """
+        options = {"temperature": temperature, **(options or {})}
+        # The options set the length of the answers if they give it.
+        if max_tokens is not None:
+            options.setdefault("num_predict", max_tokens)
+        if stop:
+            options["stop"] = stop
+        body = {"model": model, "messages": messages, "stream": stream}
+        body["options"] = options
+        if keep_alive is not None:
+            body["keep_alive"] = keep_alive
+        return f"{base}/api/chat", body, {}
+
+    def answer(self, response: httpx.Response) -> Completion:
+        data = response.json()
+        return done(data, data["message"]["content"])
+
+    def chunk(self, line: str) -> Completion | None:
+        """
+        Return the chunk of a line of the stream, a JSON object by line.
+        """
+        data = json.loads(line)
+        if "error" in data:
+            raise ProviderError(data["error"])
+        content = data.get("message", {}).get("content", "")
+        if data.get("done"):
+            return done(data, content)
+        return Completion(content) if content else None
+
+
+def done(data: dict, content: str) -> Completion:
+    """
+    Return the completion of the last answer of Ollama, giving the statistics.
+    """
+    usage = {
+        "prompt_tokens": data.get("prompt_eval_count", 0),
+        "completion_tokens": data.get("eval_count", 0),
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    duration = data.get("total_duration")
+    return Completion(
+        content,
+        usage,
+        data.get("done_reason"),
+        duration / 1e9 if duration is not None else None,
+    )
+
+
+def hosts() -> list[str]:
+    """
+    Return the base URLs of the Ollama hosts, given by `OLLAMA_HOST` as a comma
+    separated list, e.g. `gpu1,gpu2:11435,https://cpu1`, by default localhost.
+    """
+    urls = []
+    for host in os.environ.get("OLLAMA_HOST", "localhost").split(","):
+        host = host.strip().rstrip("/")
+        if not host:
+            continue
+        if "://" not in host:
+            host = f"http://{host}"
+        if urlsplit(host).port is None:
+            host = f"{host}:{PORT}"
+        urls.append(host)
+    return urls or [f"http://localhost:{PORT}"]
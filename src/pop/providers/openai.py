@@ -15,16 +15,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
+import os
+
+import httpx
 import openai
 
 from pop.globals import Provider
-from pop.providers.base import BaseProvider
+from pop.providers.base import BaseProvider, Completion
+from pop.ratelimit import RateLimiter
 
 
 class OpenAI(BaseProvider):
 
     def __init__(self) -> None:
         super().__init__(Provider.OPENAI, "gpt-4o")
+        self.limiter = RateLimiter()
 
     def fetch(self) -> None:
         """
@@ -36,3 +42,64 @@ class OpenAI(BaseProvider):
             ]
         except openai.OpenAIError:
             self.models = []
+
+    def request(
+        self,
+        base: str | None,
+        model: str,
+        messages: list[dict],
+        stream: bool,
+        temperature: float = 1.0,
+        max_tokens: int | None = None,
+        stop: list[str] | None = None,
+        keep_alive: str | int | None = None,
+        options: dict | None = None,
+    ) -> tuple[str, dict, dict]:
+        """
+        Return a request to the chat completions endpoint, at `OPENAI_BASE_URL`
+        as the OpenAI client.
+        """
+        base = base or os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+        headers = {"Authorization": f"Bearer {os.environ.get('OPENAI_API_KEY', '')}"}
+        body = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "stream": stream,
+        }
+        if max_tokens is not None:
+            body["max_tokens"] = max_tokens
+        if stop:
+            body["stop"] = stop
+        if stream:
+            body["stream_options"] = {"include_usage": True}
+        return f"{base.rstrip('/')}/chat/completions", body, headers
+
+    def answer(self, response: httpx.Response) -> Completion:
+        data = response.json()
+        choice = data["choices"][0]
+        # The time spent generating, the rest of the completion being network.
+        processing = response.headers.get("openai-processing-ms")
+        return Completion(
+            choice["message"]["content"] or "",
+            data.get("usage"),
+            choice.get("finish_reason"),
+            float(processing) / 1000 if processing is not None else None,
+        )
+
+    def chunk(self, line: str) -> Completion | None:
+        """
+        Return the chunk of a line of the stream, of server-sent events.
+        """
+        if not line.startswith("data:"):
+            return None
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return None
+        data = json.loads(data)
+        choice = data["choices"][0] if data.get("choices") else {}
+        content = choice.get("delta", {}).get("content") or ""
+        usage, reason = data.get("usage"), choice.get("finish_reason")
+        if not content and usage is None and reason is None:
+            return None
+        return Completion(content, usage, reason)
@@ -0,0 +1,191 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Pool of the backends serving a provider, e.g. several Ollama hosts, balancing the
+completions between them.
+
+A completion goes to a healthy backend having its model: with the `least`
+balancing, the one with the fewest outstanding requests, with the `latency` one,
+the one with the lowest expected wait, its mean latency times its outstanding
+requests plus one. A backend failing `errors` requests in a row, or a health
+check, is ejected until a health check succeeds again.
+"""
+
+import asyncio
+import random
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator
+
+from pop.logger import logger
+
+# Weight of the last completion in the mean latency of a backend.
+SMOOTHING = 0.2
+
+
+class Backend:
+    """
+    A backend of a pool and the state of its requests.
+    """
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.models: list[str] | None = None  # Unknown until checked
+        self.healthy = True
+        self.outstanding = 0  # Requests in flight
+        self.latency = 0.0  # Mean duration of the completions, 0 until known
+        self.failures = 0  # Requests failed in a row
+        self.completions = 0
+
+    def has(self, model: str) -> bool:
+        """
+        Return True if the backend may serve a model, i.e. has it or is unknown.
+        """
+        return self.models is None or model in self.models
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "latency": round(self.latency, 4),
+            "completions": self.completions,
+            "models": self.models,
+        }
+
+
+class Pool:
+    """
+    Backends of a provider, the completions balanced between the healthy ones.
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        probe: Callable[[str], Awaitable[list[str]]],
+        balance: str = "least",
+        errors: int = 3,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        urls : list[str]
+            The base URLs of the backends.
+        probe : Callable[[str], Awaitable[list[str]]]
+            Return the models of the backend of a URL, raising if it is down.
+        balance : str, optional
+            The balancing, `least` outstanding requests or `latency` weighted,
+            by default `least`.
+        errors : int, optional
+            The requests failed in a row ejecting a backend, by default 3.
+        """
+        self.backends = [Backend(url) for url in urls]
+        self.probe = probe
+        self.balance = balance
+        self.errors = errors
+
+    def pick(self, model: str) -> Backend:
+        """
+        Return the backend serving a completion of a model.
+
+        The backends having the model are preferred to the others, then the
+        healthy ones, so a request is still tried when none fits.
+        """
+        fitting = [backend for backend in self.backends if backend.has(model)]
+        candidates = fitting or self.backends
+        healthy = [backend for backend in candidates if backend.healthy]
+        candidates = healthy or candidates
+        if self.balance == "latency":
+            return min(
+                candidates,
+                key=lambda backend: (
+                    (backend.outstanding + 1) * backend.latency,
+                    random.random(),
+                ),
+            )
+        return min(
+            candidates, key=lambda backend: (backend.outstanding, random.random())
+        )
+
+    @contextmanager
+    def use(self, model: str) -> Iterator[str]:
+        """
+        Yield the URL of the backend serving a completion of a model, recording
+        its result, an error raised in the block being a failure.
+        """
+        backend = self.pick(model)
+        backend.outstanding += 1
+        start = time.monotonic()
+        try:
+            yield backend.url
+        except Exception:
+            backend.failures += 1
+            if backend.failures >= self.errors and backend.healthy:
+                self.eject(backend, f"{backend.failures} requests failed in a row")
+            raise
+        else:
+            latency = time.monotonic() - start
+            if backend.latency:
+                latency = backend.latency + SMOOTHING * (latency - backend.latency)
+            backend.latency = latency
+            backend.completions += 1
+            backend.failures = 0
+        finally:
+            backend.outstanding -= 1
+
+    def eject(self, backend: Backend, reason: str) -> None:
+        """
+        Stop sending completions to a backend until a health check succeeds.
+        """
+        backend.healthy = False
+        if len(self.backends) > 1:
+            logger.warning(f"Backend {backend.url} ejected: {reason}.")
+
+    async def check(self) -> None:
+        """
+        Check the health and the models of every backend, admitting again the
+        ejected ones which answer.
+        """
+
+        async def probe(backend: Backend) -> None:
+            try:
+                models = await self.probe(backend.url)
+            except Exception as e:
+                if backend.healthy:
+                    self.eject(backend, f"health check failed, {e}")
+                return
+            backend.models = models
+            if not backend.healthy:
+                backend.healthy, backend.failures = True, 0
+                backend.latency = 0.0  # Tried again by the latency balancing
+                logger.info(f"Backend {backend.url} admitted again.")
+
+        await asyncio.gather(*(probe(backend) for backend in self.backends))
+
+    def models(self) -> list[str]:
+        """
+        Return the models of the backends, in order of the backends.
+        """
+        models = []
+        for backend in self.backends:
+            for model in backend.models or []:
+                if model not in models:
+                    models.append(model)
+        return models
+
+    def stats(self) -> list[dict]:
+        return [backend.stats() for backend in self.backends]
@@ -0,0 +1,207 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Client side rate limiting of a provider enforcing quotas, e.g. OpenAI.
+
+The requests and the tokens sent per minute are limited by two token buckets,
+sized by the configured quotas or the ones the provider gives in its rate limit
+headers, and kept at most as full as the provider tells:
+
+    x-ratelimit-limit-requests: 500
+    x-ratelimit-remaining-requests: 499
+    x-ratelimit-limit-tokens: 30000
+    x-ratelimit-remaining-tokens: 29200
+
+A request takes one request and its estimated tokens, the ones of its prompt and
+its `max_tokens` as counted by OpenAI, waiting until both buckets hold them. After
+a rejection of the provider, the requests also wait for the delay it asks for.
+"""
+
+import asyncio
+import math
+import time
+from email.utils import parsedate_to_datetime
+
+from fastapi import HTTPException, status
+
+
+class Bucket:
+    """
+    Token bucket refilled at a steady rate up to its capacity, per minute.
+    """
+
+    def __init__(self, capacity: float | None = None) -> None:
+        """
+        Parameters
+        ----------
+        capacity : float, optional
+            The quota per minute, by default None for unlimited until known.
+        """
+        self.capacity = capacity
+        self.level = capacity or 0.0
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        if self.capacity is not None:
+            rate = self.capacity / 60
+            self.level = min(self.capacity, self.level + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait(self, amount: float) -> float:
+        """
+        Return the time until the bucket holds an amount, at most its capacity.
+        """
+        self.refill()
+        if self.capacity is None:
+            return 0.0
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / (self.capacity / 60))
+
+    def take(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.level -= amount
+
+    def sync(self, limit: float | None, remaining: float | None) -> None:
+        """
+        Use the quota and the remaining amount given by the provider.
+        """
+        self.refill()
+        if limit is not None and limit != self.capacity:
+            self.level = limit if self.capacity is None else self.level
+            self.capacity = limit
+        if remaining is not None and self.capacity is not None:
+            self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute of a provider, the requests waiting in order
+    of arrival until both are available.
+    """
+
+    def __init__(self, rpm: int | None = None, tpm: int | None = None) -> None:
+        """
+        Parameters
+        ----------
+        rpm : int, optional
+            The requests per minute, by default None until given by the provider.
+        tpm : int, optional
+            The tokens per minute, by default None until given by the provider.
+        """
+        self.requests = Bucket(rpm)
+        self.tokens = Bucket(tpm)
+        self.configured = (rpm, tpm)
+        self.paused = 0.0  # Monotonic time until which the provider rejects
+        self.lock = asyncio.Lock()  # Served in order of arrival
+        self.waited = 0  # Requests which waited for the quota
+        self.rejected = 0
+        self.limited = 0  # Requests rejected by the provider
+
+    def configure(self, rpm: int | None, tpm: int | None) -> None:
+        """
+        Use the configured quotas, if changed, until the provider gives them.
+        """
+        if (rpm, tpm) != self.configured:
+            self.configured = (rpm, tpm)
+            self.requests, self.tokens = Bucket(rpm), Bucket(tpm)
+
+    async def acquire(self, tokens: int, deadline: float) -> None:
+        """
+        Wait until a request of an estimated number of tokens may be sent.
+
+        Raises
+        ------
+        HTTPException
+            429 if the request can't be sent before its monotonic deadline.
+        """
+        async with self.lock:
+            waited = False
+            while True:
+                now = time.monotonic()
+                delay = max(
+                    self.paused - now,
+                    self.requests.wait(1),
+                    self.tokens.wait(tokens),
+                )
+                if delay <= 0:
+                    break
+                if now + delay > deadline:
+                    self.rejected += 1
+                    raise HTTPException(
+                        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                        detail="Quota of the provider reached, retry later.",
+                        headers={"Retry-After": str(max(1, math.ceil(delay)))},
+                    )
+                waited = True
+                await asyncio.sleep(delay)
+            self.waited += waited
+            self.requests.take(1)
+            self.tokens.take(tokens)
+
+    def update(self, headers) -> None:
+        """
+        Follow the rate limit headers of a response.
+        """
+        self.requests.sync(
+            number(headers.get("x-ratelimit-limit-requests")),
+            number(headers.get("x-ratelimit-remaining-requests")),
+        )
+        self.tokens.sync(
+            number(headers.get("x-ratelimit-limit-tokens")),
+            number(headers.get("x-ratelimit-remaining-tokens")),
+        )
+
+    def pause(self, delay: float) -> None:
+        """
+        Hold the requests for a delay in seconds, e.g. after a rejection.
+        """
+        self.limited += 1
+        self.paused = max(self.paused, time.monotonic() + delay)
+
+    def stats(self) -> dict:
+        return {
+            "rpm": self.requests.capacity,
+            "tpm": self.tokens.capacity,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "limited": self.limited,
+        }
+
+
+def number(value: str | None) -> float | None:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_after(headers) -> float | None:
+    """
+    Return the delay before retrying given by the headers of a rejection, in
+    seconds, None if none is given.
+    """
+    value = headers.get("retry-after-ms")
+    if value is not None and number(value) is not None:
+        return number(value) / 1000
+    value = headers.get("retry-after")
+    if value is None or number(value) is not None:
+        return number(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
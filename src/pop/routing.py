@@ -0,0 +1,117 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Routing of the outputs to a provider and a model, e.g. the one-line outputs to a
+small local model and the long ones to a large model.
+
+Routes are listed in the configuration file and the first one matching an output
+is used, the provider and the model of the settings otherwise:
+
+    routes:
+      - name: short
+        provider: ollama
+        model: qwen2:0.5b
+        max_tokens: 30
+      - name: critical
+        provider: openai
+        model: gpt-4o
+        states: [CRITICAL, DOWN]
+        max_queue: 16
+"""
+
+import re
+from typing import Literal
+
+from pydantic import BaseModel, Field, field_validator
+
+from pop.compact import tokens
+from pop.globals import Provider
+from pop.scheduler import PRIORITIES, STATE
+
+
+class Route(BaseModel):
+    """
+    A provider and a model for the outputs meeting every condition given.
+    """
+
+    name: str
+    provider: Provider
+    model: str
+    min_length: int | None = Field(default=None, ge=0)  # Characters of the output
+    max_length: int | None = Field(default=None, ge=0)
+    min_tokens: int | None = Field(default=None, ge=0)  # Estimated, see `tokens`
+    max_tokens: int | None = Field(default=None, ge=0)
+    states: list[str] | None = None  # State starting the output, e.g. CRITICAL
+    type: Literal["host", "service"] | None = None
+    description: re.Pattern | None = None  # Searched in the description
+    max_queue: int | None = Field(default=None, ge=0)  # Requests of the provider
+
+    @field_validator("states")
+    @classmethod
+    def check_states(cls, states: list[str] | None) -> list[str] | None:
+        """
+        Check the states are known, whatever their case.
+        """
+        if states is None:
+            return None
+        states = [state.upper() for state in states]
+        unknown = [state for state in states if state not in PRIORITIES]
+        if unknown:
+            raise ValueError(f"Unknown states: {', '.join(unknown)}.")
+        return states
+
+    def matches(self, type: str, output: str, description: str, queue: int) -> bool:
+        """
+        Return True if an output meets the conditions of the route.
+
+        Parameters
+        ----------
+        type : str
+            The type of the resource. Either "host" or "service".
+        output : str
+            The output of the plugin.
+        description : str
+            The description of the resource.
+        queue : int
+            The number of requests in flight or waiting for the provider.
+        """
+        if self.type is not None and type != self.type:
+            return False
+        if self.states is not None and state(output) not in self.states:
+            return False
+        if not within(len(output), self.min_length, self.max_length):
+            return False
+        if not within(tokens(output), self.min_tokens, self.max_tokens):
+            return False
+        if self.description is not None and not self.description.search(description):
+            return False
+        return self.max_queue is None or queue <= self.max_queue
+
+
+def state(output: str) -> str | None:
+    """
+    Return the state of an output, None if it doesn't give one.
+    """
+    match = STATE.search(output)
+    return match.group(1) if match else None
+
+
+def within(value: int, low: int | None, high: int | None) -> bool:
+    """
+    Return True if a value is within optional bounds.
+    """
+    return (low is None or value >= low) and (high is None or value <= high)
@@ -0,0 +1,291 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Canned explanations of well-known outputs, served without the LLM.
+
+A rule pack is a YAML file of rules, each one a regular expression searched in the
+outputs and the explanation of the outputs it matches. The explanation may use the
+named groups of the expression and the `type`, `name`, `output` and `description`
+of the resource, and may be given by language:
+
+    rules:
+      - name: connection-refused
+        pattern: "Connection refused(?: on port (?P<port>\\d+))?"
+        explanation: "{name} refused the connection, check the service is running."
+      - name: no-output
+        pattern: "No output returned from plugin"
+        explanation:
+          English: "The plugin ended without writing anything."
+          French: "Le plugin s'est terminé sans rien écrire."
+
+The first rule of the pack matching an output is used. Searching thousands of
+expressions in every output would be slow, so the rules are indexed by a few
+characters their expression always matches, starting with a separator like a
+space, and an output is only searched with the rules whose characters follow one
+of its separators.
+"""
+
+import os
+import re
+import string
+from collections import Counter
+
+import yaml
+from pydantic import BaseModel, ValidationError, ValidationInfo, field_validator
+
+from pop.globals import Language
+
+# Characters indexing a rule, the longer the fewer rules share them.
+GRAM = 4
+
+# Start of the characters indexing a rule, rare enough to look up quickly.
+SEPARATOR = re.compile(r"\W")
+
+# Digits following an escape, e.g. "\x41", up to the given ending.
+ARGUMENTS = {"x": 2, "u": 4, "U": 8, "N": "}"}
+
+# Fields of the resource available to the explanations.
+FIELDS = ("type", "name", "output", "description")
+
+
+class Rule(BaseModel):
+    """
+    An expression searched in the outputs and their explanation.
+    """
+
+    name: str
+    pattern: re.Pattern
+    explanation: str | dict[Language, str]
+
+    @field_validator("explanation")
+    @classmethod
+    def check_explanation(
+        cls, explanation: str | dict[Language, str], info: ValidationInfo
+    ) -> str | dict[Language, str]:
+        """
+        Check the fields of the explanation are known.
+        """
+        pattern = info.data.get("pattern")
+        known = set(FIELDS) | set(pattern.groupindex if pattern else ())
+        texts = explanation.values() if isinstance(explanation, dict) else [explanation]
+        for text in texts:
+            try:
+                fields = {field for _, field, _, _ in string.Formatter().parse(text)}
+            except ValueError as e:
+                raise ValueError(f"Invalid explanation: {e}")
+            unknown = fields - known - {None}
+            if unknown:
+                raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}.")
+        return explanation
+
+
+class Fields(dict):
+    """
+    Fields of an explanation, the unmatched groups being unknown.
+    """
+
+    def __missing__(self, key: str) -> str:
+        return "n/a"
+
+
+class RulePack:
+    """
+    Rules indexed by the grams of characters their expression always matches,
+    starting with a separator.
+    """
+
+    def __init__(self, rules: list[Rule], stamp: tuple | None = None) -> None:
+        """
+        Parameters
+        ----------
+        rules : list[Rule]
+            The rules, in order of preference.
+        stamp : tuple, optional
+            The modification time and size of the file of the rules.
+        """
+        self.rules = rules
+        self.stamp = stamp
+        self.index: dict[str, list[int]] = {}
+        self.scanned: list[int] = []  # Rules without grams, tried on every output
+
+        grams = [
+            {gram for gram in literals(rule.pattern) if SEPARATOR.match(gram)}
+            for rule in rules
+        ]
+        # The rarest gram of each rule indexes it, so few rules share an entry.
+        counts = Counter(gram for rule in grams for gram in rule)
+        for number, rule in enumerate(grams):
+            if rule:
+                gram = min(rule, key=lambda gram: (counts[gram], gram))
+                self.index.setdefault(gram, []).append(number)
+            else:
+                self.scanned.append(number)
+
+    def match(
+        self, type: str, name: str, output: str, description: str, language: Language
+    ) -> tuple[str, str] | None:
+        """
+        Return the name of the first rule matching an output and its explanation,
+        None if none does.
+        """
+        text = output.lower()
+        candidates = set(self.scanned)
+        for separator in SEPARATOR.finditer(text):
+            start = separator.start()
+            rules = self.index.get(text[start : start + GRAM])
+            if rules is not None:
+                candidates.update(rules)
+
+        for number in sorted(candidates):
+            rule = self.rules[number]
+            match = rule.pattern.search(output)
+            if match is None:
+                continue
+            explanation = rule.explanation
+            if isinstance(explanation, dict):
+                explanation = explanation.get(language)
+                if explanation is None:
+                    continue  # Left to the LLM in this language
+            fields = Fields(
+                type=type, name=name, output=output, description=description
+            )
+            fields.update(
+                (key, value)
+                for key, value in match.groupdict().items()
+                if value is not None
+            )
+            return rule.name, explanation.format_map(fields).strip()
+        return None
+
+
+def literals(pattern: re.Pattern) -> set[str]:
+    """
+    Return the grams of lowercase characters matched by a pattern whatever the
+    output, empty if unknown.
+
+    Only the characters out of any group, class or repetition are considered, and
+    none if the pattern has alternatives.
+    """
+    if pattern.flags & re.VERBOSE:
+        return set()  # Spaces are not characters to match
+    source = pattern.pattern
+    runs, run, depth, index = [], "", 0, 0
+    while index < len(source):
+        char = source[index]
+        if char == "\\":
+            escaped = source[index + 1 : index + 2]
+            index += 2
+            if depth == 0 and escaped and not escaped.isalnum():
+                run += escaped
+                continue
+            # A class, an anchor, a reference or a character given by its code.
+            runs.append(run)
+            run = ""
+            argument = ARGUMENTS.get(escaped)
+            if isinstance(argument, int):
+                index += argument
+            elif argument is not None:
+                index = closing(source, argument, index) + 1
+            while escaped.isdigit() and source[index : index + 1].isdigit():
+                index += 1
+            continue
+        if char == "[":
+            # Skip the class, where "]" is a character if first.
+            index += 2 if source[index + 1 : index + 2] == "^" else 1
+            index += 1 if source[index : index + 1] == "]" else 0
+            while index < len(source) and source[index] != "]":
+                index += 2 if source[index] == "\\" else 1
+            runs.append(run)
+            run = ""
+        elif char in "()":
+            depth += 1 if char == "(" else -1
+            runs.append(run)
+            run = ""
+        elif depth:
+            pass
+        elif char == "|":
+            return set()
+        elif char in "*?{":
+            # The previous character may be missing.
+            runs.append(run[:-1])
+            run = ""
+            if char == "{":
+                index = closing(source, "}", index)
+        elif char in "+.^$":
+            runs.append(run)
+            run = ""
+        else:
+            run += char
+        index += 1
+    runs.append(run)
+    return {
+        run[start : start + GRAM].lower()
+        for run in runs
+        for start in range(len(run) - GRAM + 1)
+    }
+
+
+def closing(source: str, char: str, start: int) -> int:
+    """
+    Return the index of a closing character, the end of the source if missing.
+    """
+    index = source.find(char, start)
+    return len(source) if index < 0 else index
+
+
+def load(path: str) -> RulePack:
+    """
+    Load a rule pack, compiled again only if its file changed.
+
+    Raises
+    ------
+    ValueError
+        If the file is missing or not a valid rule pack.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise ValueError(f"Invalid rule pack: {e}")
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = PACKS.get(path)
+    if cached is not None and cached.stamp == stamp:
+        return cached
+
+    try:
+        with open(path) as file:
+            content = yaml.safe_load(file) or {}
+    except (OSError, yaml.YAMLError) as e:
+        raise ValueError(f"Invalid rule pack: {e}")
+    if not isinstance(content, dict) or not isinstance(content.get("rules"), list):
+        raise ValueError(f"Invalid rule pack: {path} has no list of rules.")
+    rules = []
+    for number, rule in enumerate(content["rules"], 1):
+        try:
+            rules.append(Rule.model_validate(rule))
+        except ValidationError as e:
+            reason = e.errors()[0]["msg"].removeprefix("Value error, ")
+            raise ValueError(f"Invalid rule {number} of {path}: {reason}")
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Invalid rule pack: the names of {path} must be unique.")
+
+    PACKS[path] = RulePack(rules, stamp)
+    return PACKS[path]
+
+
+# Rule packs by path, shared by the validation of the settings and the processor.
+PACKS: dict[str, RulePack] = {}
@@ -0,0 +1,213 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import itertools
+import math
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException, status
+
+# Lower is more urgent, outputs without a known state come after the warnings.
+PRIORITIES = {
+    "CRITICAL": 0,
+    "DOWN": 0,
+    "UNKNOWN": 1,
+    "UNREACHABLE": 1,
+    "WARNING": 2,
+    "OK": 4,
+    "UP": 4,
+}
+DEFAULT_PRIORITY = 3
+
+# A plugin output starts with its state, e.g. "CRITICAL: ..." or "OK - ...".
+STATE = re.compile(r"\b(" + "|".join(PRIORITIES) + r")\b\s*[:-]")
+
+
+def priority(text: str) -> int:
+    """
+    Return the priority of an output, or of a prompt containing it.
+    """
+    match = STATE.search(text)
+    return PRIORITIES[match.group(1)] if match else DEFAULT_PRIORITY
+
+
+class Scheduler:
+    """
+    Admission control in front of a provider.
+
+    At most `concurrency` requests are in flight, the others wait in a bounded
+    queue ordered by priority. Requests are rejected rather than queued when they
+    cannot be served before their deadline, and a full queue sheds its least
+    urgent request in favor of a more urgent one.
+    """
+
+    def __init__(self, concurrency: int, size: int, timeout: float) -> None:
+        """
+        Parameters
+        ----------
+        concurrency : int
+            The maximum number of requests in flight.
+        size : int
+            The maximum number of requests waiting.
+        timeout : float
+            The maximum time a request waits in the queue, in seconds.
+        """
+        self.concurrency = concurrency
+        self.size = size
+        self.timeout = timeout
+        self.inflight = 0
+        # Waiting requests by priority, each in arrival order and keyed by it.
+        # A request leaves its queue as soon as it is served, shed or gives up.
+        self.queues: dict[int, dict[int, asyncio.Future]] = {}
+        self.order = itertools.count()
+        self.waiting = 0  # Number of requests in the queues
+
+        self.service = 1.0  # Moving average of the time in flight, in seconds
+        self.waits: deque[float] = deque(maxlen=1000)
+        self.admitted = 0
+        self.rejected = 0
+        self.shed = 0
+        self.expired = 0
+
+    @asynccontextmanager
+    async def slot(self, priority: int = DEFAULT_PRIORITY):
+        """
+        Wait for a slot to send a request to the provider.
+
+        Raises
+        ------
+        HTTPException
+            429 if the queue is full of more urgent requests, 503 if the request
+            can't be served before its deadline or is shed by a more urgent one.
+        """
+        start = time.monotonic()
+        await self.acquire(priority)
+        self.waits.append(time.monotonic() - start)
+        self.admitted += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.service += 0.1 * (time.monotonic() - start - self.service)
+            self.release()
+
+    async def acquire(self, priority: int) -> None:
+        """
+        Take a slot, waiting for one in the queue if none is free.
+        """
+        if self.inflight < self.concurrency and self.waiting == 0:
+            self.inflight += 1
+            return
+
+        ahead = sum(len(queue) for p, queue in self.queues.items() if p <= priority)
+        if (ahead + 1) * self.service / self.concurrency > self.timeout:
+            self.rejected += 1
+            raise self.error(status.HTTP_503_SERVICE_UNAVAILABLE, "Overloaded")
+
+        if self.waiting >= self.size:
+            least = max((p for p, queue in self.queues.items() if queue), default=None)
+            if least is None or least <= priority:
+                self.rejected += 1
+                raise self.error(status.HTTP_429_TOO_MANY_REQUESTS, "Queue full")
+            # Shed the last arrived of the least urgent requests.
+            _, shed = self.queues[least].popitem()
+            self.waiting -= 1
+            shed.set_exception(self.error(status.HTTP_503_SERVICE_UNAVAILABLE, "Shed"))
+            self.shed += 1
+
+        order = next(self.order)
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(priority, {})[order] = future
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.expired += 1
+            self.cancel(priority, order, future)
+            raise self.error(status.HTTP_503_SERVICE_UNAVAILABLE, "Queue timeout")
+        except asyncio.CancelledError:
+            self.cancel(priority, order, future)
+            raise
+
+    def cancel(self, priority: int, order: int, future: asyncio.Future) -> None:
+        """
+        Give up waiting, giving back the slot if it was just handed over.
+        """
+        if self.queues[priority].pop(order, None) is not None:
+            future.cancel()
+            self.waiting -= 1
+        elif not future.cancelled() and future.exception() is None:
+            self.release()
+
+    def release(self) -> None:
+        """
+        Give the slot to the most urgent waiting request, or free it.
+        """
+        if self.inflight > self.concurrency:
+            # The concurrency was lowered, see `resize`.
+            self.inflight -= 1
+            return
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            if queue:
+                future = queue.pop(next(iter(queue)))
+                self.waiting -= 1
+                future.set_result(None)
+                return
+        self.inflight -= 1
+
+    def resize(self, concurrency: int) -> None:
+        """
+        Change the maximum number of requests in flight, admitting waiting
+        requests at once if raised, and letting requests in flight end if lowered.
+        """
+        self.concurrency = concurrency
+        while self.inflight < self.concurrency and self.waiting:
+            self.inflight += 1
+            self.release()
+
+    def error(self, code: int, reason: str) -> HTTPException:
+        """
+        Return an error asking the client to retry once the queue is drained.
+        """
+        retry = math.ceil((self.waiting + 1) * self.service / self.concurrency)
+        return HTTPException(
+            status_code=code,
+            detail=f"{reason}, retry later.",
+            headers={"Retry-After": str(max(1, retry))},
+        )
+
+    def stats(self) -> dict:
+        """
+        Return the queue depth and counters, and the waiting times in seconds.
+        """
+        waits = sorted(self.waits)
+        return {
+            "inflight": self.inflight,
+            "queued": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "expired": self.expired,
+            "wait_mean": sum(waits) / len(waits) if waits else 0,
+            "wait_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0,
+            "wait_max": waits[-1] if waits else 0,
+        }
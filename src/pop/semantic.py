@@ -0,0 +1,250 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Semantic cache of explanations, serving the explanation of a similar output.
+
+Outputs like "CRITICAL: /var usage 97%" and "CRITICAL: /var usage 98%" have the
+same explanation. Their embeddings, computed by a local model, are close, so the
+explanation of the first one is served for the second one when the cosine
+similarity of their embeddings is above a threshold.
+
+NumPy is an optional dependency, only imported when the semantic cache is enabled.
+"""
+
+import asyncio
+import contextlib
+import glob
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from pop.compact import split
+from pop.logger import logger
+
+# Rows of the index compared at once, bounding the memory used by a search.
+CHUNK = 65536
+
+# Minimum similarity of the cached explanation and the one of the LLM for an
+# audited hit to be right.
+AGREEMENT = 0.8
+
+
+def normalize(type: str, output: str) -> str:
+    """
+    Return the text of an output to embed, without its performance data and with
+    single spaces.
+    """
+    text, _ = split(output)
+    return f"{type}: {' '.join(text.split())}"
+
+
+def unit(vector: list[float]) -> np.ndarray:
+    """
+    Return a vector scaled to a length of 1, so a dot product is a cosine.
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def similarity(a: list[float], b: list[float]) -> float:
+    """
+    Return the cosine similarity of two vectors.
+    """
+    return float(unit(a) @ unit(b))
+
+
+class SemanticCache:
+    """
+    Index of the embeddings of the explained outputs.
+
+    The embeddings are kept in a memory-mapped NumPy file next to the database,
+    searched by blocks of rows at once, and the explanations in the database.
+    The index is a ring of `size` rows, the oldest entries are replaced once it
+    is full. Without a database, both are kept in memory.
+
+    The index is accessed from a thread, so a search over a large index doesn't
+    block the event loop. Workers share the file, which is mapped by each one.
+    """
+
+    def __init__(
+        self, size: int, ttl: float, threshold: float, path: str | None = None
+    ) -> None:
+        """
+        Parameters
+        ----------
+        size : int
+            The maximum number of entries.
+        ttl : float
+            The time to live of an entry in seconds.
+        threshold : float
+            The minimum cosine similarity of a hit.
+        path : str, optional
+            The path of the SQLite database, by default None to keep the index in
+            memory.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.path = path
+        self.file = None  # Embeddings file of the current scope
+        self.vectors: np.ndarray | None = None  # Mapped once the file exists
+
+        self.lock = threading.Lock()  # The connection is shared by threads
+        self.db = sqlite3.connect(
+            path or ":memory:", timeout=10, check_same_thread=False
+        )
+        if path is not None:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS semantic"
+            " (slot INTEGER PRIMARY KEY, created REAL, explanation TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.db.commit()
+
+    async def get(self, vector: list[float]) -> tuple[float, str | None]:
+        """
+        Return the similarity of the closest output and its explanation, None if
+        below the threshold or expired.
+        """
+        return await asyncio.to_thread(self._search, unit(vector))
+
+    async def set(self, vector: list[float], explanation: str) -> None:
+        """
+        Add the embedding of an output and its explanation.
+        """
+        await asyncio.to_thread(self._add, unit(vector), explanation)
+
+    def _search(self, vector: np.ndarray) -> tuple[float, str | None]:
+        with self.lock:
+            count = min(self._count(), self.size)
+            vectors = self._open()
+            if vectors is None or count == 0 or vectors.shape[1] != len(vector):
+                return 0.0, None
+            best, slot = -1.0, None
+            for start in range(0, count, CHUNK):
+                scores = vectors[start : min(start + CHUNK, count)] @ vector
+                index = int(np.argmax(scores))
+                if scores[index] > best:
+                    best, slot = float(scores[index]), start + index
+            if best < self.threshold:
+                return best, None
+            row = self.db.execute(
+                "SELECT created, explanation FROM semantic WHERE slot = ?", (slot,)
+            ).fetchone()
+        if row is None or time.time() - row[0] >= self.ttl:
+            return best, None
+        return best, row[1]
+
+    def _add(self, vector: np.ndarray, explanation: str) -> None:
+        with self.lock:
+            vectors = self._open(len(vector))
+            if vectors.shape[1] != len(vector):
+                logger.warning("Embeddings size changed, semantic cache not updated.")
+                return
+            with self.db:
+                # Allocated by the database, which is shared by the workers.
+                (count,) = self.db.execute(
+                    "INSERT INTO metadata VALUES ('semantic_count', 1)"
+                    " ON CONFLICT (name) DO UPDATE SET value = value + 1"
+                    " RETURNING value"
+                ).fetchone()
+            slot = (int(count) - 1) % self.size
+            # Never pair the embedding of an output with another explanation.
+            vectors[slot] = 0
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO semantic VALUES (?, ?, ?)",
+                    (slot, time.time(), explanation),
+                )
+            vectors[slot] = vector
+
+    def _count(self) -> int:
+        row = self.db.execute(
+            "SELECT value FROM metadata WHERE name = 'semantic_count'"
+        ).fetchone()
+        return int(row[0]) if row is not None else 0
+
+    def _open(self, dimensions: int | None = None) -> np.ndarray | None:
+        """
+        Return the embeddings, created with the given dimensions if missing.
+        """
+        if self.vectors is not None:
+            return self.vectors
+        if self.file is None:
+            if dimensions is not None:
+                self.vectors = np.zeros((self.size, dimensions), dtype=np.float32)
+            return self.vectors
+        if not os.path.exists(self.file):
+            if dimensions is None:
+                return None
+            # Created aside then linked, so a worker never maps a file another
+            # worker replaces.
+            temporary = f"{self.file}.{os.getpid()}.tmp"
+            open_memmap(
+                temporary, mode="w+", dtype=np.float32, shape=(self.size, dimensions)
+            ).flush()
+            try:
+                os.link(temporary, self.file)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temporary)
+        self.vectors = open_memmap(self.file, mode="r+")
+        return self.vectors
+
+    def scope(self, fingerprint: str) -> None:
+        """
+        Purge the cache if it was filled with a different fingerprint.
+
+        The fingerprint identifies the settings whose change invalidates every
+        explanation or embedding, like the model or the embedding model.
+        """
+        with self.lock:
+            if self.path is not None:
+                file = f"{self.path}.vectors-{fingerprint[:16]}.npy"
+                if file != self.file:
+                    self.file, self.vectors = file, None
+            row = self.db.execute(
+                "SELECT value FROM metadata WHERE name = 'semantic_fingerprint'"
+            ).fetchone()
+            if row is not None and row[0] == fingerprint:
+                return
+            self.vectors = None
+            with self.db:
+                self.db.execute("DELETE FROM semantic")
+                self.db.execute("DELETE FROM metadata WHERE name = 'semantic_count'")
+                self.db.execute(
+                    "INSERT OR REPLACE INTO metadata"
+                    " VALUES ('semantic_fingerprint', ?)",
+                    (fingerprint,),
+                )
+            if self.path is not None:
+                for file in glob.glob(f"{glob.escape(self.path)}.vectors-*.npy"):
+                    # Another worker may have removed it meanwhile.
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(file)
+        if row is not None:
+            logger.info("Semantic cache purged.")
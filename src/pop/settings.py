@@ -14,14 +14,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import importlib.util
+import os
 import sys
 from enum import Enum
+from pathlib import Path
+from typing import Literal
 
-from pydantic import BaseModel, Field, ValidationInfo, field_serializer, field_validator
+import yaml
+from pydantic import (
+    BaseModel,
+    Field,
+    ValidationError,
+    ValidationInfo,
+    field_serializer,
+    field_validator,
+)
 
+from pop import rules
 from pop.globals import DEFAULT_ROLE, Language, Provider
 from pop.logger import logger
 from pop.providers import PROVIDERS
+from pop.routing import Route
 
 # Disable traceback in case of error, cleaner logs especially for REST API
 sys.tracebacklimit = 0
@@ -29,13 +43,75 @@ sys.tracebacklimit = 0
 
 class Settings(BaseModel):
 
+    # Declared first to be known when validating the provider.
+    models_ttl: int = Field(default=86400, ge=0)
     provider: Provider | None = Field(default=None, validate_default=True)
     model: str | None = Field(default=None, validate_default=True)
     url: str | None = Field(default=None, validate_default=True)
-    temperature: float = 1
-    length: int = 100
+    temperature: float = 1.0
+    length: int = Field(default=100, gt=0)
     language: Language = Language.ENGLISH
     role: str = DEFAULT_ROLE
+    concurrency: int = Field(default=64, gt=0)
+    queue_size: int = Field(default=256, ge=0)
+    queue_timeout: float = Field(default=30, gt=0)
+    batch_concurrency: int = Field(default=16, gt=0)
+    batch_size: int = Field(default=1000, gt=0)
+    cache_size: int = Field(default=1024, ge=0)
+    cache_ttl: int = Field(default=86400, ge=0)
+    cache_persist: bool = True
+    prompt_store_size: int = Field(default=10000, gt=0)
+    prompt_ttl: int = Field(default=3600, gt=0)
+    prompt_compress: bool = False
+    compact: bool = True
+    output_budget: int = Field(default=512, gt=0)
+    workers: int = Field(default=1, gt=0)
+    timeout: float = Field(default=60, gt=0)
+    timeouts: dict[str, float] = {}
+    failover: bool = True
+    hedge: bool = False
+    hedge_delay: float | None = None
+    breaker_window: int = Field(default=20, gt=1)
+    breaker_errors: float = Field(default=0.5, gt=0, le=1)
+    breaker_latency: float | None = None
+    breaker_cooldown: float = Field(default=30, ge=0)
+    keep_alive: str | int = "30m"
+    keep_warm: float | None = Field(default=None, gt=0)
+    warm_up: bool = True
+    ollama_options: dict[str, int | float | str | bool] = {}
+    semantic_cache: bool = False
+    semantic_model: str = "nomic-embed-text"
+    semantic_threshold: float = Field(default=0.95, gt=0, le=1)
+    semantic_size: int = Field(default=10000, gt=0)
+    semantic_audit: float = Field(default=0, ge=0, le=1)
+    watch_interval: float | None = Field(default=2, gt=0)
+    routes: list[Route] = []
+    rules_path: str | None = None
+    slow_request: float | None = Field(default=30, gt=0)
+    profile: bool = False
+    profile_sample: float = Field(default=0, ge=0, le=1)
+    profile_interval: float = Field(default=60, ge=0)
+    job_queue_size: int = Field(default=1000, gt=0)
+    job_ttl: int = Field(default=86400, gt=0)
+    job_concurrency: int = Field(default=4, gt=0)
+    job_webhook: str | None = None
+    job_webhook_secret: str | None = None
+    job_webhook_retries: int = Field(default=5, ge=0)
+    tokens_per_word: float | None = Field(default=2, gt=0)
+    stop: list[str] = Field(default=[], max_length=4)
+    cutoff: bool = True
+    engine: Literal["native", "litellm"] = "native"
+    connect_timeout: float = Field(default=5, gt=0)
+    max_connections: int = Field(default=100, gt=0)
+    max_keepalive: int = Field(default=20, ge=0)
+    keepalive_expiry: float = Field(default=30, ge=0)
+    ollama_balance: Literal["least", "latency"] = "least"
+    ollama_eject_errors: int = Field(default=3, gt=0)
+    ollama_health_interval: float = Field(default=10, gt=0)
+    openai_rpm: int | None = Field(default=None, gt=0)
+    openai_tpm: int | None = Field(default=None, gt=0)
+    retries: int = Field(default=3, ge=0)
+    retry_backoff: float = Field(default=0.5, gt=0)
 
     @field_serializer("provider", "language")
     def serialize_enum(self, enum: Enum | None) -> str:
@@ -46,17 +122,20 @@ class Settings(BaseModel):
 
     @field_validator("provider")
     @classmethod
-    def check_provider(cls, name: Provider) -> Provider:
+    def check_provider(cls, name: Provider, info: ValidationInfo) -> Provider:
         """
         Use the provider given by the user, if it's not available try a new one.
         """
+        if not must_discover(info):
+            return name
 
         providers = [provider for key, provider in PROVIDERS.items() if key != name]
         if name in PROVIDERS:
             providers.insert(0, PROVIDERS.get(name))
 
+        models = (info.context or {}).get("models")
         for provider in providers:
-            provider.fetch()
+            provider.discover(models, info.data.get("models_ttl", 0))
             if not provider.available:
                 logger.warning(
                     f"{provider.name} is not available. Trying another provider."
@@ -77,12 +156,58 @@ class Settings(BaseModel):
         provider = PROVIDERS.get(info.data.get("provider"))
         if provider is None:
             raise ValueError("Provider not set")
+        # Without discovery, checked only if the models are known, e.g. on reload.
+        if not must_discover(info) and not provider.available:
+            return model
         if model not in provider.models:
             logger.warning(f"{model} is not available for {provider.name}.")
             model = provider.default
         logger.info(f"Using {model} model.")
         return model
 
+    @field_validator("semantic_cache")
+    @classmethod
+    def check_semantic_cache(cls, enabled: bool) -> bool:
+        """
+        Check NumPy, an optional dependency, is installed to use the semantic cache.
+        """
+        if enabled and importlib.util.find_spec("numpy") is None:
+            raise ValueError("The semantic cache needs NumPy, install pop[semantic].")
+        return enabled
+
+    @field_validator("engine")
+    @classmethod
+    def check_engine(cls, engine: str) -> str:
+        """
+        Check litellm, an optional dependency, is installed to complete with it.
+        """
+        if engine == "litellm" and importlib.util.find_spec("litellm") is None:
+            raise ValueError("The litellm engine needs litellm, install pop[litellm].")
+        return engine
+
+    @field_validator("routes")
+    @classmethod
+    def check_routes(cls, routes: list[Route]) -> list[Route]:
+        """
+        Check the names of the routes, which label their metrics, are unique.
+        """
+        names = [route.name for route in routes]
+        if "default" in names:
+            raise ValueError("The default route is the one of the provider in use.")
+        if len(set(names)) != len(names):
+            raise ValueError("The names of the routes must be unique.")
+        return routes
+
+    @field_validator("rules_path")
+    @classmethod
+    def check_rules_path(cls, path: str | None) -> str | None:
+        """
+        Check the rule pack is valid, compiling it for the processor.
+        """
+        if path is not None:
+            rules.load(path)
+        return path
+
     @field_validator("url")
     @classmethod
     def set_url(cls, url: str, info: ValidationInfo) -> str:
@@ -93,3 +218,164 @@ class Settings(BaseModel):
         if provider is None:
             raise ValueError("Provider not set")
         return provider.url
+
+
+def discover_fallbacks(settings: Settings, path: str) -> None:
+    """
+    Discover the providers other than the one in use, to fall back or route to
+    them.
+
+    Parameters
+    ----------
+    settings : Settings
+        The settings, only the providers of the routes are discovered if the
+        failover is disabled.
+    path : str
+        The path of the configuration file.
+    """
+    routed = {route.provider for route in settings.routes}
+    for name, provider in PROVIDERS.items():
+        if name == settings.provider or provider.status != "unknown":
+            continue
+        if not settings.failover and name not in routed:
+            continue
+        try:
+            provider.discover(models_path(path), settings.models_ttl)
+        except Exception as e:
+            logger.warning(f"Fallback {name.value} unavailable: {e}")
+
+    for route in settings.routes:
+        provider = PROVIDERS[route.provider]
+        if route.model not in provider.models:
+            logger.warning(
+                f"{route.model} is not available for {provider.name}, "
+                f"route {route.name} skipped."
+            )
+
+
+def must_discover(info: ValidationInfo) -> bool:
+    """
+    Return True if the providers must be fetched to validate the settings.
+    """
+    return (info.context or {}).get("discover", True)
+
+
+def config_path() -> str:
+    """
+    Return the path of the configuration file.
+    """
+    # Default path to the root of the project if not provided.
+    default_path = os.path.join(os.getcwd(), "pop.yaml")
+    return os.environ.get("POP_CONFIG_PATH", default_path)
+
+
+def models_path(path: str) -> str:
+    """
+    Return the path of the file caching the models fetched from the providers.
+    """
+    # Cached next to the configuration file.
+    return os.path.join(os.path.dirname(path), "models.json")
+
+
+def load_settings(path: str, discover: bool = True) -> Settings | None:
+    """
+    Load the settings from the configuration file and create it if it doesn't exist.
+
+    Parameters
+    ----------
+    path : str
+        The path of the configuration file.
+    discover : bool, optional
+        Whether to fetch the providers to check the provider and the model, and
+        write the result back to the configuration file, by default True.
+
+    Returns
+    -------
+    settings : Settings | None
+        The settings, None if the providers must be discovered to complete the
+        configuration but discover is False.
+
+    Raises
+    ------
+    ValueError
+        If the configuration is not valid or none of the providers are available.
+    """
+
+    config = read_config(path)
+
+    if not discover and not (config.get("provider") and config.get("model")):
+        return None
+
+    try:
+        settings = Settings.model_validate(
+            config, context={"discover": discover, "models": models_path(path)}
+        )
+    except ValidationError as e:
+        raise ValueError(e.errors()[0]["msg"])
+
+    # Write the discovered provider and model back, and every setting to a new
+    # file, leaving the file untouched if nothing was discovered.
+    discovered = {"provider": settings.provider.value, "model": settings.model}
+    if discover and not config:
+        with open(path, "w") as file:
+            yaml.safe_dump(settings.model_dump(exclude=["url"]), file)
+    elif discover and any(config.get(k) != v for k, v in discovered.items()):
+        with open(path, "w") as file:
+            yaml.safe_dump({**config, **discovered}, file)
+
+    logger.info(f"Configuration path: {path}")
+    return settings
+
+
+def reload_settings(path: str, current: Settings) -> Settings:
+    """
+    Load the settings from the configuration file again while serving.
+
+    The models are fetched only if the provider changed, and the configuration
+    file is not written, so watching it doesn't reload it again.
+
+    Parameters
+    ----------
+    path : str
+        The path of the configuration file.
+    current : Settings
+        The settings in use, whose provider and model are kept if not given.
+
+    Returns
+    -------
+    settings : Settings
+        The new settings.
+
+    Raises
+    ------
+    ValueError
+        If the configuration is not valid or none of the providers are available.
+    """
+
+    config = read_config(path)
+    config.setdefault("provider", current.provider.value)
+    if config["provider"] == current.provider.value:
+        config.setdefault("model", current.model)
+    discover = config["provider"] != current.provider.value
+
+    try:
+        return Settings.model_validate(
+            config, context={"discover": discover, "models": models_path(path)}
+        )
+    except ValidationError as e:
+        raise ValueError(e.errors()[0]["msg"])
+
+
+def read_config(path: str) -> dict:
+    """
+    Return the content of the configuration file, created empty if missing.
+    """
+    # Create a configuration file if doesn't exist
+    Path(path).touch()
+
+    with open(path, "r") as file:
+        try:
+            config = yaml.safe_load(file)
+        except yaml.YAMLError as e:
+            raise ValueError(f"Invalid configuration file: {e}")
+    return config if isinstance(config, dict) else {}
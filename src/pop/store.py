@@ -0,0 +1,205 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from uuid import UUID
+
+# Minimum time between two purges of the old prompts of the shared store, in
+# seconds. Prompts beyond the size or the TTL are ignored when read meanwhile.
+SWEEP_INTERVAL = 1
+
+
+class _Entry:
+    """
+    A stored prompt, encoded and optionally compressed.
+    """
+
+    __slots__ = ("created", "body", "compressed")
+
+    def __init__(self, created: float, body: bytes, compressed: bool) -> None:
+        self.created = created
+        self.body = body
+        self.compressed = compressed
+
+
+class PromptStore:
+    """
+    Bounded store of the generated prompts, evicting the oldest ones.
+
+    Every entry has the same time to live, so the insertion order is also the
+    expiration order and expired entries are always at the front of the store.
+    """
+
+    def __init__(self, size: int, ttl: float, compress: bool = False) -> None:
+        """
+        Parameters
+        ----------
+        size : int
+            The maximum number of prompts stored.
+        ttl : float
+            The time to live of a prompt in seconds.
+        compress : bool, optional
+            Whether to compress the prompts with zlib, by default False.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.compress = compress
+        # Keyed by the integer value of the UUID which is smaller than the UUID.
+        self.entries: OrderedDict[int, _Entry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __setitem__(self, uuid: UUID, prompt: str) -> None:
+        now = time.monotonic()
+        self.expire(now)
+
+        body = prompt.encode()
+        if self.compress:
+            body = zlib.compress(body)
+        self.entries[uuid.int] = _Entry(now, body, self.compress)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def get(self, uuid: UUID) -> str | None:
+        """
+        Return the prompt or None if it is unknown or expired.
+        """
+        entry = self.entries.get(uuid.int)
+        if entry is None or time.monotonic() - entry.created >= self.ttl:
+            return None
+        body = zlib.decompress(entry.body) if entry.compressed else entry.body
+        return body.decode()
+
+    async def put(self, uuid: UUID, prompt: str) -> None:
+        """
+        Store a prompt, see `SharedPromptStore.put`.
+        """
+        self[uuid] = prompt
+
+    async def fetch(self, uuid: UUID) -> str | None:
+        """
+        Return the prompt or None, see `SharedPromptStore.fetch`.
+        """
+        return self.get(uuid)
+
+    def expire(self, now: float) -> None:
+        """
+        Remove the expired prompts.
+        """
+        while self.entries:
+            entry = next(iter(self.entries.values()))
+            if now - entry.created < self.ttl:
+                break
+            self.entries.popitem(last=False)
+
+
+class SharedPromptStore:
+    """
+    Bounded store of the generated prompts, shared between processes.
+
+    Prompts are kept in a SQLite database in WAL mode, so a prompt stored by a
+    worker can be read by any other one. The coroutines `put` and `fetch` access
+    the database from a thread, so a database locked by another worker doesn't
+    block the event loop.
+    """
+
+    def __init__(self, path: str, size: int, ttl: float, compress: bool = False):
+        """
+        Parameters
+        ----------
+        path : str
+            The path of the SQLite database.
+        size : int
+            The maximum number of prompts stored.
+        ttl : float
+            The time to live of a prompt in seconds.
+        compress : bool, optional
+            Whether to compress the prompts with zlib, by default False.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.compress = compress
+        self.lock = threading.Lock()  # The connection is shared by threads
+        self.swept = 0.0  # When the old prompts were last purged
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Prompts are short lived, no need to fsync each of them.
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS prompts (id INTEGER PRIMARY KEY,"
+            " uuid BLOB UNIQUE, created REAL, body BLOB, compressed INTEGER)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS prompts_created ON prompts (created)"
+        )
+        self.db.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM prompts").fetchone()[0]
+
+    def __setitem__(self, uuid: UUID, prompt: str) -> None:
+        now = time.time()
+        body = prompt.encode()
+        if self.compress:
+            body = zlib.compress(body)
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO prompts (uuid, created, body, compressed)"
+                " VALUES (?, ?, ?, ?)",
+                (uuid.bytes, now, body, self.compress),
+            )
+            if now - self.swept >= SWEEP_INTERVAL:
+                self.swept = now
+                # Ids are increasing, the oldest prompts have the lowest ids.
+                self.db.execute(
+                    "DELETE FROM prompts WHERE id <= ? OR created <= ?",
+                    (cursor.lastrowid - self.size, now - self.ttl),
+                )
+
+    def get(self, uuid: UUID) -> str | None:
+        """
+        Return the prompt or None if it is unknown, expired or evicted.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT created, body, compressed FROM prompts WHERE uuid = ?"
+                " AND id > (SELECT MAX(id) FROM prompts) - ?",
+                (uuid.bytes, self.size),
+            ).fetchone()
+        if row is None or time.time() - row[0] >= self.ttl:
+            return None
+        created, body, compressed = row
+        body = zlib.decompress(body) if compressed else body
+        return body.decode()
+
+    async def put(self, uuid: UUID, prompt: str) -> None:
+        """
+        Store a prompt without blocking the event loop.
+        """
+        await asyncio.to_thread(self.__setitem__, uuid, prompt)
+
+    async def fetch(self, uuid: UUID) -> str | None:
+        """
+        Return the prompt or None without blocking the event loop.
+        """
+        return await asyncio.to_thread(self.get, uuid)
@@ -0,0 +1,250 @@
+# plugin-output-processing
+# Copyright (C) 2024  Centreon
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Timing of the stages of each request, and sampling profiler of selected requests.
+
+The stages of a request (validation, cache lookup, prompt crafting, waiting for a
+provider slot, completion...) are recorded in the trace of the request, given to
+the client by a `Server-Timing` header and logged as JSON if the request is slow.
+
+A request may also be profiled: the stacks of the event loop thread are sampled
+while it is handled and written in the collapsed format of flame graphs, one
+`frame;frame;frame count` line per stack, which flamegraph.pl, speedscope or
+inferno read as is.
+"""
+
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from pop.logger import logger
+
+
+class Trace:
+    """
+    Durations of the stages of a request, in seconds, in order of completion.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.spans: list[tuple[str, float]] = []
+        self.attributes: dict[str, str] = {}  # E.g. the provider and the model
+
+    def header(self) -> str:
+        """
+        Return the value of the Server-Timing header, durations in milliseconds.
+        """
+        spans = self.spans + [("total", time.perf_counter() - self.start)]
+        return ", ".join(
+            f"{name};dur={duration * 1000:.1f}" for name, duration in spans
+        )
+
+
+# Trace of the request being handled, shared by the tasks it starts.
+trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+
+
+def record(name: str, duration: float) -> None:
+    """
+    Add a stage to the trace of the request being handled, if any.
+    """
+    current = trace.get()
+    if current is not None:
+        current.spans.append((name, duration))
+
+
+@contextmanager
+def span(name: str):
+    """
+    Time the block as a stage of the request being handled.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def lap(name: str) -> None:
+    """
+    Add a stage lasting from the start of the request being handled until now.
+    """
+    current = trace.get()
+    if current is not None:
+        current.spans.append((name, time.perf_counter() - current.start))
+
+
+def annotate(**attributes) -> None:
+    """
+    Describe the request being handled in its slow request log.
+    """
+    current = trace.get()
+    if current is not None:
+        current.attributes.update(
+            (key, str(getattr(value, "value", value)))
+            for key, value in attributes.items()
+        )
+
+
+def attributes() -> dict[str, str]:
+    """
+    Return the description of the request being handled, empty if none.
+    """
+    current = trace.get()
+    return current.attributes if current is not None else {}
+
+
+class Profiler:
+    """
+    Sampling profiler of a thread, counting its stacks.
+    """
+
+    def __init__(self, thread: int, interval: float = 0.005) -> None:
+        """
+        Parameters
+        ----------
+        thread : int
+            The identifier of the sampled thread.
+        interval : float, optional
+            The delay between two samples in seconds, by default 5ms.
+        """
+        self.thread = thread
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.running = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self) -> None:
+        self.running.set()
+        self.sampler.start()
+
+    def sample(self) -> None:
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                file = os.path.basename(code.co_filename)
+                frames.append(f"{code.co_name} ({file}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+            time.sleep(self.interval)
+
+    def stop(self, path: str) -> None:
+        """
+        Stop sampling and write the stacks to a file.
+        """
+        self.running.clear()
+        self.sampler.join()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware tracing the HTTP requests.
+
+    The settings are given by a callable, as they may change while serving: the
+    requests slower than `slow_request` are logged, and if `profile` is enabled,
+    those with a `X-Profile` header or a `profile_sample` of the others are
+    profiled, at most one every `profile_interval` seconds.
+    """
+
+    def __init__(self, app, settings, directory: str) -> None:
+        self.app = app
+        self.settings = settings  # Return the settings in use, None if not ready
+        self.directory = directory  # Where the profiles are written
+        self.profiling = False  # At most one profile at once
+        self.profiled = -math.inf  # Monotonic time of the last profile
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        current = Trace()
+        token = trace.set(current)
+        code = 500
+
+        async def send_timing(message):
+            nonlocal code
+            if message["type"] == "http.response.start":
+                code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", current.header().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profiler = self.profiler(scope)
+        try:
+            await self.app(scope, receive, send_timing)
+        finally:
+            trace.reset(token)
+            duration = time.perf_counter() - current.start
+            settings = self.settings()
+            if settings is not None and settings.slow_request is not None:
+                if duration >= settings.slow_request:
+                    self.log(scope, code, duration, current)
+            if profiler is not None:
+                name = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.folded"
+                path = os.path.join(self.directory, name)
+                await asyncio.to_thread(profiler.stop, path)
+                self.profiling = False
+                logger.info(f"Profile of {scope['path']} written to {path}.")
+
+    def profiler(self, scope) -> Profiler | None:
+        """
+        Return a started profiler if the request is selected to be profiled.
+        """
+        settings = self.settings()
+        if settings is None or not settings.profile or self.profiling:
+            return None
+        if time.monotonic() - self.profiled < settings.profile_interval:
+            return None
+        asked = any(name == b"x-profile" for name, _ in scope.get("headers", ()))
+        if not asked and random.random() >= settings.profile_sample:
+            return None
+        self.profiling, self.profiled = True, time.monotonic()
+        profiler = Profiler(threading.get_ident())
+        profiler.start()
+        return profiler
+
+    @staticmethod
+    def log(scope, code: int, duration: float, current: Trace) -> None:
+        """
+        Log a slow request and its stages as JSON.
+        """
+        record = {
+            "event": "slow_request",
+            "method": scope["method"],
+            "path": scope["path"],
+            "status": code,
+            "duration": round(duration, 4),
+            "spans": [[name, round(value, 4)] for name, value in current.spans],
+            **current.attributes,
+        }
+        logger.warning(json.dumps(record))